@@ -3,13 +3,24 @@
 from TSPSolver import *
 from TSPClasses import *
 
-import sys, getopt
+import contextlib
+import csv
+import getopt
+import io
+import json
+import math
+import statistics
+import sys
 
 ################################################################
-# 
+#
 # Run benchmarks for the traveling salesman problem
 #
-# Usage: python Benchmarks.py [--rounds=<int>] [--cities=<int>]
+# Usage: python Benchmarks.py [--rounds=<int>] [--cities=<int>[,<int>...]]
+#                             [--algorithms=<name>[,<name>...]]
+#                             [--time=<seconds>] [--seed=<int>]
+#                             [--difficulty=<name>] [--format=csv|json]
+#                             [--output=<file>]
 #
 #  - rounds :: number of times to run a particular benchmark and
 #    average out the results
@@ -17,38 +28,180 @@ import sys, getopt
 #  - cities :: defaults to do all the numbers of cities; this
 #   specifies a number to limit it to
 #
+# Round r of every size uses the scenario the GUI generates for that size
+# with seed `seed + r', so runs are repeatable and every algorithm sees the
+# same scenarios.  Each (size, algorithm) pair gets one row with the mean
+# and standard deviation over the rounds of the time, the tour cost and the
+# Instrumenter counters from the results dictionary.  Costs are only
+# averaged over the rounds that found a tour; `solved' counts those.
+#
 ################################################################
 
+ALGORITHMS = ['defaultRandomTour', 'greedy', 'multiStartGreedy', 'branchAndBound',
+              'parallelBranchAndBound', 'heldKarp', 'fancy', 'linKernighan']
+
+DEFAULT_CITIES = list(range(10, 51, 5))
+
+# The results dictionary entries that get averaged
+MEASURES = ['time', 'cost', 'count', 'max', 'total', 'pruned']
+
+COLUMNS = ['cities', 'algorithm', 'difficulty', 'rounds', 'solved'] + \
+          [m + suffix for m in MEASURES for suffix in ('_mean', '_stddev')]
+
+
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv, "h:rc", ["help", "rounds=", "cities="])
+        opts, args = getopt.getopt(sys.argv[1:], "hr:c:a:t:s:d:f:o:",
+                                   ["help", "rounds=", "cities=", "algorithms=", "time=",
+                                    "seed=", "difficulty=", "format=", "output="])
     except getopt.GetoptError as err:
         print(err)
         usage()
         sys.exit(2)
 
     rounds = 1
-    cities = "all"
-    for o, a in opts:
-        if o in ("-h", "--help"):
-            usage()
-            sys.exit()
-        elif o in ("-r", "--rounds"):
-            rounds = a
-        elif o in ("-c", "--cities"):
-            cities = a
-        else:
-            print(f"Undefined option {o}")
+    cities = DEFAULT_CITIES
+    algorithms = ALGORITHMS
+    time_allowance = 60.0
+    seed = 0
+    difficulty = 'Hard (Deterministic)'
+    out_format = 'csv'
+    output = None
+    try:
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                usage()
+                sys.exit()
+            elif o in ("-r", "--rounds"):
+                rounds = int(a)
+            elif o in ("-c", "--cities"):
+                cities = [int(c) for c in a.split(',')]
+            elif o in ("-a", "--algorithms"):
+                algorithms = a.split(',')
+            elif o in ("-t", "--time"):
+                time_allowance = float(a)
+            elif o in ("-s", "--seed"):
+                seed = int(a)
+            elif o in ("-d", "--difficulty"):
+                difficulty = a
+            elif o in ("-f", "--format"):
+                out_format = a
+            elif o in ("-o", "--output"):
+                output = a
+            else:
+                print(f"Undefined option {o}")
+                sys.exit(2)
+    except ValueError as err:
+        print(f"Error: {err}")
+        usage()
+        sys.exit(2)
+
+    for alg in algorithms:
+        if alg not in ALGORITHMS:
+            print(f"Error: unknown algorithm {alg}; choose from {', '.join(ALGORITHMS)}")
             sys.exit(2)
+    if out_format not in ('csv', 'json'):
+        print(f"Error: unknown format {out_format}")
+        sys.exit(2)
+
+    rows = run_benchmarks(cities, algorithms, rounds, time_allowance, seed, difficulty)
+    if output is None:
+        write_rows(rows, sys.stdout, out_format)
+    else:
+        with open(output, 'w', newline='') as f:
+            write_rows(rows, f, out_format)
 
 
 def usage():
     print("""
-Usage: python Benchmarks.py [-r|--rounds=<int>] [-c|--cities=<int>]
+Usage: python Benchmarks.py [-r|--rounds=<int>] [-c|--cities=<int>[,<int>...]]
+                            [-a|--algorithms=<name>[,<name>...]] [-t|--time=<seconds>]
+                            [-s|--seed=<int>] [-d|--difficulty=<name>]
+                            [-f|--format=csv|json] [-o|--output=<file>]
 
  - rounds: number of times to run to average; default is 1
  - cities: number of cities in benchmark; defaults runing 10..50 in steps of 5
-""")
+ - algorithms: TSPSolver entry points to run; defaults to all of
+   {}
+ - time: time allowance for each run in seconds; default is 60
+ - seed: seed of the first round's scenario; default is 0
+ - difficulty: Easy, Normal, Hard or Hard (Deterministic) (the default)
+ - format: csv (the default) or json
+ - output: file to write the results to; defaults to standard output
+""".format(', '.join(ALGORITHMS)))
+
+
+# run_benchmarks :: [Nat] -> [String] -> Nat -> Time -> Nat -> String -> [Row]
+#
+# One row (a dictionary with the COLUMNS as keys) per size and algorithm.
+# Whatever the solvers print goes nowhere, so it can't mix with the results.
+def run_benchmarks(cities, algorithms, rounds, time_allowance, seed=0,
+                   difficulty='Hard (Deterministic)'):
+    rows = []
+    for ncities in cities:
+        scenarios = [make_scenario(ncities, seed + r, difficulty) for r in range(rounds)]
+        for alg in algorithms:
+            runs = []
+            for scenario in scenarios:
+                solver = TSPSolver(None)
+                solver.setupWithScenario(scenario)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    runs.append(getattr(solver, alg)(time_allowance=time_allowance))
+            rows.append(summarize(ncities, alg, difficulty, runs))
+    return rows
+
+
+def make_scenario(ncities, seed, difficulty):
+    return Scenario(city_locations=generate_points(ncities, seed), difficulty=difficulty,
+                    rand_seed=seed)
+
+
+# summarize :: Nat -> String -> String -> [Results] -> Row
+def summarize(ncities, alg, difficulty, runs):
+    solved = [r for r in runs if r['soln'] is not None and r['cost'] < math.inf]
+    row = {'cities': ncities, 'algorithm': alg, 'difficulty': difficulty,
+           'rounds': len(runs), 'solved': len(solved)}
+    for m in MEASURES:
+        over = solved if m == 'cost' else runs
+        values = [r[m] for r in over if r.get(m) is not None]
+        if values:
+            row[m + '_mean'] = statistics.mean(values)
+            row[m + '_stddev'] = statistics.pstdev(values)
+        else:
+            row[m + '_mean'] = None
+            row[m + '_stddev'] = None
+    return row
+
+
+def write_rows(rows, f, out_format):
+    if out_format == 'json':
+        json.dump(rows, f, indent=2)
+        f.write('\n')
+    else:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_run_benchmarks():
+    rows = run_benchmarks([8], ['greedy', 'heldKarp'], 2, 5.0)
+    assert [(r['cities'], r['algorithm'], r['rounds']) for r in rows] == \
+           [(8, 'greedy', 2), (8, 'heldKarp', 2)]
+    (greedy, exact) = rows
+    assert exact['solved'] == 2
+    if greedy['solved'] == 2:
+        assert exact['cost_mean'] <= greedy['cost_mean']
+
+    # The same seeds give the same scenarios, so the same exact costs
+    again = run_benchmarks([8], ['heldKarp'], 2, 5.0)
+    assert again[0]['cost_mean'] == exact['cost_mean']
+    assert again[0]['cost_stddev'] == exact['cost_stddev']
+
+    out = io.StringIO()
+    write_rows(rows, out, 'csv')
+    assert out.getvalue().splitlines()[0] == ','.join(COLUMNS)
+    assert len(out.getvalue().splitlines()) == 3
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+import math
+import numpy as np
+
+
+############################################################
+#
+#       Candidate graphs for scenarios too big for a matrix
+#
+############################################################
+
+# Type Definitions
+# ---------
+# Coordinates :: n x 2 array of city locations
+# CostMatrix :: anything indexable as costs[src, dst], with arrays of
+#               indices as well as single ones
+
+
+# GridIndex :: a uniform grid over city locations
+#
+# Cities are bucketed by cell, about PER_CELL to a cell, and stored sorted
+# by cell so that each column of cells is one contiguous run.  Any city
+# within r cell widths of a city in cell (cx, cy) lies in the block of cells
+# cx-r..cx+r by cy-r..cy+r, which is what the nearest-neighbour search
+# widens through.  PER_CELL is enough for the nearest ten or so to be in
+# the first block of nine cells most of the time.
+class GridIndex:
+    PER_CELL = 8.0
+    # Cells with more than SPLIT times PER_CELL cities in them (clustered
+    # input) get a finer grid of their own in knn
+    SPLIT = 16
+    # Most distances knn works out at once
+    CHUNK = 1 << 20
+
+    def __init__(self, xy):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        n = len(self.xy)
+
+        lo = self.xy.min(axis=0) if n else np.zeros(2)
+        extent = (self.xy.max(axis=0) - lo) if n else np.zeros(2)
+        extent = np.maximum(extent, 1e-9)
+        self.cell = math.sqrt(extent[0] * extent[1] * self.PER_CELL / max(n, 1))
+        self.shape = tuple(np.maximum(np.ceil(extent / self.cell), 1).astype(int))
+
+        cells = np.minimum(((self.xy - lo) / self.cell).astype(np.int64), np.array(self.shape) - 1)
+        self.cx = cells[:, 0]
+        self.cy = cells[:, 1]
+        cell_id = self.cx * self.shape[1] + self.cy
+        self.order = np.argsort(cell_id, kind='stable')
+        self.start = np.searchsorted(cell_id[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    # The cities in the block of cells x0..x1 by y0..y1 (inclusive, clipped
+    # to the grid)
+    def block(self, x0, x1, y0, y1):
+        (nx, ny) = self.shape
+        (x0, x1, y0, y1) = (max(x0, 0), min(x1, nx - 1), max(y0, 0), min(y1, ny - 1))
+        runs = [self.order[self.start[cx * ny + y0]:self.start[cx * ny + y1 + 1]]
+                for cx in range(x0, x1 + 1)]
+        return np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+
+    # knn :: Nat -> n x k array
+    #
+    # Each city's k nearest other cities by straight-line distance, nearest
+    # first.  Works a cell at a time, widening the block around the cell
+    # until it holds k other cities for everyone in it and the k-th of them
+    # is no further away than the block is guaranteed to reach.
+    def knn(self, k):
+        return self._knn(k, None)
+
+    # _knn :: Nat -> Optional([Bool]) -> n x k array
+    #
+    # knn, filling in only the rows of the `wanted' cities (all of them
+    # when it's None)
+    def _knn(self, k, wanted):
+        n = len(self.xy)
+        k = max(0, min(k, n - 1))
+        result = np.zeros((n, k), dtype=np.int64)
+        if k == 0:
+            return result
+
+        (nx, ny) = self.shape
+        for c in np.flatnonzero(np.diff(self.start)):
+            members = self.order[self.start[c]:self.start[c + 1]]
+            if wanted is not None:
+                members = members[wanted[members]]
+                if len(members) == 0:
+                    continue
+            (cx, cy) = divmod(int(c), ny)
+            r = 1
+            while True:
+                block = self.block(cx - r, cx + r, cy - r, cy + r)
+                whole = cx - r <= 0 and cy - r <= 0 and cx + r >= nx - 1 and cy + r >= ny - 1
+                if len(block) > k:
+                    (near, near_d) = self._block_knn(members, block, k)
+                    if whole or near_d.max() <= r * self.cell:
+                        by_d = np.argsort(near_d, axis=1, kind='stable')
+                        result[members] = np.take_along_axis(near, by_d, axis=1)
+                        break
+                r += 1
+        return result
+
+    # _block_knn :: [Nat] -> [Nat] -> Nat -> (m x k array, m x k array)
+    #
+    # The k nearest cities in `block' to each of the m `members' (which are
+    # in it, and aren't their own neighbours), in no particular order, and
+    # their distances.  A crowded cell's block gets a GridIndex of its own,
+    # so a cluster costs about what it would spread out; otherwise members
+    # are compared with the whole block a chunk at a time, so memory stays
+    # bounded however many cities share a cell.
+    def _block_knn(self, members, block, k):
+        if len(members) > self.SPLIT * self.PER_CELL and len(block) < len(self.xy):
+            sorter = np.argsort(block, kind='stable')
+            pos = sorter[np.searchsorted(block, members, sorter=sorter)]
+            within = np.zeros(len(block), dtype=bool)
+            within[pos] = True
+            near = block[GridIndex(self.xy[block])._knn(k, within)[pos]]
+            near_d = np.hypot(self.xy[near, 0] - self.xy[members, 0][:, None],
+                              self.xy[near, 1] - self.xy[members, 1][:, None])
+            return (near, near_d)
+
+        chunks = []
+        rows = max(1, self.CHUNK // len(block))
+        for i in range(0, len(members), rows):
+            chunk = members[i:i + rows]
+            d = np.hypot(self.xy[chunk, 0][:, None] - self.xy[block, 0][None, :],
+                         self.xy[chunk, 1][:, None] - self.xy[block, 1][None, :])
+            d[chunk[:, None] == block[None, :]] = np.inf
+            near = np.argpartition(d, k - 1, axis=1)[:, :k]
+            chunks.append((block[near], np.take_along_axis(d, near, axis=1)))
+        if len(chunks) == 1:
+            return chunks[0]
+        return (np.concatenate([near for (near, _) in chunks]),
+                np.concatenate([near_d for (_, near_d) in chunks]))
+
+    # How many cities are in each cell, as an nx x ny array.  A search that
+    # uses up cities keeps its own copy of this for nearest().
+    def cell_counts(self):
+        return np.diff(self.start).reshape(self.shape)
+
+    # nearest :: Nat -> [Bool] -> CellCounts -> [Nat]
+    #
+    # The cities not yet `taken' in the smallest block around city c's cell
+    # that is sure to hold the nearest of them, so the nearest is among the
+    # cities returned.  `counts' has the number not taken in each cell.
+    # Empty when every city is taken.
+    def nearest(self, c, taken, counts):
+        (cx, cy) = (self.cx[c], self.cy[c])
+        r = 1
+        while counts[max(cx - r, 0):cx + r + 1, max(cy - r, 0):cy + r + 1].sum() == 0:
+            if r > max(self.shape):
+                return np.zeros(0, dtype=np.int64)
+            r *= 2
+
+        block = self.block(cx - r, cx + r, cy - r, cy + r)
+        block = block[~taken[block]]
+        reach = np.hypot(self.xy[block, 0] - self.xy[c, 0], self.xy[block, 1] - self.xy[c, 1]).min()
+        wider = int(math.ceil(reach / self.cell))
+        if wider > r:
+            block = self.block(cx - wider, cx + wider, cy - wider, cy + wider)
+            block = block[~taken[block]]
+        return block
+
+
+# CandidateGraph :: each city's candidate edges, in CSR form
+#
+# Row i holds the cities indices[indptr[i]:indptr[i+1]] with the costs of
+# the edges from i to them, cheapest first.  These are the only edges the
+# greedy and local searches try to add, so they stand in for the full cost
+# matrix's sorted rows.
+class CandidateGraph:
+    def __init__(self, indptr, indices, costs, grid=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+        # The GridIndex the candidates came from, if there is one
+        self.grid = grid
+        self._neighbors = None
+        self._in_neighbors = None
+
+    # build :: Coordinates -> CostMatrix -> Nat -> CandidateGraph
+    #
+    # Candidates are the k nearest cities on the map, which need not be the
+    # k cheapest to go to once elevation counts, so each row is sorted by
+    # actual cost.
+    @staticmethod
+    def build(xy, costs, k):
+        grid = GridIndex(xy)
+        near = grid.knn(k)
+        (n, k) = near.shape
+        rows = np.repeat(np.arange(n), k)
+        indices = near.ravel()
+        edge_costs = costs[rows, indices]
+
+        by_cost = np.lexsort((edge_costs, rows))
+        return CandidateGraph(np.arange(n + 1) * k, indices[by_cost], edge_costs[by_cost], grid)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    # Rows as lists, the way LocalSearch walks them
+    def neighbors(self):
+        if self._neighbors is None:
+            self._neighbors = [self.indices[a:b].tolist()
+                               for (a, b) in zip(self.indptr[:-1], self.indptr[1:])]
+        return self._neighbors
+
+    # The same candidates the other way round: for each city, the cities in
+    # its row sorted by the cost of coming from them
+    def in_neighbors(self, costs):
+        if self._in_neighbors is None:
+            counts = np.diff(self.indptr)
+            rows = np.repeat(np.arange(len(self)), counts)
+            in_costs = costs[self.indices, rows]
+            by_cost = np.lexsort((in_costs, rows))
+            indices = self.indices[by_cost]
+            self._in_neighbors = [indices[a:b].tolist()
+                                  for (a, b) in zip(self.indptr[:-1], self.indptr[1:])]
+        return self._in_neighbors
+
+
+def test_knn_matches_brute_force():
+    rand = np.random.RandomState(4)
+    for (n, k) in [(1, 3), (5, 10), (200, 6), (1000, 10)]:
+        xy = rand.uniform(-1.0, 1.0, size=(n, 2))
+        # A tight clump as well, so cells differ a lot in how full they are
+        xy[:n // 4] *= 0.01
+
+        near = GridIndex(xy).knn(k)
+        d = np.hypot(xy[:, 0][:, None] - xy[:, 0][None, :], xy[:, 1][:, None] - xy[:, 1][None, :])
+        np.fill_diagonal(d, np.inf)
+        k = min(k, n - 1)
+        assert near.shape == (n, k)
+        expected = np.sort(d, axis=1)[:, :k]
+        assert np.allclose(np.take_along_axis(d, near, axis=1), expected)
+
+    # Big enough that comparing the clump's cells with each other all at
+    # once would take gigabytes; checked against a scan for some of the cities
+    import tracemalloc
+    xy = rand.uniform(-1.0, 1.0, size=(40000, 2))
+    xy[:10000] *= 0.01
+    tracemalloc.start()
+    try:
+        near = GridIndex(xy).knn(10)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 200 * 2 ** 20
+    rows = np.concatenate([rand.choice(10000, 100, replace=False), rand.choice(40000, 100, replace=False)])
+    d = np.hypot(xy[rows, 0][:, None] - xy[:, 0][None, :], xy[rows, 1][:, None] - xy[:, 1][None, :])
+    d[np.arange(len(rows)), rows] = np.inf
+    assert np.allclose(np.take_along_axis(d, near[rows], axis=1), np.sort(d, axis=1)[:, :10])
+
+
+def test_nearest_untaken():
+    rand = np.random.RandomState(3)
+    xy = rand.uniform(-1.0, 1.0, size=(2000, 2))
+    grid = GridIndex(xy)
+    counts = grid.cell_counts()
+    taken = np.zeros(len(xy), dtype=bool)
+
+    # Take most of the cities, a few at a time, checking against a scan
+    for c in rand.permutation(len(xy))[:1990]:
+        pool = grid.nearest(c, taken, counts)
+        left = np.flatnonzero(~taken)
+        d = np.hypot(xy[left, 0] - xy[c, 0], xy[left, 1] - xy[c, 1])
+        assert left[np.argmin(d)] in pool
+        assert not taken[pool].any()
+        taken[c] = True
+        counts[grid.cx[c], grid.cy[c]] -= 1
+
+    taken[:] = True
+    assert len(grid.nearest(0, taken, np.zeros_like(counts))) == 0
+
+
+def test_candidate_graph():
+    rand = np.random.RandomState(2)
+    xy = rand.uniform(-1.0, 1.0, size=(300, 2))
+    costs = rand.uniform(1, 100, size=(300, 300))
+
+    graph = CandidateGraph.build(xy, costs, 8)
+    near = GridIndex(xy).knn(8)
+    for (i, row) in enumerate(graph.neighbors()):
+        assert sorted(row) == sorted(near[i].tolist())
+        assert costs[i, row].tolist() == sorted(costs[i, row].tolist())
+    for (i, row) in enumerate(graph.in_neighbors(costs)):
+        assert sorted(row) == sorted(near[i].tolist())
+        assert costs[row, i].tolist() == sorted(costs[row, i].tolist())
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import itertools
+import math
+import time
+import numpy as np
+
+
+############################################################
+#
+#           Held-Karp dynamic programming (exact)
+#
+############################################################
+
+# Type Definitions
+# ---------
+# CostMatrix :: n x n array, costs[a, b] = cost of the edge a -> b
+# Subset :: Nat, bit j set when city j + 1 has been visited
+#
+# Tours start and end at city 0, so subsets only cover cities 1..n-1.
+# best[S, j] is the cheapest path that leaves city 0, visits exactly the
+# cities in S and ends at city j + 1; parent[S, j] is the city (again less
+# one) visited just before that.  Subsets are filled in by number of
+# cities, so every subset's predecessors are done before it is.
+
+# Default cap on what the tables may take; 22 cities fit, 23 don't
+HELD_KARP_MAX_BYTES = 1 << 30
+
+
+# held_karp_bytes :: Nat -> Nat
+#
+# Roughly how much memory held_karp needs for `ncities' cities: the cost
+# and parent tables, the subset bookkeeping and the scratch space for the
+# largest layer of subsets.
+def held_karp_bytes(ncities):
+    m = max(ncities - 1, 0)
+    size = 1 << m
+    layer = math.comb(m, m // 2)
+    return size * m * (8 + 1) + size * 8 * 3 + layer * m * 8 * 3
+
+
+# held_karp :: CostMatrix -> Optional(Instrument) -> Optional(Time)
+#              -> Optional(Nat) -> Optional(([Nat], Real))
+#
+# The cheapest tour, starting from city 0, or None when there isn't one
+# (or the deadline passes, or the instrumenter is stopped, first).  Raises
+# MemoryError before allocating anything when the tables would need more
+# than `max_bytes'.
+def held_karp(costs, instrumenter=None, deadline=None, max_bytes=None):
+    costs = np.asarray(costs, dtype=float)
+    ncities = len(costs)
+    if max_bytes is not None and held_karp_bytes(ncities) > max_bytes:
+        raise MemoryError("Held-Karp needs about {} bytes for {} cities, more than the {} allowed"
+                          .format(held_karp_bytes(ncities), ncities, max_bytes))
+    if ncities < 2:
+        return None
+
+    m = ncities - 1
+    size = 1 << m
+    inner = costs[1:, 1:]
+
+    best = np.full((size, m), np.inf)
+    parent = np.zeros((size, m), dtype=np.int8)
+    best[1 << np.arange(m), np.arange(m)] = costs[0, 1:]
+
+    # Group the subsets into layers by how many cities they hold
+    subsets = np.arange(size)
+    popcount = np.zeros(size, dtype=np.int64)
+    for j in range(m):
+        popcount += (subsets >> j) & 1
+    by_count = np.argsort(popcount, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(popcount, minlength=m + 1))))
+    del subsets, popcount
+
+    for count in range(2, m + 1):
+        if deadline is not None and time.time() > deadline:
+            return None
+        if instrumenter is not None and instrumenter.stopped():
+            return None
+        layer = by_count[bounds[count]:bounds[count + 1]]
+        for j in range(m):
+            ending = layer[(layer >> j) & 1 == 1]
+            # Coming from k means best[S - {j}, k] + costs[k, j]; every k
+            # not in S - {j} is still inf there
+            via = best[ending ^ (1 << j)] + inner[:, j]
+            prev = via.argmin(axis=1)
+            best[ending, j] = via[np.arange(len(ending)), prev]
+            parent[ending, j] = prev
+            if instrumenter is not None:
+                instrumenter.inc_states_created(len(ending))
+
+    everything = size - 1
+    closed = best[everything] + costs[1:, 0]
+    last = int(closed.argmin())
+    tour_cost = closed[last]
+    if tour_cost == np.inf:
+        return None
+
+    path = []
+    subset = everything
+    while subset:
+        path.append(last + 1)
+        (subset, last) = (subset ^ (1 << last), int(parent[subset, last]))
+    path.append(0)
+    path.reverse()
+
+    if instrumenter is not None:
+        instrumenter.inc_solutions_found()
+        instrumenter.report_solution(tour_cost, path)
+    return (path, tour_cost)
+
+
+def brute_force(costs):
+    costs = np.asarray(costs)
+    ncities = len(costs)
+    best = (None, np.inf)
+    for perm in itertools.permutations(range(1, ncities)):
+        path = [0] + list(perm)
+        cost = costs[path, path[1:] + [0]].sum()
+        if cost < best[1]:
+            best = (path, cost)
+    return best
+
+
+def test_held_karp_matches_brute_force():
+    rand = np.random.RandomState(6)
+    for ncities in range(2, 9):
+        costs = np.ceil(rand.uniform(1, 100, size=(ncities, ncities)))
+        costs[rand.uniform(size=(ncities, ncities)) < 0.3] = np.inf
+        np.fill_diagonal(costs, np.inf)
+
+        expected = brute_force(costs)
+        result = held_karp(costs)
+        if expected[1] == np.inf:
+            assert result is None
+        else:
+            (path, cost) = result
+            assert cost == expected[1]
+            assert sorted(path) == list(range(ncities))
+            assert costs[path, path[1:] + [0]].sum() == cost
+
+
+def test_held_karp_memory_check():
+    costs = np.ones((30, 30))
+    try:
+        held_karp(costs, max_bytes=HELD_KARP_MAX_BYTES)
+        assert False
+    except MemoryError:
+        pass
+    assert held_karp_bytes(22) <= HELD_KARP_MAX_BYTES < held_karp_bytes(23)
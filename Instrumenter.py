@@ -1,9 +1,54 @@
+import contextlib
+import json
+import math
+import time
+
+
 class Instrumenter:
-    def __init__(self):
+    # Seconds between points of the time series
+    SAMPLE_INTERVAL = 0.05
+    # Seconds between tours passed on to on_solution
+    REPORT_INTERVAL = 0.1
+
+    def __init__(self, on_solution=None, stop_event=None, sample_interval=SAMPLE_INTERVAL,
+                 report_interval=REPORT_INTERVAL):
         self.max_queue = 0
         self.states_created = 0
         self.states_pruned = 0
         self.solutions_found = 0
+        self.states_dropped = 0
+        self.states_spilled = 0
+        # Local search moves looked at, improving or not
+        self.moves_tried = 0
+
+        # Wall time spent in each phase of the search, by name (see phase)
+        self.phase_times = {}
+        # (time, queue size, bssf cost, lower bound) every sample_interval
+        # seconds or so while the search runs (see sample)
+        self.samples = []
+        self.sample_interval = sample_interval
+
+        # Called with new best tours the search reports, at most one every
+        # report_interval seconds (see report_solution)
+        self.on_solution = on_solution
+        self.report_interval = report_interval
+        self.start_time = time.time()
+
+        # Set (by another thread) to ask the search to stop early
+        self.stop_event = stop_event
+        self._next_sample = self.start_time
+        self._next_report = self.start_time
+        # (cost, tour, time) of the best tour reported but not yet passed on
+        self._pending = None
+
+    # The hooks belong to the process that set them, so only the counters
+    # travel when an Instrumenter is sent back from a worker
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['on_solution'] = None
+        state['stop_event'] = None
+        state['_pending'] = None
+        return state
 
     def update_queue(self, new_size):
         self.max_queue = max(self.max_queue, new_size)
@@ -16,3 +61,162 @@ class Instrumenter:
 
     def inc_solutions_found(self, more=1):
         self.solutions_found += more
+
+    def inc_states_dropped(self, more=1):
+        self.states_dropped += more
+
+    def inc_states_spilled(self, more=1):
+        self.states_spilled += more
+
+    def inc_moves_tried(self, more=1):
+        self.moves_tried += more
+
+    # Times the body of a with statement as part of the named phase:
+    #   with inst.phase('greedy'): ...
+    # Entering the same phase again adds to its time.
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + time.time() - start
+
+    # Adds a point to the time series, unless the last one was less than
+    # sample_interval ago, so it's cheap enough to call on every step of a
+    # search.  Values a search doesn't have are left as None.
+    def sample(self, queue=None, bssf=None, lower_bound=None):
+        now = time.time()
+        if now >= self._next_sample:
+            self._next_sample = now + self.sample_interval
+            self.samples.append((now, queue, bssf, lower_bound))
+
+    # Counts per second since this Instrumenter was made.  Searches count in
+    # batches (a whole expansion or pass at a time), so rates taken in the
+    # middle of one lag a little.
+    def rates(self):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return {'states_per_s': self.states_created / elapsed,
+                'moves_per_s': self.moves_tried / elapsed}
+
+    # Searches check this wherever they check the time, and wind up the same
+    # way as when time runs out
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    # The counters so far, under the same names as in a results dictionary
+    def snapshot(self):
+        return {'max': self.max_queue,
+                'total': self.states_created,
+                'pruned': self.states_pruned,
+                'count': self.solutions_found,
+                'dropped': self.states_dropped,
+                'spilled': self.states_spilled,
+                'moves': self.moves_tried}
+
+    # Pass a new best tour (city indices) on to on_solution, if there is
+    # one, with the time it was found and a snapshot of the counters.  A
+    # tour reported less than report_interval after the last one sent is
+    # held back until the next report or flush, which sends only the best.
+    # The tour is copied when it's sent, not before, so a search that
+    # changes its tour in place must report every change (or flush) before
+    # the tour stops being its best.
+    def report_solution(self, cost, tour):
+        if self.on_solution is None:
+            return
+        now = time.time()
+        self._pending = (cost, tour, now)
+        if now >= self._next_report:
+            self.flush()
+
+    # Sends the tour held back by report_solution, if any.  Searches flush
+    # when they finish so the last best tour always goes out.
+    def flush(self):
+        if self._pending is None:
+            return
+        (cost, tour, found) = self._pending
+        self._pending = None
+        self._next_report = time.time() + self.report_interval
+        self.on_solution({'cost': cost,
+                          'tour': [int(c) for c in tour],
+                          'time': found - self.start_time,
+                          'stats': self.snapshot()})
+
+    # Fold in the counters and time series from another Instrumenter (e.g.
+    # a worker process's).  The queues existed side by side, so their maxima
+    # add.  Phases aren't merged: the other's ran inside one of this one's.
+    def merge(self, other):
+        self.max_queue += other.max_queue
+        self.states_created += other.states_created
+        self.states_pruned += other.states_pruned
+        self.solutions_found += other.solutions_found
+        self.states_dropped += other.states_dropped
+        self.states_spilled += other.states_spilled
+        self.moves_tried += other.moves_tried
+        if other.samples:
+            self.samples = sorted(self.samples + other.samples, key=lambda s: s[0])
+
+    # Everything recorded so far, as plain numbers for JSON.  Sample times
+    # are seconds since this Instrumenter was made; infinite costs (no bssf
+    # yet) are None.
+    def to_dict(self):
+        def number(v):
+            return None if v is None or v == math.inf else float(v)
+        return {'elapsed': time.time() - self.start_time,
+                'counters': self.snapshot(),
+                'phases': dict(self.phase_times),
+                'rates': self.rates(),
+                'samples': [{'time': t - self.start_time,
+                             'queue': None if q is None else int(q),
+                             'bssf': number(b),
+                             'lower_bound': number(lb)}
+                            for (t, q, b, lb) in self.samples]}
+
+    # to_json :: Optional(File) -> String
+    #
+    # to_dict as JSON, also written to `f' if it's given
+    def to_json(self, f=None):
+        text = json.dumps(self.to_dict(), indent=2)
+        if f is not None:
+            f.write(text)
+        return text
+
+
+def test_instrumenter():
+    inst = Instrumenter(sample_interval=0.02)
+    with inst.phase('greedy'):
+        time.sleep(0.01)
+    with inst.phase('greedy'):
+        pass
+    assert 0.01 <= inst.phase_times['greedy'] < 1
+
+    # Samples are throttled to one per interval
+    deadline = time.time() + 0.1
+    while time.time() < deadline:
+        inst.sample(queue=3, bssf=math.inf, lower_bound=10)
+    assert 2 <= len(inst.samples) <= 7
+
+    worker = Instrumenter()
+    worker.inc_states_created(5)
+    worker.inc_moves_tried(7)
+    worker.sample(bssf=20)
+    inst.inc_states_created(2)
+    inst.merge(worker)
+    assert inst.states_created == 7 and inst.moves_tried == 7
+    assert [s[0] for s in inst.samples] == sorted(s[0] for s in inst.samples)
+
+    exported = json.loads(inst.to_json())
+    assert exported['counters']['total'] == 7
+    assert exported['samples'][0]['bssf'] is None
+    assert 20.0 in [s['bssf'] for s in exported['samples']]
+    assert exported['rates']['moves_per_s'] > 0
+
+    # Reports are throttled too, and the best one held back goes out on flush
+    sent = []
+    inst = Instrumenter(sent.append, report_interval=60)
+    for cost in [30, 20, 10]:
+        inst.report_solution(cost, [0, 1, 2])
+    assert [u['cost'] for u in sent] == [30]
+    inst.flush()
+    inst.flush()
+    assert [u['cost'] for u in sent] == [30, 10]
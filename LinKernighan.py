@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+import functools
+import random
+import time
+import numpy as np
+from LocalSearch import LocalSearch, Tour, neighbor_lists, tour_cost, random_costs
+
+
+############################################################
+#
+#        Lin-Kernighan style variable-depth search
+#
+############################################################
+
+# Type Definitions
+# ---------
+# CostMatrix :: n x n array, costs[a, b] = cost of the edge a -> b
+# Edge :: (Nat, Nat), directed
+
+
+# LinKernighan :: iterated LK-style k-opt search over a cost matrix
+#
+# On top of the 2-opt and Or-opt moves of LocalSearch, each active city
+# starts a chain of steps.  Every step breaks the closing edge (x, y) of the
+# previous one, adds an edge from x to one of its neighbours and closes the
+# tour again, either as a 2-opt (turning a stretch around) or by swapping
+# two stretches, which adds a second edge into y from one of its
+# in-neighbours and keeps every direction as it was.  Costs are asymmetric,
+# so the reversal cost of a turned stretch counts towards the gain, and the
+# swap is what makes most of the headway.
+#
+# The chain is followed while the gain of the open path stays positive;
+# edges it added are never broken again and vice versa, and the first
+# prefix of the chain that shortens the tour is kept.  BREADTH alternatives
+# are tried at each of the first levels and one thereafter, down to
+# MAX_DEPTH steps.
+#
+# Once no chain improves the tour it is kicked with a double bridge between
+# nearby positions, which doesn't reverse anything, and the search restarts
+# from the cities around the kick.  Kicks that don't pay off are undone.
+class LinKernighan(LocalSearch):
+    MAX_DEPTH = 10
+    BREADTH = (3,)
+    KICK_SPAN = 50
+
+    # in_neighbors, like neighbors, defaults to the k cheapest from the
+    # cost matrix: the cities each city is cheapest to come from
+    def __init__(self, costs, neighbors=None, k=8, seed=None, in_neighbors=None):
+        LocalSearch.__init__(self, costs, neighbors, k)
+        if in_neighbors is None:
+            in_neighbors = neighbor_lists(np.transpose(costs), k).tolist()
+        self._in_neighbors = in_neighbors
+        self._rand = random.Random(seed)
+
+    # run :: [Nat] -> Time -> Optional(Instrument) -> ([Nat], Real)
+    def run(self, order, time_allowance, instrumenter=None):
+        tour = Tour(order, self._costs)
+        if tour.n < 8 or tour.cost == np.inf:
+            return LocalSearch.run(self, order, time_allowance, instrumenter)
+
+        deadline = time.time() + time_allowance
+        before = self.moves_tried
+        while self.optimize(tour, tour.order.tolist(), deadline, instrumenter):
+            pass
+
+        best_order = tour.order.copy()
+        best_cost = tour.cost
+        while time.time() < deadline and not (instrumenter is not None and instrumenter.stopped()):
+            touched = self.kick(tour)
+            if tour.cost < np.inf:
+                self.optimize(tour, touched, deadline)
+            if tour.cost < best_cost:
+                best_order = tour.order.copy()
+                best_cost = tour.cost
+                if instrumenter is not None:
+                    instrumenter.inc_solutions_found()
+                    instrumenter.report_solution(best_cost, best_order)
+            elif not tour.cost <= best_cost:
+                tour.order = best_order.copy()
+                tour.refresh()
+            if instrumenter is not None:
+                instrumenter.sample(bssf=best_cost)
+
+        if instrumenter is not None:
+            instrumenter.inc_moves_tried(self.moves_tried - before)
+        return (best_order.tolist(), best_cost)
+
+    def improve(self, tour, a):
+        touched = LocalSearch.improve(self, tour, a)
+        if touched is None:
+            touched = self.improve_lk(tour, a)
+        return touched
+
+    # improve_lk :: Tour -> Nat -> Optional([Nat])
+    #
+    # Looks for an improving chain that starts by breaking the edge leaving
+    # `a'; applies it and returns the cities whose edges changed.
+    def improve_lk(self, tour, a):
+        b = tour.at(tour.pos[a] + 1)
+        touched = [a, b]
+        if self._lk_step(tour, a, b, self._costs[a, b], 0,
+                         frozenset([(a, b)]), frozenset(), tour.cost, touched):
+            return touched
+        return None
+
+    # _lk_step :: Tour -> Nat -> Nat -> Real -> Nat -> {Edge} -> {Edge}
+    #             -> Real -> [Nat] -> Bool
+    #
+    # One step of the chain from the closing edge (x, y) with open gain
+    # `gain'.  Leaves the tour changed and returns True once some prefix of
+    # the chain beats `base'; otherwise leaves the tour as it found it.
+    # The tour's cost is always `base' less `gain' plus the closing edge.
+    def _lk_step(self, tour, x, y, gain, depth, removed, added, base, touched):
+        candidates = self._two_opt_steps(tour, x, y, gain, removed, added) + \
+                     self._swap_steps(tour, x, y, gain, removed, added)
+        candidates.sort(key=lambda step: step[0], reverse=True)
+
+        breadth = self.BREADTH[depth] if depth < len(self.BREADTH) else 1
+        for (g, apply, undo, new_x, new_y, new_removed, new_added) in candidates[:breadth]:
+            # The tour cost once the step closes is known without making it
+            closed = base - g + self._costs[new_x, new_y]
+            if closed == np.inf:
+                continue
+            if closed < base:
+                apply()
+                touched.extend(c for edge in new_removed for c in edge)
+                return True
+            if depth + 1 == self.MAX_DEPTH:
+                continue
+
+            apply()
+            if self._lk_step(tour, new_x, new_y, g, depth + 1, removed | new_removed,
+                             added | new_added, base, touched):
+                touched.extend(c for edge in new_removed for c in edge)
+                return True
+            undo()
+
+        return False
+
+    # _two_opt_steps :: Tour -> Nat -> Nat -> Real -> {Edge} -> {Edge} -> [Step]
+    #
+    # Add (x, e), break (e, f) and close with (y, f), turning y..e around.
+    def _two_opt_steps(self, tour, x, y, gain, removed, added):
+        costs = self._costs
+        i = tour.pos[x]
+
+        steps = []
+        for e in self._neighbors[x]:
+            added_cost = costs[x, e]
+            if added_cost >= gain:
+                break
+            if e == y:
+                continue
+            j = tour.pos[e]
+            f = tour.at(j + 1)
+            if f == x or (x, e) in removed or (e, f) in added:
+                continue
+            g = gain - added_cost + costs[e, f] - tour.reversal_delta(i, j)
+            if g > 0:
+                steps.append((g, functools.partial(self._flip, tour, x, e),
+                              functools.partial(self._flip, tour, x, y),
+                              y, f, {(e, f)}, {(x, e)}))
+        return steps
+
+    # _swap_steps :: Tour -> Nat -> Nat -> Real -> {Edge} -> {Edge} -> [Step]
+    #
+    # Add (x, e) and break (p, e), add (q, y) and break (q, r), and close
+    # with (p, r): the stretches y..p and e..q trade places without either
+    # being turned around, so only these six edges change.
+    def _swap_steps(self, tour, x, y, gain, removed, added):
+        costs = self._costs
+        n = tour.n
+        i = tour.pos[x]
+
+        steps = []
+        for e in self._neighbors[x]:
+            g1 = gain - costs[x, e]
+            if g1 <= 0:
+                break
+            first = (tour.pos[e] - i) % n - 1
+            if first < 1 or (x, e) in removed:
+                continue
+            p = tour.at(i + first)
+            if (p, e) in added:
+                continue
+            g1 += costs[p, e]
+
+            for q in self._in_neighbors[y]:
+                g2 = g1 - costs[q, y]
+                if g2 <= 0:
+                    break
+                second = (tour.pos[q] - i) % n - first
+                if second < 1 or (q, y) in removed:
+                    continue
+                r = tour.at(i + first + second + 1)
+                if (q, r) in added:
+                    continue
+                steps.append((g2 + costs[q, r],
+                              functools.partial(self._swap, tour, x, first, second),
+                              functools.partial(self._swap, tour, x, second, first),
+                              p, r, {(p, e), (q, r)}, {(x, e), (q, y)}))
+        return steps
+
+    # Swaps can rotate the whole order, so steps are made and undone by
+    # city rather than by position.  Turning x..c's stretch around again, or
+    # swapping back the two stretches after x, undoes a step.
+    def _flip(self, tour, x, c):
+        tour.apply_two_opt(tour.pos[x], tour.pos[c])
+
+    def _swap(self, tour, x, first, second):
+        tour.apply_swap(tour.pos[x], first, second)
+
+    # kick :: Tour -> [Nat]
+    #
+    # Double bridge: swaps two adjacent stretches, both within KICK_SPAN
+    # positions of a random point.  Returns the cities next to the cuts.
+    def kick(self, tour):
+        n = tour.n
+        span = min(self.KICK_SPAN, n - 1)
+        start = self._rand.randrange(n)
+        (p1, p2, p3) = sorted(self._rand.sample(range(1, span + 1), 3))
+
+        touched = [tour.at(start + p - 1) for p in (p1, p2, p3)] + \
+                  [tour.at(start + p) for p in (0, p1, p2, p3)]
+        tour.apply_swap((start + p1 - 1) % n, p2 - p1, p3 - p2)
+        return [int(c) for c in touched]
+
+
+def test_lk_chain_improves_local_optimum():
+    rand = np.random.RandomState(5)
+    costs = random_costs(rand, 150)
+    order = rand.permutation(150).tolist()
+
+    (local, local_cost) = LocalSearch(costs, k=8).run(order, 60)
+    search = LinKernighan(costs, k=8, seed=1)
+    tour = Tour(local, costs)
+    search.optimize(tour, list(range(150)), time.time() + 60)
+
+    assert sorted(tour.order) == list(range(150))
+    assert tour.cost == tour_cost(costs, tour.order)
+    assert tour.cost < local_cost
+
+
+def test_lin_kernighan_run():
+    rand = np.random.RandomState(8)
+    costs = random_costs(rand, 100)
+    order = rand.permutation(100).tolist()
+
+    # Drop some edges, but not the ones the starting tour uses
+    keep = costs[order, np.roll(order, -1)]
+    costs[rand.randint(100, size=500), rand.randint(100, size=500)] = np.inf
+    costs[order, np.roll(order, -1)] = keep
+
+    (best, best_cost) = LinKernighan(costs, seed=2).run(order, 1.0)
+    assert sorted(best) == list(range(100))
+    assert best_cost == tour_cost(costs, best)
+    assert best_cost < LocalSearch(costs).run(order, 60)[1]
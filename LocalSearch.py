@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+
+import collections
+import time
+import numpy as np
+
+
+############################################################
+#
+#             Local search: 2-opt and Or-opt
+#
+############################################################
+
+# Type Definitions
+# ---------
+# CostMatrix :: n x n array, costs[a, b] = cost of the edge a -> b
+# Neighbors :: n x k array of city indices, each row sorted by cost
+
+
+# neighbor_lists :: CostMatrix -> Nat -> Neighbors
+#
+# The k cheapest cities to go to from each city.  Local search only
+# considers moves that add one of these edges.
+def neighbor_lists(costs, k):
+    ncities = len(costs)
+    k = max(1, min(k, ncities - 1))
+    near = np.argpartition(costs, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(costs, near, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(near, order, axis=1)
+
+
+# range_sum :: [Real] -> Nat -> Nat -> Real
+#
+# Sum of `count' consecutive tour edges starting at position `start',
+# wrapping around the end, given the prefix sums of the edges.
+def range_sum(prefix, start, count):
+    n = len(prefix) - 1
+    if start + count <= n:
+        return prefix[start + count] - prefix[start]
+    return prefix[n] - prefix[start] + prefix[start + count - n]
+
+
+# Tour :: a tour held as an array of city indices
+#
+# Alongside the order it keeps each city's position and prefix sums of the
+# edge costs in both directions, so that reversing any stretch of the tour
+# can be costed in O(1) even though costs are asymmetric.  Applying a move
+# recomputes only the edges it changes; shifting the prefix sums after them
+# is a single vectorised add.
+class Tour:
+    def __init__(self, order, costs):
+        self.order = np.array(order, dtype=np.int64)
+        self.n = len(self.order)
+        self._costs = costs
+        self.refresh()
+
+    def refresh(self):
+        order = self.order
+        nxt = np.concatenate((order[1:], order[:1]))
+
+        self.pos = np.empty(self.n, dtype=np.int64)
+        self.pos[order] = np.arange(self.n)
+
+        # Edge k runs from order[k] to order[k + 1]
+        fwd = self._costs[order, nxt]
+        bwd = self._costs[nxt, order]
+        bwd_inf = bwd == np.inf
+        self._fwd = np.concatenate(([0.0], np.cumsum(fwd)))
+        self._bwd = np.concatenate(([0.0], np.cumsum(np.where(bwd_inf, 0.0, bwd))))
+        self._bwd_inf = np.concatenate(([0], np.cumsum(bwd_inf)))
+        self.cost = self._fwd[-1]
+
+    # update :: Nat -> Nat -> ()
+    #
+    # Same as refresh, when only order[start:end] has changed; end may run
+    # past n, for a stretch that wraps around to the front.  Edges start-1
+    # .. end-1 are recomputed and the prefix sums after them shifted, so
+    # the cost of a move grows with the stretch it changes rather than the
+    # tour.  A missing edge anywhere falls back to a full refresh.
+    def update(self, start, end):
+        pieces = [(start, min(end, self.n))] + ([(0, end - self.n)] if end > self.n else [])
+        if self.cost == np.inf or not all(self._set_range(lo, hi) for (lo, hi) in pieces):
+            self.refresh()
+            return
+        self.cost = self._fwd[-1]
+
+    def _set_range(self, start, end):
+        self.pos[self.order[start:end]] = np.arange(start, end)
+        # Edge -1 is the last one, back to order[0]
+        return self._set_edges(max(start - 1, 0), end) and \
+            (start > 0 or self._set_edges(self.n - 1, self.n))
+
+    # _set_edges :: Nat -> Nat -> Bool
+    #
+    # Recomputes edges lo .. hi-1 and shifts the prefix sums after them;
+    # False, leaving the sums to a refresh, if one of the edges is missing.
+    def _set_edges(self, lo, hi):
+        order = self.order
+        src = order[lo:hi]
+        dst = order[lo + 1:hi + 1] if hi < self.n else np.append(order[lo + 1:], order[0])
+        fwd = self._costs[src, dst]
+        if fwd.sum() == np.inf:
+            return False
+        bwd = self._costs[dst, src]
+        bwd_inf = bwd == np.inf
+
+        for (prefix, edges) in ((self._fwd, fwd),
+                                (self._bwd, np.where(bwd_inf, 0.0, bwd)),
+                                (self._bwd_inf, bwd_inf)):
+            old_end = prefix[hi]
+            prefix[lo + 1:hi + 1] = prefix[lo] + np.cumsum(edges)
+            prefix[hi + 1:] += prefix[hi] - old_end
+        return True
+
+    def at(self, i):
+        return self.order[i % self.n]
+
+    # two_opt_delta :: Nat -> Nat -> Real
+    #
+    # Change in cost from replacing edges (order[i], order[i+1]) and
+    # (order[j], order[j+1]) with (order[i], order[j]) and
+    # (order[i+1], order[j+1]), which reverses order[i+1..j].
+    def two_opt_delta(self, i, j):
+        costs = self._costs
+        a, b, c, d = self.at(i), self.at(i + 1), self.at(j), self.at(j + 1)
+        reversal = self.reversal_delta(i, j)
+        return costs[a, c] + costs[b, d] - costs[a, b] - costs[c, d] + reversal
+
+    # reversal_delta :: Nat -> Nat -> Real
+    #
+    # Change in cost of the edges inside order[i+1..j] when that stretch is
+    # turned around.
+    def reversal_delta(self, i, j):
+        inner = (j - i) % self.n - 1
+        start = (i + 1) % self.n
+        if range_sum(self._bwd_inf, start, inner) > 0:
+            return np.inf
+        return range_sum(self._bwd, start, inner) - range_sum(self._fwd, start, inner)
+
+    def apply_two_opt(self, i, j):
+        start = i + 1
+        end = start + (j - i) % self.n
+        if end <= self.n:
+            self.order[start:end] = self.order[start:end][::-1].copy()
+            self.update(start, end)
+        else:
+            idx = np.arange(start, end) % self.n
+            self.order[idx] = self.order[idx[::-1]]
+            self.update(start, end)
+
+    # apply_swap :: Nat -> Nat -> Nat -> ()
+    #
+    # Swaps the `first' cities after position i with the `second' cities
+    # that follow them, keeping both directions.  Of the three stretches
+    # the tour falls into, swapping any two neighbouring ones gives the same
+    # cycle, so this picks the pair that's cheapest to move, which may move
+    # order[i] too.  Swapping `second' then `first' after order[i] undoes it.
+    def apply_swap(self, i, first, second):
+        n = self.n
+        rest = n - first - second
+        options = [((i + 1) % n, first, second),
+                   ((i + 1 + first) % n, second, rest),
+                   ((i + 1 + first + second) % n, rest, first)]
+        (start, a, b) = min(options, key=lambda o: (o[0] + o[1] + o[2] > n, o[1] + o[2]))
+
+        end = start + a + b
+        if end <= n:
+            segment = self.order[start:end]
+            self.order[start:end] = np.concatenate((segment[a:], segment[:a]))
+        else:
+            idx = np.arange(start, end) % n
+            segment = self.order[idx]
+            self.order[idx] = np.concatenate((segment[a:], segment[:a]))
+        self.update(start, end)
+
+    # apply_or_opt :: Nat -> Nat -> Nat -> ()
+    #
+    # Moves the `length' cities starting at position i so that they
+    # follow city c, keeping their direction: a swap of the stretch with
+    # the cities after it up to c.
+    def apply_or_opt(self, i, length, c):
+        between = (self.pos[c] - i - length) % self.n + 1
+        self.apply_swap((i - 1) % self.n, length, between)
+
+
+# LocalSearch :: 2-opt / Or-opt local search over a cost matrix
+#
+# Moves are restricted to the precomputed neighbour lists, and cities
+# whose surroundings haven't changed since they last failed to improve
+# are skipped (don't-look bits, kept as a work queue of active cities).
+# Or-opt moves stretches of up to OR_OPT_MAX cities; moving a single city
+# is the relocate move.
+class LocalSearch:
+    OR_OPT_MAX = 3
+
+    def __init__(self, costs, neighbors=None, k=10):
+        self._costs = costs
+        self._neighbors = neighbor_lists(costs, k) if neighbors is None else neighbors
+        # Cities optimize has tried to improve around; run passes how many
+        # it took on to the Instrumenter as moves tried, all at once
+        self.moves_tried = 0
+
+    # run :: [Nat] -> Time -> Optional(Instrument) -> ([Nat], Real)
+    def run(self, order, time_allowance, instrumenter=None):
+        tour = Tour(order, self._costs)
+        if tour.n < 5 or tour.cost == np.inf:
+            return (tour.order.tolist(), tour.cost)
+
+        # A reversal also turns around the edges inside it, which the
+        # don't-look bits don't track, so once the queue runs dry after any
+        # improvement every city gets one more look
+        deadline = time.time() + time_allowance
+        before = self.moves_tried
+        while self.optimize(tour, tour.order.tolist(), deadline, instrumenter):
+            pass
+
+        if instrumenter is not None:
+            instrumenter.inc_moves_tried(self.moves_tried - before)
+        return (tour.order.tolist(), tour.cost)
+
+    # optimize :: Tour -> [Nat] -> Time -> Optional(Instrument) -> Bool
+    #
+    # Works through the queue of active cities, starting with `active',
+    # until none of them can be improved or the deadline passes.  Returns
+    # whether the tour got any better.
+    def optimize(self, tour, active, deadline, instrumenter=None):
+        queue = collections.deque(active)
+        queued = np.zeros(tour.n, dtype=bool)
+        queued[active] = True
+
+        improved = False
+        tried = 0
+        while queue and time.time() < deadline and \
+              not (instrumenter is not None and instrumenter.stopped()):
+            a = queue.popleft()
+            queued[a] = False
+
+            tried += 1
+            touched = self.improve(tour, a)
+            if touched is None:
+                continue
+
+            improved = True
+            if instrumenter is not None:
+                instrumenter.inc_solutions_found()
+                instrumenter.report_solution(tour.cost, tour.order)
+                instrumenter.sample(bssf=tour.cost)
+            for c in touched:
+                if not queued[c]:
+                    queued[c] = True
+                    queue.append(c)
+
+        self.moves_tried += tried
+        # The last tour reported is `tour' itself, which changes from here on
+        if instrumenter is not None:
+            instrumenter.flush()
+        return improved
+
+    # improve :: Tour -> Nat -> Optional([Nat])
+    #
+    # Tries each kind of move around `a' in turn; subclasses add their own.
+    def improve(self, tour, a):
+        touched = self.improve_two_opt(tour, a)
+        if touched is None:
+            touched = self.improve_or_opt(tour, a)
+        return touched
+
+    # improve_two_opt :: Tour -> Nat -> Optional([Nat])
+    #
+    # Applies the first improving 2-opt move that adds an edge from `a' to
+    # one of its neighbours; returns the cities whose edges changed.
+    def improve_two_opt(self, tour, a):
+        costs = self._costs
+        i = tour.pos[a]
+        b = tour.at(i + 1)
+        removed = costs[a, b]
+
+        for c in self._neighbors[a]:
+            # Neighbours are sorted, so once the new edge is no cheaper than
+            # the one it replaces no later neighbour will help either
+            if costs[a, c] >= removed:
+                break
+            j = tour.pos[c]
+            d = tour.at(j + 1)
+            if c == b or d == a:
+                continue
+            if tour.two_opt_delta(i, j) < 0:
+                tour.apply_two_opt(i, j)
+                return [a, b, c, d]
+
+        return None
+
+    # improve_or_opt :: Tour -> Nat -> Optional([Nat])
+    #
+    # Applies the first improving move of the stretch starting at `a' to
+    # between some c and d, where d is a neighbour of the stretch's last
+    # city; returns the cities whose edges changed.
+    def improve_or_opt(self, tour, a):
+        costs = self._costs
+        n = tour.n
+        i = tour.pos[a]
+        p = tour.at(i - 1)
+
+        for length in range(1, min(self.OR_OPT_MAX, n - 3) + 1):
+            last = tour.at(i + length - 1)
+            nxt = tour.at(i + length)
+            gain = costs[p, a] + costs[last, nxt] - costs[p, nxt]
+            if not gain > 0:
+                continue
+
+            for d in self._neighbors[last]:
+                if costs[last, d] >= gain:
+                    break
+                j = tour.pos[d]
+                c = tour.at(j - 1)
+                # Neither end of the new slot may be inside the stretch
+                if (j - i) % n < length or (j - 1 - i) % n < length:
+                    continue
+                if costs[c, a] + costs[last, d] - costs[c, d] - gain < 0:
+                    tour.apply_or_opt(i, length, c)
+                    return [p, nxt, a, last, c, d]
+
+        return None
+
+
+def tour_cost(costs, order):
+    order = np.asarray(order)
+    return costs[order, np.roll(order, -1)].sum()
+
+
+def random_costs(rand, ncities, asymmetric=True):
+    pts = rand.uniform(-1.0, 1.0, size=(ncities, 2))
+    costs = np.sqrt(((pts[:, np.newaxis, :] - pts[np.newaxis, :, :]) ** 2).sum(axis=2))
+    if asymmetric:
+        elevation = rand.uniform(0.0, 1.0, size=ncities)
+        costs = np.maximum(costs + elevation[np.newaxis, :] - elevation[:, np.newaxis], 0.0)
+    costs = np.ceil(1000 * costs)
+    np.fill_diagonal(costs, np.inf)
+    return costs
+
+
+def test_two_opt_delta():
+    rand = np.random.RandomState(12)
+    costs = random_costs(rand, 9)
+    costs[2, 7] = np.inf
+    order = rand.permutation(9)
+    tour = Tour(order, costs)
+
+    for i in range(9):
+        for j in range(9):
+            if i == j or (j + 1) % 9 == i:
+                continue
+            moved = Tour(order, costs)
+            moved.apply_two_opt(i, j)
+            assert tour.two_opt_delta(i, j) == moved.cost - tour.cost
+            assert sorted(moved.order) == list(range(9))
+
+
+def test_tour_update():
+    rand = np.random.RandomState(4)
+    costs = random_costs(rand, 30)
+    costs[rand.randint(30, size=60), rand.randint(30, size=60)] = np.inf
+    tour = Tour(rand.permutation(30), costs)
+
+    for _ in range(200):
+        (i, first, second) = (rand.randint(30), rand.randint(1, 10), rand.randint(1, 10))
+        move = rand.randint(3)
+        if move == 0:
+            x = tour.at(i)
+            before = np.roll(tour.order, -i)
+            tour.apply_swap(i, first, second)
+            after = np.roll(tour.order, -tour.pos[x])
+            assert (after[1:first + second + 1] ==
+                    np.concatenate((before[first + 1:first + second + 1], before[1:first + 1]))).all()
+            assert (after[first + second + 1:] == before[first + second + 1:]).all()
+        elif move == 1:
+            tour.apply_two_opt(i, i + first + second)
+        else:
+            (a, c) = (tour.at(i), tour.at(i + first + second))
+            stretch = [tour.at(i + k) for k in range(first)]
+            tour.apply_or_opt(i, first, c)
+            assert [tour.at(tour.pos[c] + 1 + k) for k in range(first)] == stretch
+            assert tour.at(tour.pos[a] - 1) == c
+
+        fresh = Tour(tour.order, costs)
+        assert (tour.pos == fresh.pos).all()
+        assert tour.cost == fresh.cost
+        if fresh.cost < np.inf:
+            assert (tour._fwd == fresh._fwd).all()
+        assert (tour._bwd == fresh._bwd).all()
+        assert (tour._bwd_inf == fresh._bwd_inf).all()
+
+
+def test_local_search_improves():
+    rand = np.random.RandomState(3)
+    costs = random_costs(rand, 120)
+    order = rand.permutation(120).tolist()
+
+    (better, better_cost) = LocalSearch(costs, k=8).run(order, 60)
+    assert sorted(better) == list(range(120))
+    assert better_cost == tour_cost(costs, better)
+    assert better_cost < 0.5 * tour_cost(costs, order)
+
+    # At a local optimum nothing in the neighbourhood helps any more
+    search = LocalSearch(costs, k=8)
+    tour = Tour(better, costs)
+    assert all(search.improve_two_opt(tour, a) is None for a in range(120))
+    assert all(search.improve_or_opt(tour, a) is None for a in range(120))
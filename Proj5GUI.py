@@ -4,7 +4,10 @@ import math
 import random
 import signal
 import sys
+import threading
 import time
+import traceback
+import numpy as np
 
 
 from which_pyqt import PYQT_VER
@@ -27,9 +30,14 @@ else:
 from TSPSolver import *
 #from TSPSolver_complete import *
 from TSPClasses import *
+from SolutionCache import SolutionCache
 
 
 class PointLineView( QWidget ):
+	ARROW_SCALE = 5.0
+	CITY_SIZE = 2.0 # DIAMETER
+	LABEL_R = 1.0E3
+
 	def __init__( self, status_bar, data_range ):
 		super(QWidget,self).__init__()
 		self.setMinimumSize(950,600)
@@ -37,25 +45,38 @@ class PointLineView( QWidget ):
 		self.pointList	= {}
 		self.edgeList	= {}
 		self.labelList	 = {}
+		self.edgeLabelList = {}
 		self.status_bar = status_bar
 		self.data_range = data_range
 		self.start_pt = None
 		self.end_pt = None
 
+		# Drawing caches.  Edge geometry (lines, arrowheads and where the edge
+		# labels go, in widget coordinates) is worked out once per set of
+		# edges and widget size; the cities and their labels, which don't
+		# change while solving, are painted once into a pixmap.
+		self._edgeGeometry = None
+		self._cityLayer = None
+
 	def displayStatusText(self, text):
 		self.status_bar.showMessage(text)
 
 	def clearPoints(self):
 		self.pointList = {}
+		self._cityLayer = None
 
 	def clearEdges(self,removeColors = None):
 		self.edgeList = {}
+		self.edgeLabelList = {}
+		self._edgeGeometry = None
 		if removeColors:							# allows removal of edge labels without removing node labels, for example
 			for color in removeColors:
 				if color in self.labelList:
 					del self.labelList[color]			
+					self._cityLayer = None
 		else:
 			self.labelList = {}
+			self._cityLayer = None
 		self.repaint()
 
 	def addPoints( self, point_list, color ):
@@ -63,6 +84,7 @@ class PointLineView( QWidget ):
 			self.pointList[color].extend( point_list )
 		else:
 			self.pointList[color] = point_list
+		self._cityLayer = None
 
 #	def setStartLoc( self, point ):
 #		self.start_pt = point
@@ -74,122 +96,194 @@ class PointLineView( QWidget ):
 
 
 	def addEdge( self, startPt, endPt, label, edgeColor, labelColor=None, xoffset=0.0 ):
-		if not labelColor:
-			labelColor = edgeColor
-
 		assert( type(startPt) == QPointF )
 		assert( type(endPt)	  == QPointF )
 		assert( type(label)	  == str )
 
-		edge = QLineF(startPt, endPt)
+		self.addEdges( [(startPt.x(),startPt.y())], [(endPt.x(),endPt.y())], [label], \
+					   edgeColor, labelColor, xoffset=xoffset )
+
+	# Adds many edges of one colour at once; starts and ends are (x,y) rows
+	# (lists or n x 2 arrays) and labels one string per edge.
+	def addEdges( self, starts, ends, labels, edgeColor, labelColor=None, xoffset=0.0 ):
+		if not labelColor:
+			labelColor = edgeColor
+
+		starts = np.asarray( starts, dtype=float ).reshape(-1,2)
+		ends = np.asarray( ends, dtype=float ).reshape(-1,2)
+		assert( len(starts) == len(ends) == len(labels) )
+
+		edges = np.hstack( (starts, ends) ).tolist()
 		if edgeColor in self.edgeList.keys():
-			self.edgeList[edgeColor].append( edge )
+			self.edgeList[edgeColor].extend( edges )
 		else:
-			self.edgeList[edgeColor] = [edge]
+			self.edgeList[edgeColor] = edges
 
-		midp = QPointF( (edge.x1()*0.2 + edge.x2()*0.8), 
-						(edge.y1()*0.2 + edge.y2()*0.8) )
-		self.addLabel( midp, label, labelColor, xoffset=xoffset )
+		midps = (starts*0.2 + ends*0.8).tolist()
+		labels = [(x, y, label, xoffset) for ((x, y), label) in zip(midps, labels)]
+		if labelColor in self.edgeLabelList.keys():
+			self.edgeLabelList[labelColor].extend( labels )
+		else:
+			self.edgeLabelList[labelColor] = labels
+		self._edgeGeometry = None
 
 	def addLabel( self, point, label, labelColor,xoffset=0.0 ):
 		if labelColor in self.labelList.keys():
 			self.labelList[labelColor].append( (point,label,xoffset) )
 		else:
 			self.labelList[labelColor] = [(point,label,xoffset)]
+		self._cityLayer = None
 
 
-
-
-	def paintEvent(self, event):
-		painter = QPainter(self)
-		painter.setRenderHint(QPainter.Antialiasing,True)
-
+	# The data-to-widget scale, keeping the aspect ratio of data_range
+	def viewScale(self):
 		xr = self.data_range['x']
 		yr = self.data_range['y']
 		w = self.width()
 		h = self.height()
 		w2h_desired_ratio = (xr[1]-xr[0])/(yr[1]-yr[0])
 		if w / h < w2h_desired_ratio:
-			 scale = w / (xr[1]-xr[0])
+			 return w / (xr[1]-xr[0])
 		else:
-			 scale = h / (yr[1]-yr[0])
+			 return h / (yr[1]-yr[0])
 
-		tform = QTransform()
-		tform.translate(self.width()/2.0,self.height()/2.0)
-		tform.scale(1.0,-1.0)
-		painter.setTransform(tform)
+	# Everything is drawn in widget coordinates: the data origin sits in the
+	# middle of the widget and y points up.
+	def toWidget(self, xy, scale):
+		return np.column_stack( (self.width()/2.0 + scale*xy[:,0], \
+								 self.height()/2.0 - scale*xy[:,1]) )
 
-		for color in self.edgeList:
-			c = QColor(color[0],color[1],color[2])
-			painter.setPen( c )
-			for edge in self.edgeList[color]:
-				ln = QLineF( scale*edge.x1(), scale*edge.y1(), scale*edge.x2(), scale*edge.y2() )
-				painter.drawLine( ln )
+	def labelRect(self, x, y):
+		R = self.LABEL_R
+		return QRectF( x-R, y-R, 2.0*R, 2.0*R )
 
-		for color in self.edgeList:
-			c = QColor(color[0],color[1],color[2])
-			painter.setPen( c )
-			for edge in self.edgeList[color]:
-				#arrow_scale = .015
-				arrow_scale = 5.0
-				unit_edge = ( edge.x2() - edge.x1(), edge.y2() - edge.y1() )
-				unit_edge_mag = math.sqrt( ( edge.x2() - edge.x1())**2 + ( edge.y2() - edge.y1() )**2 )
-				unit_edge = (unit_edge[0] / unit_edge_mag, unit_edge[1] / unit_edge_mag )
-				unit_edge_perp = (-unit_edge[1], unit_edge[0])
-
-				temp_tform = QTransform()
-				temp_tform.translate(self.width()/2.0,self.height()/2.0)
-				temp_tform.scale(1.0,-1.0)
-				temp_tform.translate(scale*edge.x2(),scale*edge.y2())
-				temp_tform.scale(1.0,-1.0)
-				painter.setTransform(temp_tform)
-				#painter.drawText( RECT, label[1], align )
-
-				tri_pts = []
-				tri_pts.append( QPointF(0,0) )
-				tri_pts.append( QPointF(-arrow_scale*(2*unit_edge[0] + unit_edge_perp[0]),
-										arrow_scale*(2*unit_edge[1] + unit_edge_perp[1])) )
-				tri_pts.append( QPointF(-arrow_scale*(2*unit_edge[0] - unit_edge_perp[0]),
-										arrow_scale*(2*unit_edge[1] - unit_edge_perp[1])) )
-				tri = QPolygonF( tri_pts )
-				b = painter.brush()
-				painter.setBrush( c )
-				painter.drawPolygon( tri )
-				painter.setBrush( b )
+	def edgeGeometry(self, scale):
+		key = (scale, self.width(), self.height())
+		if self._edgeGeometry is not None and self._edgeGeometry[0] == key:
+			return self._edgeGeometry[1]
 
-		painter.setTransform(tform)
-		font = QFont("Monospace")
-		font.setStyleHint(QFont.TypeWriter)
+		geometry = {}
+		for color in self.edgeList:
+			edges = np.array( self.edgeList[color], dtype=float ).reshape(-1,4)
+			p1 = self.toWidget( edges[:,0:2], scale )
+			p2 = self.toWidget( edges[:,2:4], scale )
+			lines = [QLineF(*ln) for ln in np.hstack( (p1, p2) ).tolist()]
+
+			# Arrowheads at the far end of each edge, ARROW_SCALE pixels
+			# across whatever the scale; y is already flipped in p1 and p2
+			delta = p2 - p1
+			mag = np.hypot( delta[:,0], delta[:,1] )
+			unit = delta / np.where( mag == 0.0, 1.0, mag )[:,None]
+			perp = np.column_stack( (unit[:,1], -unit[:,0]) )
+			a = self.ARROW_SCALE
+			left = p2 - a*(2*unit + perp)
+			right = p2 - a*(2*unit - perp)
+			# (Separate small polygons fill much faster than one path
+			# holding them all.)
+			arrows = [QPolygonF( [QPointF(*tip), QPointF(*l), QPointF(*r)] ) \
+					  for (tip, l, r) in zip( p2.tolist(), left.tolist(), right.tolist() )]
+			geometry[color] = (lines, arrows)
+
+		labels = {}
+		for color in self.edgeLabelList:
+			rows = self.edgeLabelList[color]
+			pts = self.toWidget( np.array( [row[:2] for row in rows], dtype=float ).reshape(-1,2), scale )
+			labels[color] = [(self.labelRect( x+row[3], y ), row[2]) \
+							 for ((x, y), row) in zip( pts.tolist(), rows )]
+
+		self._edgeGeometry = (key, (geometry, labels))
+		return self._edgeGeometry[1]
+
+	# The cities and their labels, painted once into a transparent pixmap
+	# the size of the widget
+	def cityLayer(self, scale):
+		ratio = self.devicePixelRatioF()
+		key = (scale, self.width(), self.height(), ratio)
+		if self._cityLayer is not None and self._cityLayer[0] == key:
+			return self._cityLayer[1]
+
+		pixmap = QPixmap( int(math.ceil(self.width()*ratio)), int(math.ceil(self.height()*ratio)) )
+		pixmap.setDevicePixelRatio( ratio )
+		pixmap.fill( Qt.transparent )
+		painter = QPainter(pixmap)
+		painter.setRenderHint(QPainter.Antialiasing,True)
 
-		R = 1.0E3
-		CITY_SIZE = 2.0 # DIAMETER
-		RECT = QRectF(-R,-R,2.0*R,2.0*R)
 		align = QTextOption( Qt.Alignment(Qt.AlignHCenter | Qt.AlignVCenter) )
 		for color in self.labelList:
 			c = QColor(color[0],color[1],color[2])
 			painter.setPen( c )
-			for label in self.labelList[color]:
-				temp_tform = QTransform()
-				temp_tform.translate(self.width()/2.0,self.height()/2.0)
-				temp_tform.scale(1.0,-1.0)
-				pt = label[0]
-				xoff = label[2]
-				temp_tform.translate(scale*pt.x()+xoff,scale*pt.y())
-				temp_tform.scale(1.0,-1.0)
-				painter.setTransform(temp_tform)
-				painter.drawText( RECT, label[1], align )
-
-		painter.setTransform(tform)
+			rows = self.labelList[color]
+			pts = self.toWidget( np.array( [(pt.x(), pt.y()) for (pt,_,_) in rows], dtype=float ).reshape(-1,2), scale )
+			for ((x, y), (_, label, xoff)) in zip( pts.tolist(), rows ):
+				painter.drawText( self.labelRect( x+xoff, y ), label, align )
+
 		for color in self.pointList:
 			c = QColor(color[0],color[1],color[2])
 			painter.setPen( c )
-			b = painter.brush()
-			painter.setBrush(c)
-			for point in self.pointList[color]:
-				pt = QPointF(scale*point.x(), scale*point.y())
-				painter.drawEllipse( pt, CITY_SIZE, CITY_SIZE)
-			painter.setBrush(b)
+			painter.setBrush( c )
+			pts = self.toWidget( np.array( [(pt.x(), pt.y()) for pt in self.pointList[color]], dtype=float ).reshape(-1,2), scale )
+			for (x, y) in pts.tolist():
+				painter.drawEllipse( QPointF(x, y), self.CITY_SIZE, self.CITY_SIZE )
+		painter.end()
+
+		self._cityLayer = (key, pixmap)
+		return pixmap
+
+	def paintEvent(self, event):
+		scale = self.viewScale()
+		(geometry, labels) = self.edgeGeometry( scale )
+		cities = self.cityLayer( scale )
+
+		painter = QPainter(self)
+		painter.setRenderHint(QPainter.Antialiasing,True)
+
+		for color in geometry:
+			c = QColor(color[0],color[1],color[2])
+			(lines, arrows) = geometry[color]
+			painter.setPen( c )
+			painter.setBrush( c )
+			painter.drawLines( lines )
+			for tri in arrows:
+				painter.drawPolygon( tri )
+		painter.setBrush( QBrush() )
+
+		align = QTextOption( Qt.Alignment(Qt.AlignHCenter | Qt.AlignVCenter) )
+		for color in labels:
+			painter.setPen( QColor(color[0],color[1],color[2]) )
+			for (rect, label) in labels[color]:
+				painter.drawText( rect, label, align )
 
+		painter.drawPixmap( 0, 0, cities )
+
+
+
+class SolverThread( QThread ):
+	# Runs one solve off the GUI thread.  progress carries each better tour
+	# as the solver finds it and done carries the results dictionary (None
+	# if the solver failed); both arrive on the GUI thread as queued signals.
+	progress = pyqtSignal(object)
+	done = pyqtSignal(object)
+
+	def __init__( self, solve_func, time_allowance ):
+		super(SolverThread,self).__init__()
+		self._solve_func = solve_func
+		self._time_allowance = time_allowance
+		self._stop_event = threading.Event()
+
+	def run( self ):
+		results = None
+		try:
+			results = self._solve_func( time_allowance=self._time_allowance, \
+										on_solution=self.progress.emit, \
+										stop_event=self._stop_event )
+		except Exception:
+			traceback.print_exc()
+		self.done.emit( results )
+
+	# Asks the solver to wind up; it still returns (and emits done) with the
+	# best tour it has so far
+	def cancel( self ):
+		self._stop_event.set()
 
 
 class Proj5GUI( QMainWindow ):
@@ -202,8 +296,11 @@ class Proj5GUI( QMainWindow ):
 		self._MAX_SEED = 1000 
 
 		self._scenario = None
+		self.solverThread = None
 		self.initUI()
-		self.solver = TSPSolver( self.view )
+		# Regenerating the same scenario and solving it again is answered
+		# from the cache
+		self.solver = TSPSolver( self.view, SolutionCache() )
 		self.genParams = {'size':None,'seed':None,'diff':None}
 
 
@@ -211,21 +308,8 @@ class Proj5GUI( QMainWindow ):
 	def newPoints(self):		
 		# TODO - ERROR CHECKING!!!!
 		seed = int(self.curSeed.text())
-		random.seed( seed )
-
-		ptlist = []
-		RANGE = self.data_range
-		xr = self.data_range['x']
-		yr = self.data_range['y']
 		npoints = int(self.size.text())
-		while len(ptlist) < npoints:
-			x = random.uniform(0.0,1.0)
-			y = random.uniform(0.0,1.0)
-			if True:
-				xval = xr[0] + (xr[1]-xr[0])*x
-				yval = yr[0] + (yr[1]-yr[0])*y
-				ptlist.append( QPointF(xval,yval) )
-		return ptlist
+		return generate_points( npoints, seed, self.data_range )
 
 	def generateNetwork(self):
 		points = self.newPoints() # uses current rand seed
@@ -264,19 +348,20 @@ class Proj5GUI( QMainWindow ):
 		self.view.repaint()
 
 
-	def displaySolution( self ) :						# what about calling this somehow every time a new bssf is found?
+	def displaySolution( self ) :
 		self.view.clearEdges([(64,64,255)])				# get rid of edge labels but not point labels
 		if self._solution:
-			self.addCities()
-			edges = self._solution.enumerateEdges()
-			if edges:
+			# Drawn straight from the tour's city indices and edge costs, without
+			# going through City objects
+			costs = self._solution.edgeCosts()
+			if np.isfinite( costs ).all():
 				edgeColor  = (128,128,255)
 				labelColor = (64,64,255)
-				for edge in edges:
-					pt1,pt2,label = edge
-					self.view.addEdge( QPointF(pt1._x,pt1._y), \
-									   QPointF(pt2._x,pt2._y), \
-									   '{}'.format(label), edgeColor, labelColor )
+				xy = self._solution._scenario.getCoordinates()
+				tour = self._solution.indices
+				self.view.addEdges( xy[tour], xy[np.roll(tour,-1)], \
+									[str(label) for label in costs.astype(np.int64).tolist()], \
+									edgeColor, labelColor )
 		else:
 			self.statusBar.showMessage('No Solution Found.')
 		self.view.repaint()
@@ -287,11 +372,10 @@ class Proj5GUI( QMainWindow ):
 		self.curSeed.setText( '{}'.format(new_seed) )
 		self.view.repaint()
 
-	def solveClicked(self):								# need to reset display??? and say "processing..." at bottom???
+	def solveClicked(self):
 		self.solver.setupWithScenario(self._scenario)
 
 		max_time = float( self.timeLimit.text() )
-		# TODO - start on a separate thread
 		self.view.clearEdges([(64,64,255)])				# get rid of edge labels but not point labels
 		self.numSolutions.setText( '--' )
 		self.tourCost.setText( '--' )
@@ -300,10 +384,18 @@ class Proj5GUI( QMainWindow ):
 		self.totalStates.setText( '--' )
 		self.prunedStates.setText( '--' )
 		self.statusBar.showMessage('Processing...')
-		#self.view.repaint()
-		#app.processEvents()
 		solve_func = 'self.solver.'+self.ALGORITHMS[self.algDropDown.currentIndex()][1]
-		results = eval(solve_func)(time_allowance=max_time )
+		self._last_redraw = 0.0
+		self.solverThread = SolverThread( eval(solve_func), max_time )
+		self.solverThread.progress.connect( self.solutionFound )
+		self.solverThread.done.connect( self.solveFinished )
+		self.setSolving( True )
+		self.solverThread.start()
+
+	def solveFinished(self, results):
+		self.solverThread.wait()
+		self.solverThread = None
+		self.setSolving( False )
 		if results:
 			self.statusBar.showMessage('')
 			self.numSolutions.setText( '{}'.format(results['count']) )
@@ -318,10 +410,45 @@ class Proj5GUI( QMainWindow ):
 				self.prunedStates.setText( '{}'.format(results['pruned']))
 			#if self._solution:
 			self.displaySolution()
+			if 'error' in results:
+				self.statusBar.showMessage( results['error'] )
 		else:
+			self.statusBar.showMessage('Solver failed.')
 			print( 'GOT NULL SOLUTION BACK!!' )		#probably shouldn't ever use this...
 		self.view.repaint()
-#		app.processEvents()
+
+	def cancelClicked(self):
+		if self.solverThread:
+			self.solverThread.cancel()
+			self.cancelButton.setEnabled(False)
+			self.statusBar.showMessage('Cancelling...')
+
+	# Nothing that changes the scenario or the solve can be touched while a
+	# solve is running, apart from Cancel
+	def setSolving(self, solving):
+		for widget in [self.randSeedButton, self.generateButton, self.solveButton, \
+					   self.curSeed, self.size, self.diffDropDown, self.algDropDown, \
+					   self.timeLimit]:
+			widget.setEnabled( not solving )
+		self.cancelButton.setEnabled( solving )
+		if not solving:
+			self.checkGenInputs()
+
+	# Called with each better tour while the solver is still searching.
+	# Redraws at most every REDRAW_INTERVAL seconds so that a burst of
+	# improvements doesn't swamp the event loop; the final tour is always
+	# drawn once the solve finishes.
+	REDRAW_INTERVAL = 0.1
+	def solutionFound( self, update ):
+		now = time.time()
+		if now - self._last_redraw < self.REDRAW_INTERVAL:
+			return
+		self._last_redraw = now
+		self._solution = update['soln']
+		self.tourCost.setText( '{}'.format(update['cost']) )
+		self.numSolutions.setText( '{}'.format(update['stats']['count']) )
+		self.solvedIn.setText( '{:6.6f} seconds'.format(update['time']) )
+		self.displaySolution()
 
 	def checkGenInputs(self):
 		seed  = self.curSeed.text()
@@ -370,7 +497,10 @@ class Proj5GUI( QMainWindow ):
 		('Default                            ','defaultRandomTour'), \
 		('Greedy','greedy'), \
 		('Branch and Bound','branchAndBound'), \
-		('Fancy','fancy') \
+		('Branch and Bound (Parallel)','parallelBranchAndBound'), \
+		('Held-Karp (Exact)','heldKarp'), \
+		('Fancy','fancy'), \
+		('Lin-Kernighan','linKernighan') \
 	]															# whitespace hack to get longest to display correctly
 
 	def initUI( self ):
@@ -394,6 +524,7 @@ class Proj5GUI( QMainWindow ):
 		self.randSeedButton = QPushButton('Randomize Seed')
 		self.generateButton = QPushButton('Generate Scenario')
 		self.solveButton	= QPushButton('Solve TSP')
+		self.cancelButton	= QPushButton('Cancel')
 
 		self.curSeed		= QLineEdit('20')
 		self.curSeed.setFixedWidth(100)
@@ -462,6 +593,7 @@ class Proj5GUI( QMainWindow ):
 		h.addWidget( self.timeLimit )
 		h.addWidget( QLabel( 'seconds' ) )
 		h.addWidget( self.solveButton )
+		h.addWidget( self.cancelButton )
 		h.addStretch(1)
 		vbox.addLayout(h)
 
@@ -481,6 +613,7 @@ class Proj5GUI( QMainWindow ):
 
 		self.lastPath = (None,None)
 		self.solveButton.setEnabled(False)
+		self.cancelButton.setEnabled(False)
 
 		self.curSeed.textChanged.connect(self.checkGenInputs)
 		self.size.textChanged.connect(self.checkGenInputs)
@@ -488,6 +621,7 @@ class Proj5GUI( QMainWindow ):
 		self.randSeedButton.clicked.connect(self.randSeedClicked)
 		self.generateButton.clicked.connect(self.generateClicked)
 		self.solveButton.clicked.connect(self.solveClicked)
+		self.cancelButton.clicked.connect(self.cancelClicked)
 
 		self.diffDropDown.addItem('Easy                               ')					# Weird hack to make box wide enough to show all of last item
 		self.diffDropDown.addItem('Normal')
@@ -508,6 +642,13 @@ class Proj5GUI( QMainWindow ):
 		self.show()
 
 
+	# Don't leave a solve running behind a closed window
+	def closeEvent(self, event):
+		if self.solverThread:
+			self.solverThread.cancel()
+			self.solverThread.wait()
+		super(Proj5GUI,self).closeEvent(event)
+
 	def diffChanged(self, text):
 		self.checkGenInputs()
 
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+import math
+import re
+import struct
+import zipfile
+import numpy as np
+
+from Candidates import CandidateGraph, GridIndex
+from TSPClasses import Scenario
+
+
+############################################################
+#
+#       Reading and writing scenarios: TSPLIB and snapshots
+#
+############################################################
+
+# TSPLIB files are text, for trading instances with other solvers.  A
+# scenario's costs come from its elevations as well as its map, which TSPLIB
+# has no way to say, so they are written out as an EXPLICIT matrix (ATSP
+# when the costs are asymmetric, which they are unless the difficulty is
+# Easy) with the city locations as display data.  Coordinate files are read
+# with the TSPLIB distance functions, not the scenario's.
+#
+# Snapshots are the fast way to save a scenario for later: an uncompressed
+# .npz of the arrays a Scenario is built on, locations, elevations, which
+# edges exist and the cost matrix (or, for a sparse scenario, its candidate
+# edges), so loading one recomputes nothing.  With mmap=True the cost
+# matrix is mapped straight out of the file rather than read in.
+
+# TSPLIB has no infinity; missing edges are written as this, and anything at
+# least this big is read back as missing
+TSPLIB_MISSING_EDGE = 2**31 - 1
+
+# Symmetric matrix layouts, as the (row, column) of each entry in the order
+# they come in.  The *_COL layouts are the transposes of the *_ROW ones,
+# which is the same thing for a symmetric matrix.
+_TRIANGLES = {
+    'UPPER_ROW': lambda n: np.triu_indices( n, 1 ),
+    'LOWER_ROW': lambda n: np.tril_indices( n, -1 ),
+    'UPPER_DIAG_ROW': lambda n: np.triu_indices( n ),
+    'LOWER_DIAG_ROW': lambda n: np.tril_indices( n ),
+    'UPPER_COL': lambda n: np.tril_indices( n, -1 ),
+    'LOWER_COL': lambda n: np.triu_indices( n, 1 ),
+    'UPPER_DIAG_COL': lambda n: np.tril_indices( n ),
+    'LOWER_DIAG_COL': lambda n: np.triu_indices( n ),
+}
+
+_KEYWORD = re.compile( r'^[ \t]*([A-Z][A-Z0-9_]*)[ \t]*(?::[ \t]*(.*?))?[ \t]*$', re.M )
+
+
+# read_tsplib :: Path -> Scenario
+#
+# A dense scenario (difficulty 'TSPLIB') from a TSP or ATSP file with
+# EXPLICIT weights in any of the standard layouts, or EUC_2D, CEIL_2D or
+# ATT coordinates.  Cities without coordinates or display data are laid out
+# round a circle so there is something to draw.
+def read_tsplib( path ):
+    with open( path ) as f:
+        text = f.read()
+
+    header = {}
+    sections = {}
+    matches = list( _KEYWORD.finditer( text ) )
+    for (i, m) in enumerate( matches ):
+        key = m.group( 1 )
+        if key.endswith( '_SECTION' ):
+            end = matches[i + 1].start() if i + 1 < len( matches ) else len( text )
+            sections[key] = text[m.end():end]
+        elif key != 'EOF':
+            header[key] = (m.group( 2 ) or '').strip()
+
+    if 'DIMENSION' not in header:
+        raise ValueError( "{}: no DIMENSION".format( path ) )
+    n = int( header['DIMENSION'] )
+    weight_type = header.get( 'EDGE_WEIGHT_TYPE', 'EXPLICIT' )
+
+    xy = None
+    for key in ('NODE_COORD_SECTION', 'DISPLAY_DATA_SECTION'):
+        if key in sections:
+            xy = _node_table( sections[key], n, path )
+            break
+
+    if weight_type == 'EXPLICIT':
+        if 'EDGE_WEIGHT_SECTION' not in sections:
+            raise ValueError( "{}: EXPLICIT weights but no EDGE_WEIGHT_SECTION".format( path ) )
+        costs = _explicit_costs( sections['EDGE_WEIGHT_SECTION'],
+                                 header.get( 'EDGE_WEIGHT_FORMAT', 'FULL_MATRIX' ), n, path )
+    elif weight_type in _METRICS:
+        if 'NODE_COORD_SECTION' not in sections:
+            raise ValueError( "{}: {} weights but no NODE_COORD_SECTION".format( path, weight_type ) )
+        costs = _METRICS[weight_type]( xy )
+    else:
+        raise ValueError( "{}: unsupported EDGE_WEIGHT_TYPE {}".format( path, weight_type ) )
+
+    np.fill_diagonal( costs, np.inf )
+    if xy is None:
+        angle = 2 * np.pi * np.arange( n ) / max( n, 1 )
+        xy = np.column_stack( (np.cos( angle ), np.sin( angle )) )
+    return Scenario.fromArrays( xy, 'TSPLIB', cost_matrix=costs )
+
+
+# Rows of `id x y', in any order, as an n x 2 array indexed by id - 1
+def _node_table( block, n, path ):
+    values = np.fromstring( block, sep=' ' )
+    if len( values ) != 3 * n:
+        raise ValueError( "{}: expected {} rows of `id x y'".format( path, n ) )
+    rows = values.reshape( n, 3 )
+    xy = np.zeros( (n, 2) )
+    xy[rows[:, 0].astype( np.int64 ) - 1] = rows[:, 1:]
+    return xy
+
+
+def _explicit_costs( block, layout, n, path ):
+    values = np.fromstring( block, sep=' ' )
+    if layout == 'FULL_MATRIX':
+        if len( values ) != n * n:
+            raise ValueError( "{}: expected {} weights for a FULL_MATRIX".format( path, n * n ) )
+        costs = values.reshape( n, n )
+    elif layout in _TRIANGLES:
+        (rows, cols) = _TRIANGLES[layout]( n )
+        if len( values ) != len( rows ):
+            raise ValueError( "{}: expected {} weights for {}".format( path, len( rows ), layout ) )
+        costs = np.zeros( (n, n) )
+        costs[rows, cols] = values
+        costs[cols, rows] = values
+    else:
+        raise ValueError( "{}: unsupported EDGE_WEIGHT_FORMAT {}".format( path, layout ) )
+    costs[costs >= TSPLIB_MISSING_EDGE] = np.inf
+    return costs
+
+
+def _distances( xy ):
+    return np.hypot( xy[:, 0][:, None] - xy[:, 0][None, :], xy[:, 1][:, None] - xy[:, 1][None, :] )
+
+
+# The TSPLIB distance functions; nint rounds halves up
+def _att( xy ):
+    r = _distances( xy ) / math.sqrt( 10.0 )
+    t = np.floor( r + 0.5 )
+    return np.where( t < r, t + 1, t )
+
+
+_METRICS = {
+    'EUC_2D': lambda xy: np.floor( _distances( xy ) + 0.5 ),
+    'CEIL_2D': lambda xy: np.ceil( _distances( xy ) ),
+    'ATT': _att,
+}
+
+
+# write_tsplib :: Scenario -> Path -> Optional(String) -> ()
+#
+# An EXPLICIT TSPLIB file with the scenario's cost matrix: the upper
+# triangle of a TSP when the costs are symmetric, the FULL_MATRIX of an ATSP
+# when they aren't.  Sparse scenarios have no matrix to write.
+def write_tsplib( scenario, path, name=None ):
+    if scenario.isSparse():
+        raise ValueError( "sparse scenarios have no cost matrix to write; save a snapshot instead" )
+    costs = np.asarray( scenario.getCostMatrix() )
+    n = len( costs )
+    xy = np.array( [(c._x, c._y) for c in scenario.getCities()], dtype=float ).reshape( -1, 2 )
+
+    symmetric = np.array_equal( costs, costs.T )
+    weights = np.where( np.isfinite( costs ), costs, TSPLIB_MISSING_EDGE ).astype( np.int64 )
+    if symmetric:
+        weights = weights[np.triu_indices( n, 1 )]
+        rows = [weights[i * n - i * (i + 1) // 2:(i + 1) * n - (i + 1) * (i + 2) // 2] for i in range( n - 1 )]
+    else:
+        rows = list( weights )
+
+    with open( path, 'w' ) as f:
+        f.write( "NAME : {}\n".format( name or 'scenario{}'.format( n ) ) )
+        f.write( "TYPE : {}\n".format( 'TSP' if symmetric else 'ATSP' ) )
+        f.write( "COMMENT : {} scenario with {} cities\n".format( scenario._difficulty, n ) )
+        f.write( "DIMENSION : {}\n".format( n ) )
+        f.write( "EDGE_WEIGHT_TYPE : EXPLICIT\n" )
+        f.write( "EDGE_WEIGHT_FORMAT : {}\n".format( 'UPPER_ROW' if symmetric else 'FULL_MATRIX' ) )
+        f.write( "DISPLAY_DATA_TYPE : TWOD_DISPLAY\n" )
+        f.write( "EDGE_WEIGHT_SECTION\n" )
+        for row in rows:
+            f.write( ' '.join( map( str, row.tolist() ) ) )
+            f.write( '\n' )
+        f.write( "DISPLAY_DATA_SECTION\n" )
+        for (i, (x, y)) in enumerate( xy.tolist() ):
+            f.write( "{} {!r} {!r}\n".format( i + 1, x, y ) )
+        f.write( "EOF\n" )
+
+
+# save_snapshot :: Scenario -> Path -> ()
+def save_snapshot( scenario, path ):
+    cities = scenario.getCities()
+    arrays = {
+        'xy': np.array( [(c._x, c._y) for c in cities], dtype=float ).reshape( -1, 2 ),
+        'elevation': np.array( [c._elevation for c in cities], dtype=float ),
+        'difficulty': np.array( scenario._difficulty ),
+    }
+    if scenario._rand_seed is not None:
+        arrays['rand_seed'] = np.array( scenario._rand_seed )
+    if scenario.isSparse():
+        candidates = scenario.getCandidates()
+        arrays['indptr'] = candidates.indptr
+        arrays['indices'] = candidates.indices
+        arrays['candidate_costs'] = candidates.costs
+    else:
+        arrays['edge_exists'] = np.packbits( scenario._edge_exists, axis=None )
+        arrays['cost_matrix'] = np.asarray( scenario.getCostMatrix(), dtype=float )
+    # Uncompressed, so the cost matrix can be mapped
+    with open( path, 'wb' ) as f:
+        np.savez( f, **arrays )
+
+
+# load_snapshot :: Path -> Bool -> Scenario
+#
+# With mmap=True the cost matrix is mapped copy-on-write: pages are read as
+# they are used, and writing to the matrix never touches the file.
+def load_snapshot( path, mmap=False ):
+    with np.load( path ) as data:
+        xy = data['xy']
+        elevation = data['elevation']
+        difficulty = str( data['difficulty'] )
+        rand_seed = int( data['rand_seed'] ) if 'rand_seed' in data else None
+
+        if 'indptr' in data:
+            candidates = CandidateGraph( data['indptr'], data['indices'], data['candidate_costs'],
+                                         GridIndex( xy ) )
+            return Scenario.fromArrays( xy, difficulty, elevation=elevation, candidates=candidates,
+                                        rand_seed=rand_seed )
+
+        n = len( xy )
+        edge_exists = np.unpackbits( data['edge_exists'], count=n * n ).view( bool ).reshape( n, n )
+        costs = _map_member( path, 'cost_matrix' ) if mmap else None
+        if costs is None:
+            costs = data['cost_matrix']
+    return Scenario.fromArrays( xy, difficulty, elevation=elevation, edge_exists=edge_exists,
+                                cost_matrix=costs, rand_seed=rand_seed )
+
+
+# An array stored uncompressed in a .npz, mapped from the file, or None when
+# it is compressed.  The member's data starts after the zip entry's local
+# header and the .npy header.
+def _map_member( path, name ):
+    with zipfile.ZipFile( path ) as z:
+        info = z.getinfo( name + '.npy' )
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open( path, 'rb' ) as f:
+        f.seek( info.header_offset )
+        (name_length, extra_length) = struct.unpack( '<HH', f.read( 30 )[26:30] )
+        f.seek( info.header_offset + 30 + name_length + extra_length )
+        version = np.lib.format.read_magic( f )
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0( f )
+        else:
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0( f )
+        offset = f.tell()
+    mapped = np.memmap( path, dtype=dtype, mode='c', offset=offset, shape=shape,
+                        order='F' if fortran_order else 'C' )
+    return np.asarray( mapped )
+
+
+def _same_costs( a, b ):
+    return np.array_equal( np.asarray( a ), np.asarray( b ) )
+
+
+def test_tsplib_round_trip():
+    import os
+    import tempfile
+    from TSPClasses import generate_points
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join( tmp, 'scenario.tsp' )
+        for difficulty in ('Easy', 'Normal', 'Hard (Deterministic)'):
+            scenario = Scenario( generate_points( 12, 5 ), difficulty, 5 )
+            write_tsplib( scenario, path )
+            with open( path ) as f:
+                assert ('TYPE : TSP\n' in f.read()) == (difficulty == 'Easy')
+
+            loaded = read_tsplib( path )
+            assert _same_costs( loaded.getCostMatrix(), scenario.getCostMatrix() )
+            assert (loaded._edge_exists == scenario._edge_exists).all()
+            assert [(c._x, c._y) for c in loaded.getCities()] == \
+                   [(c._x, c._y) for c in scenario.getCities()]
+
+
+def test_tsplib_formats():
+    import os
+    import tempfile
+    full = np.array( [[0, 3, 5, 9], [3, 0, 4, 7], [5, 4, 0, 2], [9, 7, 2, 0]] )
+    layouts = {
+        'FULL_MATRIX': full.ravel(),
+        'UPPER_ROW': full[np.triu_indices( 4, 1 )],
+        'LOWER_DIAG_ROW': full[np.tril_indices( 4 )],
+        'UPPER_DIAG_COL': np.array( [full[i, j] for j in range( 4 ) for i in range( j + 1 )] ),
+    }
+    expected = full.astype( float )
+    np.fill_diagonal( expected, np.inf )
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join( tmp, 'small.tsp' )
+        for (layout, weights) in layouts.items():
+            with open( path, 'w' ) as f:
+                f.write( "NAME: small\nTYPE: TSP\nDIMENSION: 4\nEDGE_WEIGHT_TYPE: EXPLICIT\n"
+                         "EDGE_WEIGHT_FORMAT: {}\nEDGE_WEIGHT_SECTION\n{}\nEOF\n"
+                         .format( layout, ' '.join( map( str, weights ) ) ) )
+            assert _same_costs( read_tsplib( path ).getCostMatrix(), expected ), layout
+
+        # A 3-4-5 triangle, with the rows out of order
+        with open( path, 'w' ) as f:
+            f.write( "NAME : triangle\nTYPE : TSP\nDIMENSION : 3\nEDGE_WEIGHT_TYPE : EUC_2D\n"
+                     "NODE_COORD_SECTION\n2 3.0 0.0\n1 0 0\n3 3.0 4.4\nEOF\n" )
+        scenario = read_tsplib( path )
+        assert [(c._x, c._y) for c in scenario.getCities()] == [(0.0, 0.0), (3.0, 0.0), (3.0, 4.4)]
+        assert _same_costs( scenario.getCostMatrix(),
+                            [[np.inf, 3, 5], [3, np.inf, 4], [5, 4, np.inf]] )
+
+
+def test_snapshot_round_trip():
+    import os
+    import tempfile
+    from TSPClasses import generate_points
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join( tmp, 'scenario.npz' )
+        scenario = Scenario( generate_points( 40, 8 ), 'Hard (Deterministic)', 8 )
+        save_snapshot( scenario, path )
+        for mmap in (False, True):
+            loaded = load_snapshot( path, mmap=mmap )
+            assert _same_costs( loaded.getCostMatrix(), scenario.getCostMatrix() )
+            assert (loaded._edge_exists == scenario._edge_exists).all()
+            assert loaded._difficulty == scenario._difficulty and loaded._rand_seed == 8
+            assert [c._elevation for c in loaded.getCities()] == \
+                   [c._elevation for c in scenario.getCities()]
+            # Rebuilding from the loaded cities gives the same matrix again
+            loaded.buildCostMatrix()
+            assert _same_costs( loaded.getCostMatrix(), scenario.getCostMatrix() )
+            del loaded
+
+        sparse = Scenario( generate_points( 300, 9 ), 'Normal', 9, neighbors=6 )
+        save_snapshot( sparse, path )
+        loaded = load_snapshot( path )
+        assert loaded.isSparse()
+        assert loaded.getCandidates().neighbors() == sparse.getCandidates().neighbors()
+        assert loaded.getCostMatrix()[3, 7] == sparse.getCostMatrix()[3, 7]
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import math
+import os
+import tempfile
+
+
+############################################################
+#
+#       Best tours found so far, by scenario and algorithm
+#
+############################################################
+
+# Type Definitions
+# ---------
+# Fingerprint :: String, from Scenario.fingerprint
+# Tour :: [Nat], city indices in visiting order
+# Entry :: (Tour, Real, Real), a tour, its cost and the time allowance it
+#          answers for
+#
+# The GUI regenerates the same scenario whenever the size, seed and
+# difficulty don't change, and fancy and linKernighan start with a greedy
+# search every time, so the same tours keep being searched for.  A
+# TSPSolver given a SolutionCache answers from it when the scenario and
+# algorithm (with the same settings) have been seen before, and the
+# improving searches start from the best tour any algorithm has found for
+# the scenario.
+#
+# Each entry answers for runs given up to its allowance: inf for a search
+# that ran to completion, the time allowance for one that always uses all
+# of it.  A run given longer isn't answered from the cache.
+#
+# Only the `capacity' most recently used entries are kept.  Given a path,
+# the cache starts with what is saved there and save() writes it back.
+class SolutionCache:
+    def __init__(self, capacity=128, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # (Fingerprint, algorithm) -> Entry, least recently used first
+        self._entries = collections.OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # get :: Scenario -> String -> Real -> Optional(Entry)
+    def get(self, scenario, algorithm, time_allowance=math.inf):
+        key = (scenario.fingerprint(), algorithm)
+        entry = self._entries.get(key)
+        if entry is None or time_allowance > entry[2]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    # Remembers a tour found with the given allowance.  An entry already
+    # there keeps the cheaper of the two tours and the longer allowance: a
+    # longer run found nothing better, or a shorter one did.
+    def put(self, scenario, algorithm, tour, cost, allowance=math.inf):
+        key = (scenario.fingerprint(), algorithm)
+        old = self._entries.get(key)
+        if old is None or cost < old[1]:
+            entry = ([int(c) for c in tour], cost, allowance)
+        else:
+            entry = old
+        if old is not None:
+            entry = (entry[0], entry[1], max(allowance, old[2]))
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    # best :: Scenario -> Optional(Entry)
+    #
+    # The cheapest tour found for the scenario by any algorithm
+    def best(self, scenario):
+        fingerprint = scenario.fingerprint()
+        found = [entry for ((f, _), entry) in self._entries.items() if f == fingerprint]
+        return min(found, key=lambda entry: entry[1]) if found else None
+
+    def clear(self):
+        self._entries.clear()
+
+    # Entries are written oldest first, so a load keeps the same order; an
+    # infinite allowance is written as null.  The file is replaced in one
+    # go, so a crash never leaves half of one.
+    def save(self, path=None):
+        path = path or self.path
+        entries = [[f, alg, tour, cost, None if allowance == math.inf else allowance]
+                   for ((f, alg), (tour, cost, allowance)) in self._entries.items()]
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            json.dump({'version': 2, 'entries': entries}, f)
+        os.replace(f.name, path)
+
+    # Files from before entries had allowances may hold the tours of runs
+    # cut short, so they're ignored
+    def load(self, path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('version') != 2:
+            return
+        for (fingerprint, alg, tour, cost, allowance) in saved['entries']:
+            self._entries[(fingerprint, alg)] = (tour, cost, math.inf if allowance is None else allowance)
+            self._entries.move_to_end((fingerprint, alg))
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+def test_solution_cache():
+    from TSPClasses import Scenario, generate_points
+    scenarios = [Scenario(generate_points(6, seed), 'Normal', seed) for seed in range(3)]
+    cache = SolutionCache(capacity=4)
+    assert cache.get(scenarios[0], 'greedy') is None
+
+    cache.put(scenarios[0], 'greedy', [0, 1, 2, 3, 4, 5], 50)
+    cache.put(scenarios[0], 'greedy', [0, 2, 1, 3, 4, 5], 60)
+    assert cache.get(scenarios[0], 'greedy') == ([0, 1, 2, 3, 4, 5], 50, math.inf)
+    cache.put(scenarios[0], 'fancy', [0, 5, 4, 3, 2, 1], 40, 10.0)
+    assert cache.best(scenarios[0]) == ([0, 5, 4, 3, 2, 1], 40, 10.0)
+    assert cache.best(scenarios[1]) is None
+
+    # A run given longer than the entry's isn't answered from it, and a
+    # longer run that finds nothing better extends the entry
+    assert cache.get(scenarios[0], 'fancy', 5.0) is not None
+    assert cache.get(scenarios[0], 'fancy', 20.0) is None
+    cache.put(scenarios[0], 'fancy', [0, 1, 2, 3, 4, 5], 45, 20.0)
+    assert cache.get(scenarios[0], 'fancy', 20.0) == ([0, 5, 4, 3, 2, 1], 40, 20.0)
+
+    # The same points and seed make the same scenario
+    again = Scenario(generate_points(6, 0), 'Normal', 0)
+    assert cache.get(again, 'greedy') == ([0, 1, 2, 3, 4, 5], 50, math.inf)
+    other = Scenario(generate_points(6, 0), 'Easy', 0)
+    assert cache.get(other, 'greedy') is None
+
+    # Using an entry keeps it; the least recently used one goes
+    cache.put(scenarios[1], 'greedy', [0, 1, 2, 3, 4, 5], 70)
+    cache.put(scenarios[2], 'greedy', [0, 1, 2, 3, 4, 5], 80)
+    cache.get(scenarios[0], 'greedy')
+    cache.put(scenarios[2], 'fancy', [0, 1, 2, 3, 4, 5], 75, 1.0)
+    assert len(cache) == 4
+    assert cache.get(scenarios[0], 'fancy', 0.0) is None
+    assert cache.get(scenarios[0], 'greedy') is not None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'cache.json')
+        cache.save(path)
+        loaded = SolutionCache(capacity=4, path=path)
+        assert list(loaded._entries.items()) == list(cache._entries.items())
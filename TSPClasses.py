@@ -1,42 +1,59 @@
 #!/usr/bin/python3
 
 
+import hashlib
 import math
 import numpy as np
 import random
 import time
+from Candidates import CandidateGraph
 
 
 
 class TSPSolution:
-    def __init__( self, listOfCities):
-        self.route = listOfCities
+    # The tour is either a list of Cities or, given the scenario, the city
+    # indices in visiting order (a list or an array), which is what the
+    # solvers have.  Either way it is kept as an array of indices; the
+    # Cities are only looked up when route is asked for.
+    def __init__( self, route, scenario=None ):
+        if scenario is None:
+            scenario = route[0]._scenario
+            self._route = list( route )
+            self.indices = np.array( [c._index for c in route], dtype=np.int64 )
+        else:
+            self._route = None
+            self.indices = np.asarray( route, dtype=np.int64 )
+        self._scenario = scenario
+        self._edge_costs = None
         self.cost = self._costOfRoute()
-        #print( [c._index for c in listOfCities] )
+
+    @property
+    def route( self ):
+        if self._route is None:
+            cities = self._scenario.getCities()
+            self._route = [cities[i] for i in self.indices.tolist()]
+        return self._route
+
+    # The cost of each edge of the tour, from route[i] to route[i+1] (and
+    # the last back to the first), gathered from the cost matrix in one go
+    def edgeCosts( self ):
+        if self._edge_costs is None:
+            costs = self._scenario.getCostMatrix()
+            self._edge_costs = np.asarray( costs[self.indices, np.roll(self.indices, -1)], dtype=float )
+        return self._edge_costs
 
     def _costOfRoute( self ):
-        cost = 0
-        last = self.route[0]
-        for city in self.route[1:]:
-            cost += last.costTo(city)
-            last = city
-        cost += self.route[-1].costTo( self.route[0] )
-        return cost
+        cost = self.edgeCosts().sum()
+        return cost if cost == np.inf or not self._scenario.integerCosts() else int(cost)
 
     def enumerateEdges( self ):
-        elist = []
-        c1 = self.route[0]
-        for c2 in self.route[1:]:
-            dist = c1.costTo( c2 )
-            if dist == np.inf:
-                return None
-            elist.append( (c1, c2, int(math.ceil(dist))) )
-            c1 = c2
-        dist = self.route[-1].costTo( self.route[0] )
-        if dist == np.inf:
+        costs = self.edgeCosts()
+        if not np.isfinite( costs ).all():
             return None
-        elist.append( (self.route[-1], self.route[0], int(math.ceil(dist))) )
-        return elist
+        route = self.route
+        if self._scenario.integerCosts():
+            costs = costs.astype( np.int64 )
+        return [(c1, c2, cost) for (c1, c2, cost) in zip( route, route[1:] + route[:1], costs.tolist() )]
 
 
 def nameForInt( num ):
@@ -48,38 +65,128 @@ def nameForInt( num ):
         return nameForInt((num-1) // 26 ) + nameForInt((num-1)%26+1)
 
 
+# The area the GUI shows; cities are placed uniformly inside it
+DEFAULT_DATA_RANGE = { 'x':[-1.5,1.5], 'y':[-1.0,1.0] }
+
+# Random city locations, as (x, y) tuples, the same ones the GUI generates
+# for a given size and seed.  This reseeds the global random module, like the
+# GUI does, so a Scenario built straight after gets the same elevations too.
+def generate_points( npoints, seed, data_range=DEFAULT_DATA_RANGE ):
+    random.seed( seed )
+
+    xr = data_range['x']
+    yr = data_range['y']
+    ptlist = []
+    while len(ptlist) < npoints:
+        x = random.uniform(0.0,1.0)
+        y = random.uniform(0.0,1.0)
+        ptlist.append( (xr[0] + (xr[1]-xr[0])*x, yr[0] + (yr[1]-yr[0])*y) )
+    return ptlist
+
+
+
 
 
 
 
 
+# City locations as an n x 2 float array, whichever form they come in
+def coordinates( city_locations ):
+    if isinstance( city_locations, np.ndarray ):
+        return city_locations.astype( float ).reshape(-1,2)
+    return np.array( [(pt.x(), pt.y()) if callable(getattr(pt, 'x', None)) else tuple(pt) \
+                      for pt in city_locations], dtype=float ).reshape(-1,2)
+
+
+# LazyCostMatrix :: the cost matrix without the matrix
+#
+# Indexes like the n x n cost matrix, costs[src, dst] with single indices
+# or arrays of them, but works each entry out from the city locations and
+# elevations when asked.  The dense matrix is built from one of these, so
+# the two always agree.  Every edge but the self-edges exists.
+class LazyCostMatrix:
+    def __init__( self, xy, elevation=None ):
+        self._xy = np.asarray( xy, dtype=float )
+        self._elevation = None if elevation is None else np.asarray( elevation, dtype=float )
+        # Plain lists make single lookups quicker than going through numpy
+        self._x = self._xy[:,0].tolist()
+        self._y = self._xy[:,1].tolist()
+        self._e = None if elevation is None else self._elevation.tolist()
+        self.shape = (len(self._x), len(self._x))
+
+    def __len__( self ):
+        return len(self._x)
+
+    def __getitem__( self, key ):
+        if isinstance( key, tuple ):
+            (src, dst) = key
+        else:
+            (src, dst) = (key, np.arange(len(self._x)))
+        try:
+            # Only single indices get through list indexing
+            (x0, y0, x1, y1) = (self._x[src], self._y[src], self._x[dst], self._y[dst])
+        except TypeError:
+            return self._lookup( np.asarray( src ), np.asarray( dst ) )
+
+        if src == dst:
+            return np.inf
+        cost = math.sqrt( (x1-x0)**2 + (y1-y0)**2 )
+        if self._e is not None:
+            cost = max( cost + (self._e[dst]-self._e[src]), 0.0 )
+        return float( math.ceil( cost * City.MAP_SCALE ) )
+
+    def _lookup( self, src, dst ):
+        x = self._xy[:,0]
+        y = self._xy[:,1]
+        cost = np.sqrt( (x[dst] - x[src])**2 + (y[dst] - y[src])**2 )
+        if self._elevation is not None:
+            cost += self._elevation[dst] - self._elevation[src]
+            np.maximum( cost, 0.0, out=cost )
+        cost = np.ceil( cost * City.MAP_SCALE )
+        cost[np.broadcast_to( src == dst, cost.shape )] = np.inf
+        return cost
+
 
 class Scenario:
 
     HARD_MODE_FRACTION_TO_REMOVE = 0.20 # Remove 20% of the edges
 
-    def __init__( self, city_locations, difficulty, rand_seed ):
+    # city_locations are (x, y) pairs: a list of tuples, an n x 2 array, or
+    # points with x() and y() methods (such as QPointFs).
+    #
+    # With neighbors=k the scenario is sparse: there is no n x n matrix, only
+    # each city's k nearest neighbours as candidate edges (getCandidates) and
+    # a LazyCostMatrix for everything else, so it scales to 100k+ cities.
+    # Hard modes need a matrix of which edges exist, so they can't be sparse.
+    def __init__( self, city_locations, difficulty, rand_seed, neighbors=None ):
+        if neighbors is not None and difficulty in ("Hard", "Hard (Deterministic)"):
+            raise ValueError( "{} scenarios can't be sparse; their missing edges need the full matrix".format(difficulty) )
         self._difficulty = difficulty
+        self._rand_seed = rand_seed
+        self._fingerprint = None
+        self._coordinates = None
+        locations = coordinates( city_locations ).tolist()
 
         if difficulty == "Normal" or difficulty == "Hard":
-            self._cities = [City( pt.x(), pt.y(), \
+            self._cities = [City( x, y, \
                                   random.uniform(0.0,1.0) \
-                                ) for pt in city_locations]
+                                ) for (x, y) in locations]
         elif difficulty == "Hard (Deterministic)":
             random.seed( rand_seed )
-            self._cities = [City( pt.x(), pt.y(), \
+            self._cities = [City( x, y, \
                                   random.uniform(0.0,1.0) \
-                                ) for pt in city_locations]
+                                ) for (x, y) in locations]
         else:
-            self._cities = [City( pt.x(), pt.y() ) for pt in city_locations]
+            self._cities = [City( x, y ) for (x, y) in locations]
 
+        self._nameCities()
 
-        num = 0
-        for city in self._cities:
-            #if difficulty == "Hard":
-            city.setScenario(self)
-            city.setIndexAndName( num, nameForInt( num+1 ) )
-            num += 1
+        self._candidates = None
+        if neighbors is not None:
+            self._edge_exists = None
+            self._cost_matrix = self.lazyCosts()
+            self._candidates = CandidateGraph.build( self._cost_matrix._xy, self._cost_matrix, neighbors )
+            return
 
         # Assume all edges exists except self-edges
         ncities = len(self._cities)
@@ -90,51 +197,158 @@ class Scenario:
         elif difficulty == "Hard (Deterministic)":
             self.thinEdges(deterministic=True)
 
-    # Set up distances manually
+        self.buildCostMatrix()
+
+    # fromArrays :: Coordinates -> String -> ... -> Scenario
+    #
+    # A scenario put together from arrays saved earlier (see ScenarioIO),
+    # without generating elevations or recomputing any costs.  A dense
+    # scenario needs its cost_matrix; edge_exists defaults to its finite
+    # entries.  A sparse one gives its CandidateGraph instead and gets a
+    # LazyCostMatrix over the locations and elevations.
+    @classmethod
+    def fromArrays( cls, xy, difficulty, elevation=None, edge_exists=None, cost_matrix=None, \
+                    candidates=None, rand_seed=None ):
+        if (cost_matrix is None) == (candidates is None):
+            raise ValueError( "a scenario needs either a cost matrix or candidate edges" )
+        self = cls.__new__( cls )
+        self._difficulty = difficulty
+        self._rand_seed = rand_seed
+        self._fingerprint = None
+        self._coordinates = None
+        locations = coordinates( xy ).tolist()
+        if elevation is None:
+            self._cities = [City( x, y ) for (x, y) in locations]
+        else:
+            self._cities = [City( x, y, e ) for ((x, y), e) in zip( locations, np.asarray( elevation, dtype=float ).tolist() )]
+        self._nameCities()
+
+        self._candidates = candidates
+        if candidates is not None:
+            self._edge_exists = None
+            self._cost_matrix = self.lazyCosts()
+        else:
+            self._cost_matrix = cost_matrix
+            self._edge_exists = np.isfinite( cost_matrix ) if edge_exists is None else edge_exists
+        return self
+
+    def _nameCities( self ):
+        num = 0
+        for city in self._cities:
+            #if difficulty == "Hard":
+            city.setScenario(self)
+            city.setIndexAndName( num, nameForInt( num+1 ) )
+            num += 1
+
+    # Set up distances manually.  They're kept as given, fractions and all;
+    # only the self-edges are made inf, as in a generated scenario.
     def setup_test( self, distances ):
         self._manual_distance = distances
         self._difficulty = 'Test'
+        self._cost_matrix = np.array( distances, dtype=float )
+        np.fill_diagonal( self._cost_matrix, np.inf )
+        self._fingerprint = None
+
+    # Generated (and loaded) scenarios' costs are whole numbers, so tour
+    # costs come out as ints; a Test scenario's are the distances given
+    def integerCosts( self ):
+        return self._difficulty != 'Test'
 
     def getCities( self ):
         return self._cities
 
+    # The city locations as an n x 2 array, by city index
+    def getCoordinates( self ):
+        if self._coordinates is None:
+            self._coordinates = np.array( [(c._x, c._y) for c in self._cities], dtype=float ).reshape(-1,2)
+        return self._coordinates
+
+    ''' <summary>
+        The n x n matrix of edge costs, indexed by city index.  Entries are the
+        ceil'd, MAP_SCALE'd integers that costTo returns, stored as floats so
+        that missing edges (and self-edges) can be np.inf.
+        </summary> '''
+    def getCostMatrix( self ):
+        return self._cost_matrix
+
+    # A hash of everything the costs come from: the difficulty, the city
+    # locations and elevations, and which edges exist (or, when sparse, the
+    # candidate edges).  Costs that don't come from the map (test and
+    # TSPLIB scenarios) are hashed themselves.  Worked out once; changing
+    # the scenario goes through buildCostMatrix or setup_test, which forget it.
+    GENERATED_DIFFICULTIES = ( "Easy", "Normal", "Hard", "Hard (Deterministic)" )
+    def fingerprint( self ):
+        if self._fingerprint is None:
+            h = hashlib.blake2b( digest_size=16 )
+            h.update( self._difficulty.encode() )
+            h.update( np.array( [(c._x, c._y, c._elevation) for c in self._cities], dtype=float ).tobytes() )
+            if self.isSparse():
+                h.update( np.asarray( self._candidates.indptr, dtype=np.int64 ).tobytes() )
+                h.update( np.asarray( self._candidates.indices, dtype=np.int64 ).tobytes() )
+            elif self._difficulty in self.GENERATED_DIFFICULTIES:
+                h.update( np.packbits( self._edge_exists, axis=None ).tobytes() )
+            else:
+                h.update( np.ascontiguousarray( self._cost_matrix, dtype=float ).tobytes() )
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def isSparse( self ):
+        return self._candidates is not None
+
+    # The CandidateGraph of a sparse scenario (None for a dense one)
+    def getCandidates( self ):
+        return self._candidates
+
+    # Costs worked out from the cities on demand, ignoring missing edges
+    def lazyCosts( self ):
+        xy = self.getCoordinates()
+
+        # For Medium and Hard modes, add in an asymmetric cost (in easy mode it is zero).
+        elev = None
+        if not self._difficulty == 'Easy':
+            elev = np.array( [c._elevation for c in self._cities], dtype=float )
+        return LazyCostMatrix( xy, elev )
+
+    # Recompute the cost matrix; call this after changing _edge_exists by hand
+    def buildCostMatrix( self ):
+        ncities = len(self._cities)
+        everyone = np.arange( ncities )
+
+        # Rows are the source city, columns the destination
+        cost = self.lazyCosts()[everyone[:,np.newaxis], everyone[np.newaxis,:]]
+
+        # Use this in all difficulties, it ensures INF for self-edge
+        cost[~self._edge_exists] = np.inf
+        self._cost_matrix = cost
+        self._fingerprint = None
 
-    def randperm( self, n ):                #isn't there a numpy function that does this and even gets called in Solver?
-        perm = np.arange(n)
-        for i in range(n):
-            randind = random.randint(i,n-1)
-            save = perm[i]
-            perm[i] = perm[randind]
-            perm[randind] = save
-        return perm
 
+    def randperm( self, n, rng=None ):
+        if rng is None:
+            rng = np.random.default_rng()
+        return rng.permutation( n )
+
+    # Removes HARD_MODE_FRACTION_TO_REMOVE of the edges, chosen uniformly
+    # from all but the edges of one random tour, which are kept so that a
+    # tour always exists.  The edges to remove are drawn in one go; in
+    # deterministic mode they come from a Generator seeded with the
+    # scenario's seed, so the same seed always thins the same edges.
     def thinEdges( self, deterministic=False ):
         ncities = len(self._cities)
         edge_count = ncities*(ncities-1) # can't have self-edge
-        num_to_remove = np.floor(self.HARD_MODE_FRACTION_TO_REMOVE*edge_count)
+        num_to_remove = int(np.floor(self.HARD_MODE_FRACTION_TO_REMOVE*edge_count))
+
+        rng = np.random.default_rng( self._rand_seed if deterministic else None )
 
         can_delete  = self._edge_exists.copy()
 
         # Set aside a route to ensure at least one tour exists
-        route_keep = np.random.permutation( ncities )
-        if deterministic:
-            route_keep = self.randperm( ncities )
-        for i in range(ncities):
-            can_delete[route_keep[i],route_keep[(i+1)%ncities]] = False
-
-        # Now remove edges until 
-        while num_to_remove > 0:
-            if deterministic:
-                src = random.randint(0,ncities-1)
-                dst = random.randint(0,ncities-1)
-            else:
-                src = np.random.randint(ncities)
-                dst = np.random.randint(ncities)
-            if self._edge_exists[src,dst] and can_delete[src,dst]:
-                self._edge_exists[src,dst] = False
-                num_to_remove -= 1
-
+        route_keep = self.randperm( ncities, rng )
+        can_delete[route_keep, np.roll(route_keep, -1)] = False
 
+        candidates = np.flatnonzero( can_delete )
+        remove = rng.choice( candidates, size=min(num_to_remove, len(candidates)), replace=False )
+        self._edge_exists.flat[remove] = False
 
 
 class City:
@@ -164,27 +378,68 @@ class City:
         </summary> '''
     MAP_SCALE = 1000.0
     def costTo( self, other_city ):
-
-        assert( type(other_city) == City )
-
-        if self._scenario._difficulty == 'Test':
-            return self._scenario._manual_distance[self._index][other_city._index]
-
-        # In hard mode, remove edges; this slows down the calculation...
-        # Use this in all difficulties, it ensures INF for self-edge
-        if not self._scenario._edge_exists[self._index, other_city._index]:
-            return np.inf
-
-        # Euclidean Distance
-        cost = math.sqrt( (other_city._x - self._x)**2 +
-                          (other_city._y - self._y)**2 )
-
-        # For Medium and Hard modes, add in an asymmetric cost (in easy mode it is zero).
-        if not self._scenario._difficulty == 'Easy':
-            cost += (other_city._elevation - self._elevation)
-            if cost < 0.0:
-                cost = 0.0                  # Shouldn't it cost something to go downhill, no matter how steep??????
-
-
-        return int(math.ceil(cost * self.MAP_SCALE))
-
+        # Costs are precomputed once by Scenario.buildCostMatrix
+        cost = self._scenario._cost_matrix[self._index, other_city._index]
+        if cost == np.inf or not self._scenario.integerCosts():
+            return float(cost)
+        return int(cost)
+
+
+def test_thin_edges():
+    points = generate_points( 60, 3 )
+    hard = Scenario( points, "Hard (Deterministic)", 3 )
+    ncities = len(points)
+    removed = ncities*(ncities-1) - hard._edge_exists.sum()
+    assert removed == int(np.floor(Scenario.HARD_MODE_FRACTION_TO_REMOVE*ncities*(ncities-1)))
+    assert not hard._edge_exists.diagonal().any()
+
+    # The same seed thins the same edges; another seed doesn't
+    again = Scenario( points, "Hard (Deterministic)", 3 )
+    assert (again._edge_exists == hard._edge_exists).all()
+    other = Scenario( points, "Hard (Deterministic)", 4 )
+    assert (other._edge_exists != hard._edge_exists).any()
+
+    # There is always a tour left
+    from HeldKarp import held_karp
+    for seed in range(5):
+        small = Scenario( generate_points( 9, seed ), "Hard", seed )
+        assert held_karp( small.getCostMatrix() ) is not None
+
+
+def test_solution_from_indices():
+    rand = np.random.RandomState( 6 )
+    # Normal mode tours all exist; random Hard mode ones almost never do
+    for difficulty in ("Normal", "Hard (Deterministic)"):
+        scenario = Scenario( generate_points( 30, 6 ), difficulty, 6 )
+        cities = scenario.getCities()
+        costs = scenario.getCostMatrix()
+        for _ in range( 10 ):
+            order = rand.permutation( 30 )
+            by_index = TSPSolution( order, scenario )
+            by_city = TSPSolution( [cities[i] for i in order] )
+            assert by_index.cost == by_city.cost
+            assert by_index._route is None
+            assert by_index.route == by_city.route
+            assert (by_index.indices == order).all()
+
+            edges = by_index.enumerateEdges()
+            if by_index.cost == np.inf:
+                assert edges is None
+            else:
+                assert [(a._index, b._index) for (a, b, _) in edges] == \
+                       list( zip( order.tolist(), np.roll( order, -1 ).tolist() ) )
+                assert [c for (_, _, c) in edges] == [int( costs[a._index, b._index] ) for (a, b, _) in edges]
+                assert sum( c for (_, _, c) in edges ) == by_index.cost
+
+
+def test_setup_test_costs():
+    scenario = Scenario( [(0, 0), (1, 0), (1, 1)], 'Test', 0 )
+    scenario.setup_test( [[0, 1.5, 2.25], [1.5, 0, 1.0], [2.25, 1.0, 0]] )
+    cities = scenario.getCities()
+
+    # Manual distances aren't rounded, and self-edges don't exist
+    assert cities[0].costTo( cities[2] ) == 2.25
+    assert cities[1].costTo( cities[1] ) == np.inf
+    solution = TSPSolution( [0, 1, 2], scenario )
+    assert solution.cost == 4.75
+    assert [c for (_, _, c) in solution.enumerateEdges()] == [1.5, 1.0, 2.25]
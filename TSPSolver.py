@@ -1,31 +1,197 @@
 #!/usr/bin/python3
 
 from types import BuiltinFunctionType
-from which_pyqt import PYQT_VER
 
-if PYQT_VER == 'PYQT5':
-    from PyQt5.QtCore import QLineF, QPointF
-elif PYQT_VER == 'PYQT4':
-    from PyQt4.QtCore import QLineF, QPointF
-else:
-    raise Exception('Unsupported Version of PyQt: {}'.format(PYQT_VER))
-
-import copy
 import time
 import numpy as np
 from Instrumenter import *
 from TSPClasses import *
+from LocalSearch import LocalSearch
+from LinKernighan import LinKernighan
+from HeldKarp import HELD_KARP_MAX_BYTES, held_karp, held_karp_bytes
+import collections
+import functools
 import heapq
+import inspect
 import itertools
+import json
+import multiprocessing
+import pickle
+import queue
+import tempfile
+import threading
+
+
+# Entry points wrapped in this answer from the solver's SolutionCache, if
+# it has one, when the scenario has been solved before by the same
+# algorithm with the same settings and no more time than this, and
+# remember the tour they find otherwise.  A cached answer is passed to
+# on_solution like a newly found tour.
+#
+# Only runs that weren't stopped are remembered.  An anytime search (one
+# that always uses all its time) answers for runs given up to its time
+# allowance; any other search has to finish within the allowance, and an
+# exact one has to prove its tour optimal (by not dropping any states), and
+# then answers whatever the allowance.
+def cached_solutions(exact=False, anytime=False):
+    def wrap(entry_point):
+        signature = inspect.signature(entry_point)
+
+        @functools.wraps(entry_point)
+        def run(self, time_allowance=60.0, *args, **kwargs):
+            if self._cache is None:
+                return entry_point(self, time_allowance, *args, **kwargs)
+            start_time = time.time()
+            params = signature.bind(self, time_allowance, *args, **kwargs)
+            params.apply_defaults()
+            params = params.arguments
+            algorithm = cache_key(entry_point.__name__, signature, params)
+
+            hit = self._cache.get(self._scenario, algorithm, time_allowance)
+            if hit is not None:
+                return self._cached_results(hit[0], start_time, params['on_solution'])
+            results = entry_point(self, time_allowance, *args, **kwargs)
+
+            stopped = params['stop_event'] is not None and params['stop_event'].is_set()
+            if results['soln'] is None or results['cost'] == float('inf') or stopped:
+                return results
+            if anytime:
+                self._cache.put(self._scenario, algorithm, results['soln'].indices, results['cost'],
+                                time_allowance)
+            elif results['time'] < time_allowance and not (exact and results.get('dropped', 0)):
+                self._cache.put(self._scenario, algorithm, results['soln'].indices, results['cost'])
+            return results
+        return run
+    return wrap
+
+
+# cache_key :: String -> Signature -> {String: Any} -> String
+#
+# The name an entry point's results are cached under: the algorithm, and
+# any settings that can change them that aren't the defaults, e.g.
+# "fancy(tabu_tenure=3)"
+def cache_key(algorithm, signature, params):
+    settings = ['{}={!r}'.format(name, value) for (name, value) in params.items()
+                if name not in ('self', 'time_allowance', 'on_solution', 'stop_event') and
+                repr(value) != repr(signature.parameters[name].default)]
+    return '{}({})'.format(algorithm, ', '.join(settings)) if settings else algorithm
 
 
 class TSPSolver:
-    def __init__(self, gui_view):
+    def __init__(self, gui_view, cache=None):
         self._scenario = None
+        # An optional SolutionCache shared by every scenario this solves
+        self._cache = cache
 
     def setupWithScenario(self, scenario):
         self._scenario = scenario
 
+    # The exact searches work on the full cost matrix, which a sparse
+    # scenario doesn't have
+    def _require_dense(self, algorithm):
+        if self._scenario.isSparse():
+            raise ValueError("{} needs the full cost matrix; it can't run on a sparse scenario"
+                             .format(algorithm))
+
+    # Every entry point's results dictionary has the run's Instrumenter, as
+    # Instrumenter.to_dict, under 'instrumentation': counters, phase times,
+    # rates and a time series of the queue size, bssf and lower bound.
+    #
+    # Every entry point takes an optional on_solution hook, which it calls
+    # with better tours as the search finds them, at most one every
+    # Instrumenter.REPORT_INTERVAL seconds and always the final best:
+    #   {'cost': ..., 'soln': TSPSolution, 'time': seconds until it was found,
+    #    'stats': the Instrumenter counters when it was sent}
+    # and an optional stop_event (a threading.Event); setting it from another
+    # thread makes the search wind up as if its time had run out.
+    # Tours come out of the searches as city indices; this wraps the hook
+    # to turn them into TSPSolutions and to pass on only tours that beat
+    # every one before.
+    def _solution_stream(self, on_solution):
+        if on_solution is None:
+            return None
+        best = [float('inf')]
+
+        def stream(update):
+            if not update['cost'] < best[0]:
+                return
+            soln = TSPSolution(update['tour'], self._scenario)
+            if soln.cost < best[0]:
+                best[0] = soln.cost
+                on_solution({'cost': soln.cost,
+                             'soln': soln,
+                             'time': update['time'],
+                             'stats': update['stats']})
+        return stream
+
+    # cached_solutions' results dictionary for a tour out of the cache
+    def _cached_results(self, tour, start_time, on_solution):
+        inst = Instrumenter(self._solution_stream(on_solution))
+        soln = TSPSolution(tour, self._scenario)
+        inst.report_solution(soln.cost, tour)
+        inst.flush()
+        return {'cost': soln.cost,
+                'time': time.time() - start_time,
+                'count': 0,
+                'soln': soln,
+                'max': None,
+                'total': None,
+                'pruned': None,
+                'cached': True,
+                'instrumentation': inst.to_dict()}
+
+    # The cheapest tour the cache has for this scenario, from any algorithm
+    def _warm_start(self):
+        if self._cache is None:
+            return None
+        best = self._cache.best(self._scenario)
+        return None if best is None else best[0]
+
+    ''' <summary>
+        Runs the named entry point on a background thread and yields each better
+        tour it finds, as the on_solution updates described above, while it is
+        still searching.  A caller that needs an answer by some deadline can keep
+        the latest update and stop iterating.  Any other keyword arguments go to
+        the entry point.  Closing the generator early stops the search.  If the
+        search raises, the exception is raised again here after the last update.
+        </summary>
+        <returns>once the search is over, the entry point's results dictionary
+        (as the generator's return value)</returns>
+    '''
+
+    def solutions(self, algorithm='fancy', time_allowance=60.0, **kwargs):
+        updates = queue.Queue()
+        stop = threading.Event()
+        done = object()
+        results = {}
+        # What the search raised, if anything, to be raised again here
+        failure = []
+
+        def search():
+            try:
+                results.update(getattr(self, algorithm)(time_allowance=time_allowance,
+                                                        on_solution=updates.put, stop_event=stop,
+                                                        **kwargs))
+            except BaseException as err:
+                failure.append(err)
+            finally:
+                updates.put(done)
+
+        thread = threading.Thread(target=search, daemon=True)
+        thread.start()
+        try:
+            while True:
+                update = updates.get()
+                if update is done:
+                    break
+                yield update
+        finally:
+            stop.set()
+        thread.join()
+        if failure:
+            raise failure[0]
+        return results
+
     ''' <summary>
         This is the entry point for the default solver
         which just finds a valid random tour.  Note this could be used to find your
@@ -37,7 +203,8 @@ class TSPSolver:
         algorithm</returns> 
     '''
 
-    def defaultRandomTour(self, time_allowance=60.0):
+    def defaultRandomTour(self, time_allowance=60.0, on_solution=None, stop_event=None):
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
         results = {}
         cities = self._scenario.getCities()
         ncities = len(cities)
@@ -45,18 +212,17 @@ class TSPSolver:
         count = 0
         bssf = None
         start_time = time.time()
-        while not foundTour and time.time() - start_time < time_allowance:
-            # create a random permutation
-            perm = np.random.permutation(ncities)
-            route = []
-            # Now build the route using the random permutation
-            for i in range(ncities):
-                route.append(cities[perm[i]])
-            bssf = TSPSolution(route)
-            count += 1
-            if bssf.cost < np.inf:
-                # Found a valid route
-                foundTour = True
+        with inst.phase('search'):
+            while not foundTour and time.time() - start_time < time_allowance and not inst.stopped():
+                # create a random permutation
+                perm = np.random.permutation(ncities)
+                bssf = TSPSolution(perm, self._scenario)
+                count += 1
+                if bssf.cost < np.inf:
+                    # Found a valid route
+                    foundTour = True
+                    inst.report_solution(bssf.cost, perm)
+        inst.flush()
         end_time = time.time()
         results['cost'] = bssf.cost if foundTour else math.inf
         results['time'] = end_time - start_time
@@ -65,6 +231,7 @@ class TSPSolver:
         results['max'] = None
         results['total'] = None
         results['pruned'] = None
+        results['instrumentation'] = inst.to_dict()
         return results
 
     ''' <summary>
@@ -79,26 +246,35 @@ class TSPSolver:
         algorithm</returns> 
     '''
 
-    def greedy(self, time_allowance=60.0):
-        inst = Instrumenter()
+    @cached_solutions()
+    def greedy(self, time_allowance=60.0, on_solution=None, stop_event=None):
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
         cities = self._scenario.getCities()
         cities.sort(key=lambda c: c._index)
 
         start_time = time.time()
-        start_state = bb_init_state(cities, cities[0])
 
-        final_state = dfs_greedy(cities, start_state, inst)
+        with inst.phase('greedy'):
+            if self._scenario.isSparse():
+                tour = candidate_greedy_tour(self._scenario.getCostMatrix(), self._scenario.getCandidates(),
+                                             cities[0]._index, inst, start_time + time_allowance)
+            else:
+                tour = greedy_tour(self._scenario.getCostMatrix(), [cities[0]._index], inst,
+                                   start_time + time_allowance)
 
+        inst.flush()
         end_time = time.time()
 
-        if not (final_state is None):
-            return {'cost': get_cost_fp(state_path(final_state)),
+        if not (tour is None):
+            soln = TSPSolution(tour, self._scenario)
+            return {'cost': soln.cost,
                     'time': end_time - start_time,
                     'count': inst.solutions_found,
-                    'soln': TSPSolution(state_path(final_state)),
+                    'soln': soln,
                     'max': inst.max_queue,
                     'total': inst.states_created,
-                    'pruned': inst.states_pruned }
+                    'pruned': inst.states_pruned,
+                    'instrumentation': inst.to_dict()}
         else:
             return {'cost': float('inf'),
                     'time': end_time - start_time,
@@ -106,7 +282,62 @@ class TSPSolver:
                     'soln': None,
                     'max': inst.max_queue,
                     'total': inst.states_created,
-                    'pruned': inst.states_pruned }
+                    'pruned': inst.states_pruned,
+                    'instrumentation': inst.to_dict()}
+
+    ''' <summary>
+        Runs the greedy search from many start cities at once in a pool of worker
+        processes (one per core by default) and keeps the best tour.  starts is
+        either a list of start city indices, a number of start cities to sample at
+        random (city 0 is always included), or None for every city.
+        </summary>
+        <returns>results dictionary like greedy's, except that count is the number of
+        starts that completed within the time allowance.</returns> 
+    '''
+
+    @cached_solutions()
+    def multiStartGreedy(self, time_allowance=60.0, starts=None, workers=None, on_solution=None,
+                         stop_event=None):
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
+        cities = self._scenario.getCities()
+        cities.sort(key=lambda c: c._index)
+        ncities = len(cities)
+
+        if starts is None:
+            starts = list(range(ncities))
+        elif isinstance(starts, int):
+            sampled = np.random.permutation(np.arange(1, ncities))[:max(0, starts - 1)]
+            starts = [0] + sampled.tolist()
+
+        start_time = time.time()
+
+        with inst.phase('greedy'):
+            (tour, completed) = multi_start_greedy(self._scenario.getCostMatrix(), starts, inst,
+                                                   start_time + time_allowance, workers,
+                                                   self._scenario.getCandidates())
+
+        inst.flush()
+        end_time = time.time()
+
+        if not (tour is None):
+            soln = TSPSolution(tour, self._scenario)
+            return {'cost': soln.cost,
+                    'time': end_time - start_time,
+                    'count': completed,
+                    'soln': soln,
+                    'max': inst.max_queue,
+                    'total': inst.states_created,
+                    'pruned': inst.states_pruned,
+                    'instrumentation': inst.to_dict()}
+        else:
+            return {'cost': float('inf'),
+                    'time': end_time - start_time,
+                    'count': completed,
+                    'soln': None,
+                    'max': inst.max_queue,
+                    'total': inst.states_created,
+                    'pruned': inst.states_pruned,
+                    'instrumentation': inst.to_dict()}
 
     ''' <summary>
         This is the entry point for the branch-and-bound algorithm that you will implement
@@ -114,26 +345,37 @@ class TSPSolver:
         <returns>results dictionary for GUI that contains three ints: cost of best solution, 
         time spent to find best solution, total number solutions found during search (does
         not include the initial BSSF), the best solution found, and three more ints: 
-        max queue size, total number of states created, and number of pruned states.</returns> 
+        max queue size, total number of states created, and number of pruned states.
+        Passing max_frontier_bytes bounds the memory used by the queue; overflow says
+        whether states past that bound are 'drop'ped (reported as 'dropped') or
+        'spill'ed to disk.</returns> 
     '''
 
-    def branchAndBound(self, time_allowance=60.0):
-        inst = Instrumenter()
+    @cached_solutions(exact=True)
+    def branchAndBound(self, time_allowance=60.0, max_frontier_bytes=None, overflow='drop',
+                       on_solution=None, stop_event=None):
+        self._require_dense('branchAndBound')
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
 
         start_time = time.time()
 
-        final_state = strat_bb(self._scenario.getCities(), time_allowance, inst)
+        final_state = strat_bb(self._scenario.getCities(), time_allowance, inst,
+                               max_frontier_bytes, overflow, self._warm_start())
 
+        inst.flush()
         end_time = time.time()
 
         if not (final_state is None):
-            return {'cost': get_cost_fp(state_path(final_state)),
+            soln = TSPSolution([c._index for c in state_path(final_state)], self._scenario)
+            return {'cost': soln.cost,
                     'time': end_time - start_time,
                     'count': inst.solutions_found,
-                    'soln': TSPSolution(state_path(final_state)),
+                    'soln': soln,
                     'max': inst.max_queue,
                     'total': inst.states_created,
-                    'pruned': inst.states_pruned}
+                    'pruned': inst.states_pruned,
+                    'dropped': inst.states_dropped,
+                    'instrumentation': inst.to_dict()}
         else:
             return {'cost': float('inf'),
                     'time': end_time - start_time,
@@ -141,56 +383,188 @@ class TSPSolver:
                     'soln': None,
                     'max': inst.max_queue,
                     'total': inst.states_created,
-                    'pruned': inst.states_pruned}
+                    'pruned': inst.states_pruned,
+                    'dropped': inst.states_dropped,
+                    'instrumentation': inst.to_dict()}
 
     ''' <summary>
-        This is the entry point for the algorithm you'll write for your group project.
+        Branch-and-bound split across a pool of worker processes (one per core by
+        default).  Each worker searches its own subtrees and they all prune against
+        the best cost found by any of them.
         </summary>
-        <returns>results dictionary for GUI that contains three ints: cost of best solution, 
-        time spent to find best solution, total number of solutions found during search, the 
-        best solution found.  You may use the other three field however you like.
-        algorithm</returns> 
+        <returns>results dictionary like branchAndBound's; the max/total/pruned counts
+        are summed over the workers, and 'workers' holds each worker's own counts.</returns> 
     '''
 
-    def fancy(self, time_allowance=60.0):
-        inst = Instrumenter()
+    @cached_solutions(exact=True)
+    def parallelBranchAndBound(self, time_allowance=60.0, workers=None, max_frontier_bytes=None,
+                               overflow='drop', on_solution=None, stop_event=None):
+        self._require_dense('parallelBranchAndBound')
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
 
         start_time = time.time()
-        cities = self._scenario.getCities()
-        ncities = len(cities)
 
-        city_dict = {}
-        index_dict = {}
-        start_indices = []
-        final_cities = []
+        (final_state, worker_insts) = strat_bb_parallel(self._scenario.getCities(), time_allowance, inst,
+                                                        workers, max_frontier_bytes, overflow,
+                                                        self._warm_start())
 
-        print("populating dictionaries")
-        for i in range(ncities):
-            city_dict[cities[i]] = i
-            index_dict[i] = cities[i]
+        inst.flush()
+        end_time = time.time()
 
-        print("getting greedy solution")
-        start_bssf = self.greedy().get('soln').route
+        worker_counts = [wi.snapshot() for wi in worker_insts]
 
-        print("converting to integers")
-        for city in start_bssf:
-            start_indices.append(city_dict[city])
+        if not (final_state is None):
+            soln = TSPSolution([c._index for c in state_path(final_state)], self._scenario)
+            return {'cost': soln.cost,
+                    'time': end_time - start_time,
+                    'count': inst.solutions_found,
+                    'soln': soln,
+                    'max': inst.max_queue,
+                    'total': inst.states_created,
+                    'pruned': inst.states_pruned,
+                    'dropped': inst.states_dropped,
+                    'workers': worker_counts,
+                    'instrumentation': inst.to_dict()}
+        else:
+            return {'cost': float('inf'),
+                    'time': end_time - start_time,
+                    'count': inst.solutions_found,
+                    'soln': None,
+                    'max': inst.max_queue,
+                    'total': inst.states_created,
+                    'pruned': inst.states_pruned,
+                    'dropped': inst.states_dropped,
+                    'workers': worker_counts,
+                    'instrumentation': inst.to_dict()}
+
+    ''' <summary>
+        Exact solver by Held-Karp dynamic programming over subsets of visited cities.
+        Takes O(2^n n^2) time and O(2^n n) memory no matter how the costs fall, so it's
+        only for small instances (up to about 20 cities); the memory needed is checked
+        against max_bytes before anything is allocated, and when it's more the results
+        have no tour and say so under 'error'.
+        </summary>
+        <returns>results dictionary for GUI that contains three ints: cost of the optimal
+        tour, time spent to find it, number of solutions found, the optimal tour, the number
+        of subset/end city states computed, and two null values for fields not used for this
+        algorithm</returns>
+    '''
+
+    @cached_solutions(exact=True)
+    def heldKarp(self, time_allowance=60.0, max_bytes=HELD_KARP_MAX_BYTES, on_solution=None,
+                 stop_event=None):
+        self._require_dense('heldKarp')
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
 
-        final_state, path_cost = tabu_search(self._scenario.getCities(), time_allowance, inst, start_indices)
+        start_time = time.time()
 
-        for index in final_state:
-            final_cities.append(index_dict[index])
+        # Too many cities for the tables to fit in max_bytes isn't tried; the
+        # results say why there's no tour
+        ncities = len(self._scenario.getCities())
+        if max_bytes is not None and held_karp_bytes(ncities) > max_bytes:
+            return {'cost': float('inf'),
+                    'time': time.time() - start_time,
+                    'count': 0,
+                    'soln': None,
+                    'max': None,
+                    'total': 0,
+                    'pruned': None,
+                    'instrumentation': inst.to_dict(),
+                    'error': "Held-Karp needs about {:,} MB for {} cities, more than the {:,} MB allowed"
+                             .format(held_karp_bytes(ncities) >> 20, ncities, max_bytes >> 20)}
 
+        with inst.phase('search'):
+            result = held_karp(self._scenario.getCostMatrix(), inst,
+                               start_time + time_allowance, max_bytes)
+
+        inst.flush()
+        end_time = time.time()
+
+        if not (result is None):
+            soln = TSPSolution(result[0], self._scenario)
+            return {'cost': soln.cost,
+                    'time': end_time - start_time,
+                    'count': inst.solutions_found,
+                    'soln': soln,
+                    'max': None,
+                    'total': inst.states_created,
+                    'pruned': None,
+                    'instrumentation': inst.to_dict()}
+        else:
+            return {'cost': float('inf'),
+                    'time': end_time - start_time,
+                    'count': inst.solutions_found,
+                    'soln': None,
+                    'max': None,
+                    'total': inst.states_created,
+                    'pruned': None,
+                    'instrumentation': inst.to_dict()}
+
+    ''' <summary>
+        This is the entry point for the algorithm you'll write for your group project.
+        </summary>
+        <returns>results dictionary for GUI that contains three ints: cost of best solution, 
+        time spent to find best solution, total number of solutions found during search, the 
+        best solution found.  You may use the other three field however you like.
+        algorithm</returns> 
+        tabu_tenure is how many recent tours the tabu search remembers.
+        The greedy tour is first taken to a 2-opt/Or-opt local optimum, and the
+        tabu search gets whatever time is left after that, on scenarios of up to
+        TABU_MAX_CITIES cities.
+    '''
+
+    @cached_solutions(anytime=True)
+    def fancy(self, time_allowance=60.0, tabu_tenure=None, on_solution=None, stop_event=None):
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
+
+        start_time = time.time()
+
+        # Start from the best tour found for this scenario before, if there
+        # is one; otherwise from a greedy tour.  This runs in-process: fancy
+        # is often called from a thread, which a pool mustn't be forked from.
+        start_indices = self._warm_start()
+        if start_indices is None:
+            print("getting greedy solution")
+            with inst.phase('greedy'):
+                start_bssf = self.greedy(time_allowance, on_solution=on_solution, stop_event=stop_event)['soln']
+            start_indices = None if start_bssf is None else start_bssf.indices.tolist()
+
+        # With no tour to start from (time ran out, or the search was
+        # stopped, first) there is nothing to improve
+        final_state = start_indices
+        if start_indices is not None:
+            costs = self._scenario.getCostMatrix()
+            candidates = self._scenario.getCandidates()
+            remaining = time_allowance - (time.time() - start_time)
+            with inst.phase('matrix'):
+                neighbors = None if candidates is None else candidates.neighbors()
+                local = LocalSearch(costs, neighbors)
+            with inst.phase('local search'):
+                final_state, _ = local.run(start_indices, remaining, inst)
+
+            # Local search has had all the time so far.  Tabu search keeps the
+            # whole matrix as lists, so a sparse or big scenario stops at the
+            # local optimum
+            if candidates is None and len(final_state) <= TABU_MAX_CITIES:
+                with inst.phase('matrix'):
+                    search = TabuSearch(costs, tabu_tenure or tabu_limit)
+                remaining = time_allowance - (time.time() - start_time)
+                with inst.phase('tabu search'):
+                    final_state, path_cost = search.run(final_state, remaining, inst)
+
+        inst.flush()
         end_time = time.time()
 
         if not (final_state is None):
-            return {'cost': path_cost,
+            soln = TSPSolution(final_state, self._scenario)
+            return {'cost': soln.cost,
                     'time': end_time - start_time,
                     'count': inst.solutions_found,
-                    'soln': TSPSolution(final_cities),
+                    'soln': soln,
                     'max': 0,
                     'total': 0,
-                    'pruned': 0}
+                    'pruned': 0,
+                    'instrumentation': inst.to_dict()}
         else:
             return {'cost': float('inf'),
                     'time': end_time - start_time,
@@ -198,108 +572,320 @@ class TSPSolver:
                     'soln': None,
                     'max': 0,
                     'total': 0,
-                    'pruned':0}
-
-
-tabu_list = []
-tabu_limit = 500
-cost_array = []
+                    'pruned':0,
+                    'instrumentation': inst.to_dict()}
 
+    ''' <summary>
+        Lin-Kernighan style search: improves a greedy tour with variable-depth
+        chains of 2-opt and stretch-swapping moves over each city's nearest
+        neighbours, then keeps kicking the tour with local double bridges and
+        re-optimizing around them until time runs out.  Handles asymmetric costs
+        and missing edges.
+        </summary>
+        <returns>results dictionary for GUI that contains three ints: cost of best solution,
+        time spent to find best solution, total number of solutions found (each improvement
+        counts), the best solution found, and three null values for fields not used for this
+        algorithm</returns>
+    '''
 
-def tabu_search(cities, time_allowance, instrumenter, curr_bssf):
-    # get cost array
-    init_cost_array(cities)
+    @cached_solutions(anytime=True)
+    def linKernighan(self, time_allowance=60.0, on_solution=None, stop_event=None):
+        inst = Instrumenter(self._solution_stream(on_solution), stop_event)
 
-    greedy_cost = get_cost(curr_bssf)
+        start_time = time.time()
 
-    # start search, end search when time runs out
-    start_time = time.time()
-    base_neighborhood_def = 3
-    curr_neighborhood_def = base_neighborhood_def
-    while time.time() - start_time < time_allowance:
-        # TODO: use instrumenter
-        old_bssf = curr_bssf
-        curr_bssf = tabu_helper(curr_bssf, curr_neighborhood_def, start_time, time_allowance)
-        if curr_bssf == old_bssf:
-            curr_neighborhood_def += 1
-            print(f"Neighborhood def now {curr_neighborhood_def}")
-        else:
-            curr_neighborhood_def = base_neighborhood_def
-        if curr_neighborhood_def == len(cities):
-            break
+        # Start from the best tour found for this scenario before, if there
+        # is one
+        start_indices = self._warm_start()
+        if start_indices is None:
+            with inst.phase('greedy'):
+                start_bssf = self.greedy(time_allowance, on_solution=on_solution, stop_event=stop_event)['soln']
+                if start_bssf is None:
+                    remaining = max(time_allowance - (time.time() - start_time), 0.0)
+                    start_bssf = self.defaultRandomTour(remaining, on_solution=on_solution,
+                                                        stop_event=stop_event)['soln']
+
+            if start_bssf is None:
+                return {'cost': float('inf'),
+                        'time': time.time() - start_time,
+                        'count': inst.solutions_found,
+                        'soln': None,
+                        'max': None,
+                        'total': None,
+                        'pruned': None,
+                        'instrumentation': inst.to_dict()}
+            start_indices = start_bssf.indices.tolist()
+
+        costs = self._scenario.getCostMatrix()
+        candidates = self._scenario.getCandidates()
+        with inst.phase('matrix'):
+            if candidates is None:
+                search = LinKernighan(costs)
+            else:
+                search = LinKernighan(costs, candidates.neighbors(), in_neighbors=candidates.in_neighbors(costs))
+        remaining = time_allowance - (time.time() - start_time)
+        with inst.phase('search'):
+            final_state, path_cost = search.run(start_indices, remaining, inst)
+
+        soln = TSPSolution(final_state, self._scenario)
+
+        inst.flush()
+        end_time = time.time()
 
-    best_cost = get_cost(curr_bssf)
-    if greedy_cost < best_cost:
-        i = "old is better"
-    if greedy_cost > best_cost:
-        i = "new is better"
+        return {'cost': soln.cost,
+                'time': end_time - start_time,
+                'count': inst.solutions_found,
+                'soln': soln,
+                'max': None,
+                'total': None,
+                'pruned': None,
+                'instrumentation': inst.to_dict()}
 
-    return curr_bssf, best_cost
 
+# TabuMemory :: FIFO set of tour hashes
+#
+# Remembers the last `tenure' hashes added to it.  Membership is a set
+# lookup and expiry pops from a deque, both O(1); a hash added more than
+# once stays tabu until its last copy expires.
+class TabuMemory:
+    def __init__(self, tenure):
+        self.tenure = tenure
+        self._order = collections.deque()
+        self._counts = {}
+
+    def __contains__(self, h):
+        return h in self._counts
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, h):
+        self._order.append(h)
+        self._counts[h] = self._counts.get(h, 0) + 1
+        while len(self._order) > self.tenure:
+            old = self._order.popleft()
+            self._counts[old] -= 1
+            if self._counts[old] == 0:
+                del self._counts[old]
 
-'''
-    :param path: array of integers representing cities
-    :param neighborhood_def: int representing the definition of "neighborhood" in our local search
-    
-    :return updated_path: best path in the neighborhood
-'''
-def tabu_helper(path, neighborhood_def, start_time, time_allowance):
-    # path is always our best path so far
 
-    # outside_neighborhood: leave off the last `neighborhood_def` cities on path
-    # inside_neighborhood: get the part that we trimmed off
-    # so, let (outside, inside) (split-at-from-end path neighborhood_def)
-    outside_neighborhood = path[:len(path) - neighborhood_def]
-    inside_neighborhood = path[len(path) - neighborhood_def:]
+tabu_limit = 500
 
-    best_path = path
+# Past this many cities, copying the matrix for TabuSearch and its O(n^2)
+# swap neighbourhood cost more than they win back over the local search
+TABU_MAX_CITIES = 1000
 
-    for i in range(len(inside_neighborhood)):
-        for j in range(i+1, len(inside_neighborhood)):
-            if time.time() - start_time > time_allowance:
-                return best_path
 
-            inside_copy = inside_neighborhood.copy()
-            old_i = inside_copy[i]
-            inside_copy[i] = inside_copy[j]
-            inside_copy[j] = old_i
+# TabuSearch :: tabu search over one scenario's tours of city indices
+#
+# Each search owns its cost table and tabu memory, so any number of them
+# can run side by side (in threads, say) without sharing state.
+class TabuSearch:
+    def __init__(self, costs, tenure=tabu_limit):
+        # Plain lists are much faster than NumPy for one-at-a-time lookups
+        self._costs = np.asarray(costs).tolist()
+        self._memory = TabuMemory(tenure)
+
+    # cost :: [Nat] -> Real
+    def cost(self, path):
+        path_cost = 0
+        for i in range(len(path)):
+            j = (i + 1) % len(path)
+            path_cost += self._costs[path[i]][path[j]]
+        return path_cost
+
+    # swap_move :: [Nat] -> Nat -> Nat -> Hash -> (Real, Hash)
+    #
+    # The change in cost and the new tour_hash for swapping positions p and q.
+    def swap_move(self, path, p, q, path_hash):
+        delta = 0
+        for ((a, b), (c, d)) in swap_edges(path, p, q):
+            delta += self._costs[c][d] - self._costs[a][b]
+            path_hash ^= edge_key(a, b) ^ edge_key(c, d)
+        return (delta, path_hash)
+
+    # run :: [Nat] -> Time -> Optional(Instrument) -> ([Nat], Real)
+    def run(self, curr_bssf, time_allowance, instrumenter=None):
+        best_cost = self.cost(curr_bssf)
+        best_hash = tour_hash(curr_bssf)
+
+        # start search, end search when time runs out
+        start_time = time.time()
+        base_neighborhood_def = 3
+        curr_neighborhood_def = base_neighborhood_def
+        while time.time() - start_time < time_allowance and \
+              not (instrumenter is not None and instrumenter.stopped()):
+            old_bssf = curr_bssf
+            curr_bssf, best_cost, best_hash = self.tabu_helper(curr_bssf, best_cost, best_hash,
+                                                               curr_neighborhood_def, start_time, time_allowance,
+                                                               instrumenter)
+            if curr_bssf == old_bssf:
+                curr_neighborhood_def += 1
+            else:
+                curr_neighborhood_def = base_neighborhood_def
+                if instrumenter is not None:
+                    instrumenter.inc_solutions_found()
+                    instrumenter.report_solution(best_cost, curr_bssf)
+            if instrumenter is not None:
+                instrumenter.sample(bssf=best_cost)
+            if curr_neighborhood_def == len(curr_bssf):
+                break
+
+        return curr_bssf, best_cost
 
-            path = outside_neighborhood + inside_copy
+    '''
+        :param path: array of integers representing cities
+        :param path_cost: the cost of path
+        :param path_hash: the tour_hash of path
+        :param neighborhood_def: int representing the definition of "neighborhood" in our local search
+        :param instrumenter: optional Instrumenter, checked for a request to stop and
+                             given the number of swaps looked at
+
+        :return (updated_path, updated_cost, updated_hash): best path in the neighborhood, its cost and hash
+    '''
+    def tabu_helper(self, path, path_cost, path_hash, neighborhood_def, start_time, time_allowance,
+                    instrumenter=None):
+        # path is always our best path so far
+
+        # outside_neighborhood: leave off the last `neighborhood_def` cities on path
+        # inside_neighborhood: get the part that we trimmed off
+        # so, let (outside, inside) (split-at-from-end path neighborhood_def)
+        offset = len(path) - neighborhood_def
+
+        best_path = path
+        best_cost = path_cost
+        best_hash = path_hash
+        tried = 0
+
+        for i in range(offset, len(path)):
+            for j in range(i+1, len(path)):
+                if time.time() - start_time > time_allowance or \
+                   (instrumenter is not None and instrumenter.stopped()):
+                    if instrumenter is not None:
+                        instrumenter.inc_moves_tried(tried)
+                    return best_path, best_cost, best_hash
+                tried += 1
+
+                # Every swap is scored (and hashed) against the original path,
+                # only looking at the edges the swap touches
+                (delta, candidate_hash) = self.swap_move(path, i, j, path_hash)
+                candidate_cost = path_cost + delta
+
+                if candidate_cost < best_cost and candidate_hash not in self._memory:
+                    best_path = path.copy()
+                    best_path[i], best_path[j] = best_path[j], best_path[i]
+                    best_cost = candidate_cost
+                    best_hash = candidate_hash
+                self._memory.add(candidate_hash)
+
+        if instrumenter is not None:
+            instrumenter.inc_moves_tried(tried)
+        return best_path, best_cost, best_hash
+
+
+# tabu_search :: [City] -> Time -> Instrument -> [Nat] -> Optional(Nat) -> ([Nat], Real)
+def tabu_search(cities, time_allowance, instrumenter, curr_bssf, tenure=tabu_limit):
+    search = TabuSearch(cities[0]._scenario.getCostMatrix(), tenure)
+    return search.run(curr_bssf, time_allowance, instrumenter)
+
+
+# swap_edges :: [Nat] -> Nat -> Nat -> [((Nat, Nat), (Nat, Nat))]
+#
+# The edges of the tour `path' that change when the cities at positions
+# p and q trade places, as (old edge, new edge) pairs.  There are at most
+# four of them however long the tour is.
+def swap_edges(path, p, q):
+    n = len(path)
+    swapped = {p: path[q], q: path[p]}
 
-            path_cost = get_cost(path)
-            best_cost = get_cost(best_path)
+    edges = []
+    for k in {(p - 1) % n, p, (q - 1) % n, q}:
+        k1 = (k + 1) % n
+        edges.append(((path[k], path[k1]), (swapped.get(k, path[k]), swapped.get(k1, path[k1]))))
+    return edges
 
-            if path not in tabu_list and path_cost < best_cost:
-                best_path = path
-            tabu_list.append(path)
-            if len(tabu_list) > tabu_limit:
-                tabu_list.pop(0)
 
-    return best_path
+# tour_hash :: [Nat] -> Hash
+#
+# Zobrist-style hash of a tour's set of directed edges: the XOR of every
+# edge's key.  Because XOR undoes itself, a move updates it by XOR-ing
+# out the edges it removes and XOR-ing in the ones it adds.
+def tour_hash(path):
+    h = 0
+    for i in range(len(path)):
+        h ^= edge_key(path[i], path[(i + 1) % len(path)])
+    return h
 
 
-def get_cost(path):
-    path_cost = 0
-    for i in range(len(path)):
-        j = (i + 1) % len(path)
-        path_cost += cost_array[path[i]][path[j]]
-    return path_cost
+MASK_64 = (1 << 64) - 1
 
 
-# get_cost_fp :: [Cities] -> Nat
+# edge_key :: Nat -> Nat -> Hash
+#
+# A pseudo-random 64-bit key for the edge a -> b (the splitmix64 mix of
+# the pair).  Keys are computed on demand and memoized, so only the edges
+# the search actually touches are ever stored.
+@functools.lru_cache(maxsize=1 << 20)
+def edge_key(a, b):
+    z = (((a << 32) | b) + 0x9E3779B97F4A7C15) & MASK_64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return z ^ (z >> 31)
+
+
+def test_swap_move():
+    loc = generate_points(7, 9)
+    s = Scenario(loc, "Normal", 0)
+    search = TabuSearch(s.getCostMatrix())
+
+    path = [3, 0, 6, 2, 5, 1, 4]
+    for p in range(7):
+        for q in range(p + 1, 7):
+            swapped = path.copy()
+            swapped[p], swapped[q] = swapped[q], swapped[p]
+            (delta, swapped_hash) = search.swap_move(path, p, q, tour_hash(path))
+            assert search.cost(path) + delta == search.cost(swapped)
+            assert swapped_hash == tour_hash(swapped)
+
+
+def test_tabu_search_is_reentrant():
+    loc = generate_points(12, 11)
+    small = Scenario(loc, "Normal", 0)
+    big = Scenario(loc + loc[:4], "Normal", 0)
+
+    # Interleaving searches over different scenarios mustn't change either
+    first = TabuSearch(small.getCostMatrix()).run(list(range(12)), 60, Instrumenter())
+    TabuSearch(big.getCostMatrix()).run(list(range(16)), 60, Instrumenter())
+    again = TabuSearch(small.getCostMatrix()).run(list(range(12)), 60, Instrumenter())
+    assert first == again
+    # The instrumenter is optional
+    assert TabuSearch(small.getCostMatrix()).run(list(range(12)), 60) == first
+
+
+def test_tabu_memory():
+    memory = TabuMemory(3)
+    for h in [1, 2, 1, 3]:
+        memory.add(h)
+    assert 1 in memory and 2 in memory and 3 in memory
+    assert len(memory) == 3
+
+    # The first 1 and the 2 expire; the second 1 is still remembered
+    memory.add(4)
+    assert 2 not in memory
+    assert 1 in memory
+    memory.add(5)
+    assert 1 not in memory
+    assert 3 in memory and 4 in memory and 5 in memory
+
+
+# get_cost_fp :: [Cities] -> Real
 def get_cost_fp(path):
     path_cost = 0
     for i in range(len(path)):
         path_cost += cost(path[i], path[(i + 1) % len(path)])
-    return path_cost
-
-
-def init_cost_array(cities):
-    for i in range(len(cities)):
-        cost_row = []
-        for j in range(len(cities)):
-            cost_row.append(cities[i].costTo(cities[j]))
-        cost_array.append(cost_row)
+    if path_cost == float('inf') or (path and not path[0]._scenario.integerCosts()):
+        return path_cost
+    return int(path_cost)
 
 
 ############################################################
@@ -312,38 +898,411 @@ def init_cost_array(cities):
 # ---------
 # Time :: time
 # Instrument :: {max_queue:Nat, states_created:Nat, states_pruned:Nat}
-# BbState :: (CostMatrix:[[Real]], LowerBound:Real, Depth:Nat, Path:[City])
+# BbState :: {matrix:Optional(CostMatrix), lb:Real, depth:Nat, city:City,
+#             visited:Bitmask, parent:Optional(BbState), root:City}
 
-# dfs_greedy :: [City] -> BbState -> Instrument -> Optional(BbState)
-def dfs_greedy(cities, state, instrument):
-    # pprint_state(state)
 
-    path = state_path(state)
-    if len(cities) == len(path):
-        # Make sure we can go from start to end
-        if cost(path[-1], path[0]) != float('inf'):
-            return state
+class BbState:
+    # A search state only keeps the city it ends on and a pointer to its
+    # parent; the full path is rebuilt by state_path when it is needed.
+    # The visited bitmask (bit i set = city with _index i is on the path)
+    # makes membership checks O(1).
+    __slots__ = ('matrix', 'lb', 'depth', 'city', 'visited', 'parent', 'root')
+
+    def __init__(self, matrix, lb, depth, city, visited, parent=None, root=None):
+        self.matrix = matrix
+        self.lb = lb
+        self.depth = depth
+        self.city = city
+        self.visited = visited
+        self.parent = parent
+        self.root = city if root is None else root
+
+    def visits(self, city):
+        return (self.visited >> city._index) & 1 == 1
+
+    # child :: BbState -> Optional(CostMatrix) -> Real -> City -> BbState
+    def child(self, matrix, lb, city):
+        return BbState(matrix, lb, self.depth + 1, city,
+                       self.visited | (1 << city._index), self, self.root)
+
+
+# Frontier :: priority queue of BbStates ordered by (key, insertion order)
+#
+# With no capacity this is just a heapq list.  Given a capacity (in
+# states), whenever the in-memory heap grows past it the worst quarter of
+# the heap is either dropped (beam search; the drops are counted in the
+# Instrumenter) or spilled to a sorted run in a temporary file.  Spilled
+# runs are read back a block at a time as soon as their best key beats the
+# best key in memory, so states still come out in heap_score_state order.
+#
+# A run is a file of sorted blocks with the first key and size of each
+# block still to be read.  Once there are more than MAX_RUNS runs, all but
+# the MAX_RUNS // 2 biggest are merged into one, so the open files (and
+# the runs pop looks at) stay bounded however long the search goes on,
+# and a state is rewritten only a few times.
+class Frontier:
+    OVERFLOW_MODES = ('drop', 'spill')
+    MAX_RUNS = 8
+
+    def __init__(self, cities, instrumenter, capacity=None, overflow='drop'):
+        if overflow not in self.OVERFLOW_MODES:
+            raise ValueError('Unknown overflow mode: {}'.format(overflow))
+        if capacity is not None and capacity < 4:
+            raise ValueError('Frontier capacity must be at least 4 states')
+
+        self._cities = cities
+        self._instrumenter = instrumenter
+        self._capacity = capacity
+        self._overflow = overflow
+        self._tiebreak = itertools.count()
+        self._heap = []
+        self._runs = []         # [(file, deque([(first key, count)]))]
+        self._spilled = 0
+
+    def __len__(self):
+        return len(self._heap) + self._spilled
+
+    def push(self, key, state):
+        heapq.heappush(self._heap, (key, next(self._tiebreak), state))
+        if self._capacity is not None and len(self._heap) > self._capacity:
+            self._trim()
+
+    def pop(self):
+        if self._runs:
+            best_run = min(range(len(self._runs)), key=lambda i: self._runs[i][1][0][0])
+            if len(self._heap) == 0 or self._runs[best_run][1][0][0] < self._heap[0][0]:
+                self._reload(best_run)
+        return heapq.heappop(self._heap)[2]
+
+    # Remove any spill files that are still around
+    def close(self):
+        for (f, _) in self._runs:
+            f.close()
+        self._runs = []
+        self._spilled = 0
+
+    def _trim(self):
+        # A sorted list is a valid heap, so keep the best 3/4 in place
+        keep = self._capacity * 3 // 4
+        self._heap.sort()
+        overflow = self._heap[keep:]
+        del self._heap[keep:]
+
+        if self._overflow == 'drop':
+            self._instrumenter.inc_states_dropped(len(overflow))
         else:
+            self._spill(overflow)
+
+    # Spilled entries are (key, order, lb, visited, matrix, path) rows
+    def _spill(self, entries):
+        f = tempfile.TemporaryFile()
+        rows = [(key, order, state.lb, state.visited, state.matrix,
+                 np.array([c._index for c in state_path(state)], dtype=np.int32))
+                for (key, order, state) in entries]
+        block = self._write_block(f, rows)
+        f.seek(0)
+        self._runs.append((f, collections.deque([block])))
+        self._spilled += len(entries)
+        self._instrumenter.inc_states_spilled(len(entries))
+        if len(self._runs) > self.MAX_RUNS:
+            self._merge_runs()
+
+    # BbStates point at City objects (and through them the whole
+    # Scenario), so blocks are plain arrays rather than pickled states
+    @staticmethod
+    def _write_block(f, rows):
+        pickle.dump({'keys': np.array([r[0] for r in rows]),
+                     'order': np.array([r[1] for r in rows]),
+                     'lbs': np.array([r[2] for r in rows]),
+                     'visited': [r[3] for r in rows],
+                     'matrices': np.stack([r[4] for r in rows]),
+                     'paths': [r[5] for r in rows]},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+        return (rows[0][0], len(rows))
+
+    # The next block of a run, as rows
+    @staticmethod
+    def _read_block(run):
+        (f, blocks) = run
+        (_, count) = blocks.popleft()
+        block = pickle.load(f)
+        return list(zip(block['keys'], block['order'], block['lbs'], block['visited'],
+                        block['matrices'], block['paths']))
+
+    def _read_run(self, run):
+        while run[1]:
+            yield from self._read_block(run)
+
+    # A k-way merge of the smaller runs into one new run, a block at a time
+    def _merge_runs(self):
+        self._runs.sort(key=lambda run: -sum(count for (_, count) in run[1]))
+        merging = self._runs[self.MAX_RUNS // 2:]
+        del self._runs[self.MAX_RUNS // 2:]
+
+        f = tempfile.TemporaryFile()
+        blocks = collections.deque()
+        block_size = max(1, self._capacity // 4)
+        rows = []
+        # Keys tie only with distinct orders, so rows never compare further
+        for row in heapq.merge(*[self._read_run(run) for run in merging]):
+            rows.append(row)
+            if len(rows) == block_size:
+                blocks.append(self._write_block(f, rows))
+                rows = []
+        if rows:
+            blocks.append(self._write_block(f, rows))
+        for (old, _) in merging:
+            old.close()
+        f.seek(0)
+        self._runs.append((f, blocks))
+
+    def _reload(self, i):
+        run = self._runs[i]
+        rows = self._read_block(run)
+        if not run[1]:
+            run[0].close()
+            del self._runs[i]
+        self._spilled -= len(rows)
+
+        for (key, order, lb, visited, matrix, path) in rows:
+            state = rebuild_state(self._cities, path, matrix, lb, visited)
+            self._heap.append((key, order, state))
+        heapq.heapify(self._heap)
+
+        if len(self._heap) > self._capacity:
+            self._trim()
+
+
+# rebuild_state :: [City] -> [Nat] -> Optional(CostMatrix) -> Real -> Bitmask -> BbState
+#
+# Recreates a state from plain arrays, e.g. after it has been written to
+# disk or sent to another process.  The ancestors only matter for
+# state_path, so they get no matrix.
+def rebuild_state(cities, path, matrix, lb, visited):
+    root = cities[path[0]]
+    state = BbState(None, 0, 0, root, 1 << root._index)
+    for c in path[1:]:
+        state = state.child(None, 0, cities[c])
+    state.matrix = matrix
+    state.lb = lb
+    state.visited = visited
+    return state
+
+
+# greedy_tour :: CostMatrix -> [Nat] -> Optional(Instrument) -> Optional(Time) -> Optional([Nat])
+#
+# Nearest-neighbour search over city indices, extending the partial tour
+# `path' (usually just the start city).  It is a depth-first search: when
+# it reaches a dead end (no unvisited city is reachable, or the last city
+# can't get back to the start, as happens in Hard mode) it backs up and
+# tries the next-nearest city instead.  Runs iteratively with an explicit
+# stack, so there is no recursion limit, and gives up at `deadline'.
+def greedy_tour(costs, path, instrument=None, deadline=None):
+    ncities = len(costs)
+    start = path[0]
+    path = list(path)
+
+    visited = np.zeros(ncities, dtype=bool)
+    visited[path] = True
+
+    # tried[d]: the cities already tried after path[d]
+    tried = [[] for _ in path]
+
+    while path:
+        if deadline is not None and time.time() > deadline:
+            return None
+        if instrument is not None and instrument.stopped():
+            return None
+
+        last = path[-1]
+
+        if len(path) == ncities:
+            # Make sure we can go from start to end
+            if costs[last, start] != float('inf'):
+                if instrument is not None:
+                    instrument.inc_solutions_found()
+                    instrument.report_solution(costs[path, np.roll(path, -1)].sum(), path)
+                return path
+            visited[path.pop()] = False
+            tried.pop()
+            continue
+
+        if instrument is not None and not tried[-1]:
+            instrument.inc_states_created(ncities - len(path))
+
+        row = np.where(visited, np.inf, costs[last])
+        row[tried[-1]] = np.inf
+        nxt = int(np.argmin(row))
+
+        if row[nxt] == float('inf'):
+            # Dead end; back up a city
+            if len(path) == 1:
+                return None
+            visited[path.pop()] = False
+            tried.pop()
+            continue
+
+        tried[-1].append(nxt)
+        visited[nxt] = True
+        path.append(nxt)
+        tried.append([])
+
+    return None
+
+
+# candidate_greedy_tour :: CostMatrix -> CandidateGraph -> Nat -> Optional(Instrument)
+#                          -> Optional(Time) -> Optional([Nat])
+#
+# Nearest-neighbour tour from `start' for a sparse scenario: the next city
+# is the cheapest unvisited one in the current city's candidates.  When all
+# of those are taken, the cheapest of the unvisited cities nearest on the
+# map (from the candidates' grid) is next, or the cheapest of all the
+# unvisited cities if there is no grid.  Every edge exists in a sparse
+# scenario, so there are no dead ends to back out of.
+def candidate_greedy_tour(costs, candidates, start, instrument=None, deadline=None):
+    ncities = len(costs)
+    near = candidates.neighbors()
+    grid = candidates.grid
+
+    visited = bytearray(ncities)
+    seen = np.frombuffer(visited, dtype=bool)
+    remaining = np.arange(ncities)
+    if grid is not None:
+        counts = grid.cell_counts()
+        counts[grid.cx[start], grid.cy[start]] -= 1
+
+    path = [start]
+    visited[start] = True
+    last = start
+    while len(path) < ncities:
+        if deadline is not None and time.time() > deadline:
+            return None
+        if instrument is not None and instrument.stopped():
             return None
+
+        nxt = next((c for c in near[last] if not visited[c]), None)
+        if nxt is None:
+            if grid is None:
+                remaining = remaining[~seen[remaining]]
+                pool = remaining
+            else:
+                pool = grid.nearest(last, seen, counts)
+            nxt = int(pool[np.argmin(costs[last, pool])])
+            if instrument is not None:
+                instrument.inc_states_created(len(pool))
+        elif instrument is not None:
+            instrument.inc_states_created(len(near[last]))
+
+        if grid is not None:
+            counts[grid.cx[nxt], grid.cy[nxt]] -= 1
+        visited[nxt] = True
+        path.append(nxt)
+        last = nxt
+
+    if instrument is not None:
+        instrument.inc_solutions_found()
+        instrument.report_solution(costs[path, np.roll(path, -1)].sum(), path)
+    return path
+
+
+# multi_start_greedy :: CostMatrix -> [Nat] -> Instrument -> Time -> Optional(Nat)
+#                       -> Optional(CandidateGraph) -> (Optional([Nat]), Nat)
+#
+# Runs greedy_tour (candidate_greedy_tour, given candidates) from each
+# start city in a process pool.  The cost matrix is handed to each worker
+# once, when the pool starts (under fork it's simply inherited), rather
+# than with every start.  Returns the cheapest tour and the number of
+# starts that finished before `deadline'.
+def multi_start_greedy(costs, starts, instrument, deadline, workers=None, candidates=None):
+    workers = workers or multiprocessing.cpu_count()
+    chunksize = max(1, len(starts) // (workers * 8))
+
+    best_tour = None
+    best_cost = float('inf')
+    completed = 0
+    if time.time() > deadline or instrument.stopped():
+        return (best_tour, completed)
+
+    with multiprocessing.Pool(workers, initializer=_greedy_worker_init,
+                              initargs=(costs, deadline, candidates)) as pool:
+        for (tour, tour_cost, finished, inst) in pool.imap_unordered(_greedy_worker_run, starts, chunksize):
+            instrument.merge(inst)
+            if finished:
+                completed += 1
+            if tour is not None and tour_cost < best_cost:
+                best_tour = tour
+                best_cost = tour_cost
+                instrument.report_solution(best_cost, best_tour)
+            if time.time() > deadline or instrument.stopped():
+                break
+
+    return (best_tour, completed)
+
+
+_greedy_worker = {}
+
+
+def _greedy_worker_init(costs, deadline, candidates):
+    _greedy_worker['costs'] = costs
+    _greedy_worker['deadline'] = deadline
+    _greedy_worker['candidates'] = candidates
+
+
+# _greedy_worker_run :: Nat -> (Optional([Nat]), Real, Bool, Instrument)
+def _greedy_worker_run(start):
+    costs = _greedy_worker['costs']
+    inst = Instrumenter()
+    if _greedy_worker['candidates'] is None:
+        tour = greedy_tour(costs, [start], inst, _greedy_worker['deadline'])
     else:
-        next_cities = []
-        for c in cities:
-            if not c in state_path(state):
-                next_cities.append(c)
-
-        next_cities.sort(key=lambda x: cost(state_path(state)[-1], x))
-        
-        for c in next_cities:
-            if cost(state_path(state)[-1], c) != float('inf'):
-                (a1, a2, a3, a4) = state
-                fs = dfs_greedy(cities, (a1, a2, a3+1, a4 + [c]), instrument)
-                if not (fs is None):
-                    return fs
+        tour = candidate_greedy_tour(costs, _greedy_worker['candidates'], start, inst,
+                                     _greedy_worker['deadline'])
+    if tour is None:
+        # Either a dead end from this start, or we ran out of time
+        return (None, float('inf'), time.time() <= _greedy_worker['deadline'], inst)
+    return (tour, costs[tour, np.roll(tour, -1)].sum(), True, inst)
+
+
+# dfs_greedy :: [City] -> BbState -> Instrument -> Optional(BbState)
+#
+# Greedily completes `state' with greedy_tour.  The returned state's lower
+# bound is the cost of the whole tour.
+def dfs_greedy(cities, state, instrument):
+    by_index = {c._index: c for c in cities}
+    prefix = [c._index for c in state_path(state)]
 
+    tour = greedy_tour(state.city._scenario.getCostMatrix(), prefix, instrument)
+    if tour is None:
         return None
 
+    for i in tour[len(prefix):]:
+        state = state.child(None, state.lb, by_index[i])
+    state.lb = get_cost_fp(state_path(state))
+    return state
+
+
+def test_multi_start_greedy():
+    loc = generate_points(30, 8)
+    s = Scenario(loc, "Normal", 0)
+    costs = s.getCostMatrix()
+
+    def tour_cost(tour):
+        return costs[tour, np.roll(tour, -1)].sum()
+
+    inst = Instrumenter()
+    (tour, completed) = multi_start_greedy(costs, list(range(30)), inst, time.time() + 60, workers=2)
+    assert completed == 30
+    assert inst.solutions_found == 30
+    assert sorted(tour) == list(range(30))
+    assert tour_cost(tour) == min(tour_cost(greedy_tour(costs, [i])) for i in range(30))
+
+    # Out of time already, no pool is started
+    assert multi_start_greedy(costs, list(range(30)), Instrumenter(), time.time() - 1) == (None, 0)
+
+
 def test_dfs_greedy():
-    loc = [QPointF(0, 2), QPointF(2, 3), QPointF(3, 1), QPointF(1, -2), QPointF(-2, 0)]
+    loc = [(0, 2), (2, 3), (3, 1), (1, -2), (-2, 0)]
     s = Scenario(loc, "", 0)
     cs = s.getCities()
     cs.sort(key=lambda i: i._index)
@@ -365,109 +1324,300 @@ def test_dfs_greedy():
 
     # Ok, now try in a scenario where you cannot get from 5 to 1:
     instrument = Instrumenter()
-    loc = [QPointF(0, 2), QPointF(2, 3), QPointF(3, 1), QPointF(1, -2), QPointF(-2, 0)]
+    loc = [(0, 2), (2, 3), (3, 1), (1, -2), (-2, 0)]
     s = Scenario(loc, "", 0)
     cs = s.getCities()
     s._edge_exists[4, 0] = False
+    s.buildCostMatrix()
     assert cost(cs[4], cs[0]) == float('inf')
     cs.sort(key=lambda i: i._index)
 
     st = bb_init_state(cs, cs[0])
-    assert st[0][4][0] == float('inf')
+    assert st.matrix[4][0] == float('inf')
     # [[inf, 0,    926,  1110, 592],
     #  [0,   inf,  0,    2086, 2763],
     #  [926, 0,    inf,  592,  2863],
     #  [518, 1494, 0,    inf,  0],
     #  [inf, 2171, 2271, 0,    inf]],
 
+    # 0 -> 1 -> 2 -> 3 -> 4 dead-ends, so it backs up and tries 2 -> 4 instead
     fs = dfs_greedy(cs, st, instrument)
     assert not fs is None
-    assert state_path(fs) == [cs[0], cs[4], cs[3], cs[2], cs[1]]
-    assert state_lb(fs) == cost(cs[0], cs[4]) + cost(cs[4], cs[3]) + cost(cs[3], cs[2]) + cost(cs[2], cs[1]) + cost(
-        cs[1], cs[0])
-    assert instrument.states_created == 10
+    assert state_path(fs) == [cs[0], cs[1], cs[2], cs[4], cs[3]]
+    assert state_lb(fs) == cost(cs[0], cs[1]) + cost(cs[1], cs[2]) + cost(cs[2], cs[4]) + cost(cs[4], cs[3]) + cost(
+        cs[3], cs[0])
+    assert instrument.states_created == 11
+
+
+# Rough per-state cost beyond its matrix: the BbState itself, its heap
+# entry and its share of the parent chain
+BB_STATE_OVERHEAD = 256
 
 
-# strat_bb :: [City] -> Time -> Instrument -> Optional(BbState)
-def strat_bb(cities, time_allowance, instrumenter):
+# strat_bb :: [City] -> Time -> Instrument -> Optional(Nat) -> String -> Optional([Nat])
+#             -> Optional(BbState)
+#
+# max_frontier_bytes bounds the memory held by the queue of open states;
+# once it is reached, the worst states are either dropped or spilled to
+# disk depending on overflow (see Frontier).
+def strat_bb(cities, time_allowance, instrumenter, max_frontier_bytes=None, overflow='drop',
+             initial_tour=None):
+    start_time = time.time()
+
+    (root, bssf) = bb_init_search(cities, instrumenter, initial_tour)
+    if bssf is None:
+        return None
+
+    # Now that we have a decent value for best search so far, we can
+    # start our regular branch-and-bound search
+    states = bb_frontier(cities, root, instrumenter, max_frontier_bytes, overflow)
+    states.push(state_lb(root), root)
+
+    with instrumenter.phase('search'):
+        bssf = bb_search(states, cities, bssf, start_time, time_allowance, instrumenter)
+
+        instrumenter.inc_states_pruned(len(states))
+        states.close()
+    print(f"final path:")
+    for s in state_path(bssf):
+        print(s._index, end=", ")
+    print()
+
+    # Let's verify that our solution is correct
+    # total_cost = 0
+    # path = state_path(bssf)
+    # for i in range(len(path)):
+    #     this_cost = cost(path[i], path[(i + 1) % len(path)]) 
+    #     print(f"Cost between {path[i]._index} and {path[(i + 1) % len(path)]._index}: {this_cost}")
+    #     total_cost += this_cost
+    # print(f"Total cost: {total_cost}")
+    # assert total_cost != float('inf')
+
+    return bssf
+
+
+# bb_init_search :: [City] -> Instrument -> Optional([Nat]) -> (BbState, Optional(BbState))
+#
+# Builds the root state and greedily searches for an initial bssf.  A tour
+# found earlier (city indices, e.g. from a SolutionCache) is the initial
+# bssf instead when it is cheaper.
+def bb_init_search(cities, instrumenter, initial_tour=None):
     cities.sort(key=lambda c: c._index)
-    states = [bb_init_state(cities, cities[0])]
+    with instrumenter.phase('reduction'):
+        root = bb_init_state(cities, cities[0])
 
     instrumenter.update_queue(1)
     instrumenter.inc_states_created()
 
-    start_time = time.time()
-    bssf = None
-
     # Greedily search for an initial solution
-    greedy_state = dfs_greedy(cities, states[0], instrumenter)
+    bssf = None
+    with instrumenter.phase('greedy'):
+        greedy_state = dfs_greedy(cities, root, instrumenter)
     greedy_cost = get_cost_fp(state_path(greedy_state))
-    if (greedy_state is None) or (greedy_cost == float('inf')):
+    if not ((greedy_state is None) or (greedy_cost == float('inf'))):
+        bssf = BbState(None, greedy_cost, greedy_state.depth, greedy_state.city,
+                       greedy_state.visited, greedy_state.parent, greedy_state.root)
+
+    if initial_tour is not None:
+        # Every state's path starts at the root city
+        first = initial_tour.index(cities[0]._index)
+        tour = initial_tour[first:] + initial_tour[:first]
+        tour_cost = get_cost_fp([cities[i] for i in tour])
+        if tour_cost < (float('inf') if bssf is None else state_lb(bssf)):
+            bssf = rebuild_state(cities, tour, None, tour_cost, (1 << len(cities)) - 1)
+
+    if bssf is None:
         print("Error: greedy search failed!")
-        return None
+    return (root, bssf)
 
-    bssf = (None, greedy_cost, greedy_state[2], greedy_state[3])
 
-    # Now that we have a decent value for best search so far, we can
-    # start our regular branch-and-bound search
+# bb_frontier :: [City] -> BbState -> Instrument -> Optional(Nat) -> String -> Frontier
+def bb_frontier(cities, sample_state, instrumenter, max_frontier_bytes, overflow):
+    capacity = None
+    if max_frontier_bytes is not None:
+        state_bytes = sample_state.matrix.nbytes + BB_STATE_OVERHEAD
+        capacity = max(4, int(max_frontier_bytes // state_bytes))
+    return Frontier(cities, instrumenter, capacity, overflow)
 
-    states = [heap_state_lb(s) for s in states]
-    heapq.heapify(states)
 
-    while still_timep(start_time, time_allowance) and len(states) > 0:
+# bb_search :: Frontier -> [City] -> Optional(BbState) -> Time -> Real -> Instrument
+#              -> Optional(SharedReal) -> Optional(BbState)
+#
+# The main branch-and-bound loop.  When shared_bound (a
+# multiprocessing.Value) is given, states are also pruned against it and
+# every improvement this search finds is published to it.  The time
+# series gets the queue size, the bound states are pruned against and the
+# lower bound of the state being expanded.  Counts go to the Instrumenter
+# once per expansion rather than once per child.
+def bb_search(states, cities, bssf, start_time, time_allowance, instrumenter, shared_bound=None):
+    while still_timep(start_time, time_allowance) and len(states) > 0 and not instrumenter.stopped():
         instrumenter.update_queue(len(states))
-        (_, st) = heapq.heappop(states)
+        st = states.pop()
+
+        bound = float('inf') if bssf is None else state_lb(bssf)
+        if shared_bound is not None:
+            bound = min(bound, shared_bound.value)
+        instrumenter.sample(len(states), bound, state_lb(st))
 
         # Is this an end state? If so, update the bssf
-        if (len(cities) == len(state_path(st))):
+        if (len(cities) == state_depth(st) + 1):
             print("Found a solution")
 
-            final_cost = cost(state_path(st)[-1], state_path(st)[0])
-            st = (st[0], st[1] + final_cost, st[2], st[3])
-            if state_lb(st) < state_lb(bssf):
+            # The reductions along the way already count part of the
+            # closing edge, so adding its full cost to the bound can
+            # overshoot; a complete tour's bound is just its cost
+            st.matrix = None
+            st.lb = get_cost_fp(state_path(st))
+            if state_lb(st) < bound:
                 print(f"New best solution found: {state_lb(st)}")
                 instrumenter.inc_solutions_found()
+                instrumenter.report_solution(state_lb(st), [c._index for c in state_path(st)])
                 bssf = st
+                if shared_bound is not None:
+                    with shared_bound.get_lock():
+                        if state_lb(st) < shared_bound.value:
+                            shared_bound.value = state_lb(st)
 
         # Look at the next states; prune any that are worse than the
         # bssf that we have
         else:
-            next_states = gen_next_states(st, cities)
-
-            if len(next_states) == 0:
-                print("Found a solution that's worse than our best so far")
+            # Children that can't beat the bssf are pruned (and counted)
+            # by iter_next_states before their matrices are ever built
+            next_states = iter_next_states(st, cities, bound, instrumenter)
 
+            kept = 0
+            pruned = 0
             for nst in next_states:
-                instrumenter.inc_states_created()
-
-                if state_lb(nst) > state_lb(bssf):
-                    instrumenter.inc_states_pruned()
+                if state_lb(nst) > bound:
+                    pruned += 1
                 else:
-                    new_key = heap_score_state(nst, len(cities), state_lb(bssf))
-                    heapq.heappush(states, (new_key, nst))
+                    new_key = heap_score_state(nst, len(cities), bound)
+                    states.push(new_key, nst)
+                    kept += 1
+            instrumenter.inc_states_created(kept + pruned)
+            instrumenter.inc_states_pruned(pruned)
 
-    instrumenter.inc_states_pruned(len(states))
-    print(f"final path:")
-    for s in state_path(bssf):
-        print(s._index, end=", ")
-    print()
+            # The children carry their own reduced matrices, so this one
+            # is no longer needed; only the slim parent chain stays alive
+            st.matrix = None
 
-    # Let's verify that our solution is correct
-    # total_cost = 0
-    # path = state_path(bssf)
-    # for i in range(len(path)):
-    #     this_cost = cost(path[i], path[(i + 1) % len(path)]) 
-    #     print(f"Cost between {path[i]._index} and {path[(i + 1) % len(path)]._index}: {this_cost}")
-    #     total_cost += this_cost
-    # print(f"Total cost: {total_cost}")
-    # assert total_cost != float('inf')
+            if kept == 0:
+                print("Found a solution that's worse than our best so far")
 
     return bssf
 
 
+# strat_bb_parallel :: [City] -> Time -> Instrument -> Optional(Nat) -> Optional(Nat) -> String
+#                      -> Optional([Nat]) -> (Optional(BbState), [Instrument])
+#
+# Splits the top of the search tree breadth-first until there is a
+# subtree for every worker, then runs bb_search on the subtrees in a
+# process pool.  The best cost found anywhere lives in shared memory so
+# all the workers prune against it.  Returns the best state and the
+# workers' own instruments, which are also merged into `instrumenter'.
+def strat_bb_parallel(cities, time_allowance, instrumenter, workers=None, max_frontier_bytes=None,
+                      overflow='drop', initial_tour=None):
+    start_time = time.time()
+    workers = workers or multiprocessing.cpu_count()
+
+    (root, bssf) = bb_init_search(cities, instrumenter, initial_tour)
+    if bssf is None:
+        return (None, [])
+
+    level = [root]
+    with instrumenter.phase('split'):
+        while len(level) < workers and still_timep(start_time, time_allowance) and not instrumenter.stopped():
+            next_level = []
+            for st in level:
+                if len(cities) == state_depth(st) + 1:
+                    next_level.append(st)
+                    continue
+                children = list(iter_next_states(st, cities, state_lb(bssf), instrumenter))
+                kept = [nst for nst in children if state_lb(nst) <= state_lb(bssf)]
+                instrumenter.inc_states_created(len(children))
+                instrumenter.inc_states_pruned(len(children) - len(kept))
+                next_level.extend(kept)
+                st.matrix = None
+            if all(len(cities) == state_depth(st) + 1 for st in level):
+                break
+            level = next_level
+
+    # Round-robin so every worker gets a mix of good and bad subtrees;
+    # states travel as plain arrays since City objects drag their Scenario
+    # along when pickled
+    chunks = [[(np.array([c._index for c in state_path(st)]), st.matrix, st.lb, st.visited)
+               for st in level[i::workers]] for i in range(workers)]
+    chunks = [chunk for chunk in chunks if chunk]
+
+    shared_bound = multiprocessing.Value('d', state_lb(bssf))
+    shared_stop = multiprocessing.Event()
+    deadline = start_time + time_allowance
+    worker_insts = []
+    with instrumenter.phase('search'):
+        if chunks:
+            with multiprocessing.Pool(len(chunks), initializer=_bb_worker_init,
+                                      initargs=(cities, shared_bound, shared_stop, deadline,
+                                                max_frontier_bytes, overflow)) as pool:
+                # Each worker's tour is reported as soon as it (and the ones
+                # before it) are done, rather than after the whole pool
+                pending = pool.imap(_bb_worker_run, chunks)
+                for _ in chunks:
+                    while True:
+                        try:
+                            (path, lb, inst) = pending.next(timeout=0.1)
+                            break
+                        except multiprocessing.TimeoutError:
+                            # Pass a request to stop on to the workers, which then
+                            # return what they have so far
+                            if instrumenter.stopped():
+                                shared_stop.set()
+                    instrumenter.merge(inst)
+                    worker_insts.append(inst)
+                    if path is not None and lb < state_lb(bssf):
+                        bssf = rebuild_state(cities, path, None, lb, 0)
+                        instrumenter.report_solution(lb, path)
+
+    return (bssf, worker_insts)
+
+
+_bb_worker = {}
+
+
+def _bb_worker_init(cities, shared_bound, shared_stop, deadline, max_frontier_bytes, overflow):
+    _bb_worker['cities'] = cities
+    _bb_worker['bound'] = shared_bound
+    _bb_worker['stop'] = shared_stop
+    _bb_worker['deadline'] = deadline
+    _bb_worker['max_frontier_bytes'] = max_frontier_bytes
+    _bb_worker['overflow'] = overflow
+
+
+# _bb_worker_run :: [([Nat], CostMatrix, Real, Bitmask)] -> (Optional([Nat]), Real, Instrument)
+def _bb_worker_run(packed_states):
+    cities = _bb_worker['cities']
+    inst = Instrumenter(stop_event=_bb_worker['stop'])
+    start_time = time.time()
+
+    states = [rebuild_state(cities, *packed) for packed in packed_states]
+    frontier = bb_frontier(cities, states[0], inst, _bb_worker['max_frontier_bytes'],
+                           _bb_worker['overflow'])
+    for st in states:
+        frontier.push(state_lb(st), st)
+
+    bssf = bb_search(frontier, cities, None, start_time, _bb_worker['deadline'] - start_time,
+                     inst, _bb_worker['bound'])
+
+    inst.inc_states_pruned(len(frontier))
+    frontier.close()
+
+    if bssf is None:
+        return (None, float('inf'), inst)
+    return (np.array([c._index for c in state_path(bssf)]), state_lb(bssf), inst)
+
+
 def test_strat_bb():
-    loc = [QPointF(0, 0), QPointF(1, 1), QPointF(2, 2), QPointF(3, 3), QPointF(4, 4), QPointF(5, 5), QPointF(6, 6),
-           QPointF(7, 7)]
+    loc = [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6),
+           (7, 7)]
     s = Scenario(loc, "Test", 0)
     dist = [[float('inf'), 2, float('inf'), float('inf'), float('inf'), 1, float('inf'), 1],
             [2, float('inf'), 1, float('inf'), 1, float('inf'), float('inf'), float('inf')],
@@ -490,8 +1640,8 @@ def test_strat_bb():
 
 
 def test_strat_bb2():
-    loc = [QPointF(0, 0), QPointF(1, 1), QPointF(2, 2), QPointF(3, 3), QPointF(4, 4), QPointF(5, 5), QPointF(6, 6),
-           QPointF(7, 7)]
+    loc = [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6),
+           (7, 7)]
     s = Scenario(loc, "Test", 0)
     dist = [[float('inf'), 1, float('inf'), float('inf'), float('inf'), 2, float('inf'), 1],
             [2, float('inf'), 1, float('inf'), 1, float('inf'), float('inf'), float('inf')],
@@ -512,47 +1662,308 @@ def test_strat_bb2():
     assert [i._index for i in state_path(final_state)] == [0, 7, 6, 3, 2, 1, 4, 5]
 
 
-# bb_init_state :: [City] -> BbState
-def bb_init_state(cities, start_city):
-    # Set up cost matrix
-    cost_matrix = [[cost(i, j) for j in cities] for i in cities]
-    (cost_matrix, lower_bound) = reduce_cost(cost_matrix)
+def test_strat_bb_bounded_frontier():
+    loc = generate_points(10, 4)
+    s = Scenario(loc, "Easy", 0)
+    state_bytes = 10 * 10 * 8 + BB_STATE_OVERHEAD
+
+    inst = Instrumenter()
+    best = get_cost_fp(state_path(strat_bb(s.getCities(), 6000, inst)))
+    assert inst.max_queue > 8
+    assert best == held_karp(s.getCostMatrix())[1]
 
-    path = [start_city]
+    # Spilling keeps every state, so the search is still exact
+    inst = Instrumenter()
+    final_state = strat_bb(s.getCities(), 6000, inst, max_frontier_bytes=8 * state_bytes, overflow='spill')
+    assert get_cost_fp(state_path(final_state)) == best
+    assert inst.states_spilled > 0
+    assert inst.states_dropped == 0
 
-    return (cost_matrix, lower_bound, 0, path)
+    # Dropping gives up states, but still returns a valid tour
+    inst = Instrumenter()
+    final_state = strat_bb(s.getCities(), 6000, inst, max_frontier_bytes=8 * state_bytes, overflow='drop')
+    assert best <= get_cost_fp(state_path(final_state)) < float('inf')
+    assert inst.states_dropped > 0
+    assert inst.max_queue <= 8
 
 
-# gen_next_states :: BbState -> [City] -> [BbState]
-def gen_next_states(start_state, pool):
-    next_states = []
+def test_frontier_merges_spills():
+    s = Scenario(generate_points(5, 1), "Easy", 0)
+    cities = s.getCities()
+    root = bb_init_state(cities, cities[0])
+    inst = Instrumenter()
+    frontier = Frontier(cities, inst, capacity=4, overflow='spill')
 
-    source_city = start_state[3][-1]
+    # Many more spills than MAX_RUNS, but never more runs open than that
+    keys = random.Random(1).sample(range(1000), 300)
+    for key in keys:
+        frontier.push(key, root.child(root.matrix, key, cities[1]))
+        assert len(frontier._runs) <= Frontier.MAX_RUNS
+    assert inst.states_spilled > 4 * Frontier.MAX_RUNS
 
-    for c in pool:
-        if not c in start_state[3]:
-            new_matrix = copy.deepcopy(start_state[0])
-            cost = new_matrix[source_city._index][c._index]
+    popped = [frontier.pop() for _ in range(len(keys))]
+    assert [st.lb for st in popped] == sorted(keys)
+    assert [c._index for c in state_path(popped[0])] == [0, 1]
+    assert len(frontier) == 0 and not frontier._runs
 
-            # inf out row/col the picked path is on
-            for i in range(len(new_matrix)):
-                new_matrix[i][c._index] = float('inf')
-                new_matrix[source_city._index][i] = float('inf')
+def test_strat_bb_parallel():
+    loc = generate_points(10, 4)
+    s = Scenario(loc, "Easy", 0)
 
-            # inf out back edges
-            for i in start_state[3]:
-                new_matrix[c._index][i._index] = float('inf')
+    best = get_cost_fp(state_path(strat_bb(s.getCities(), 6000, Instrumenter())))
 
-            (new_matrix, new_lb) = reduce_cost(new_matrix)
-            new_state = (new_matrix, start_state[1] + new_lb + cost, start_state[2] + 1, start_state[3] + [c])
+    inst = Instrumenter()
+    (final_state, worker_insts) = strat_bb_parallel(s.getCities(), 6000, inst, workers=3)
+    assert get_cost_fp(state_path(final_state)) == best
+    assert sorted(c._index for c in state_path(final_state)) == list(range(10))
+    assert len(worker_insts) == 3
+    assert inst.states_created > sum(wi.states_created for wi in worker_insts)
+
+
+def test_solution_stream():
+    loc = generate_points(40, 5)
+    solver = TSPSolver(None)
+    solver.setupWithScenario(Scenario(loc, "Normal", 0))
+
+    stream = solver.solutions('linKernighan', 1.0)
+    updates = []
+    try:
+        while True:
+            updates.append(next(stream))
+    except StopIteration as stop:
+        results = stop.value
+
+    assert len(updates) > 1
+    assert all(a['cost'] > b['cost'] for (a, b) in zip(updates, updates[1:]))
+    assert all(a['time'] <= b['time'] for (a, b) in zip(updates, updates[1:]))
+    assert all(u['soln'].cost == u['cost'] for u in updates)
+    assert updates[-1]['cost'] == results['cost']
+
+    updates = []
+    solver.setupWithScenario(Scenario(loc[:12], "Normal", 0))
+    results = solver.branchAndBound(60, on_solution=updates.append)
+    assert updates[-1]['cost'] == results['cost']
+    assert updates[-1]['stats']['count'] == results['count']
+
+    # A search that fails fails the stream, rather than just ending it
+    solver.setupWithScenario(Scenario(loc[:12], "Normal", 0, neighbors=5))
+    try:
+        list(solver.solutions('branchAndBound', 60))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_sparse_scenario():
+    points = generate_points(300, 7)
+    random.seed(7)
+    dense = Scenario(points, "Normal", 7)
+    random.seed(7)
+    sparse = Scenario(points, "Normal", 7, neighbors=299)
+    assert sparse.isSparse() and not dense.isSparse()
+
+    # With every city a candidate, the candidate greedy is the plain one
+    solver = TSPSolver(None)
+    solver.setupWithScenario(dense)
+    expected = solver.greedy(60)
+    solver.setupWithScenario(sparse)
+    results = solver.greedy(60)
+    assert [c._index for c in results['soln'].route] == [c._index for c in expected['soln'].route]
+    assert results['cost'] == expected['cost']
+
+    random.seed(7)
+    sparse = Scenario(points, "Normal", 7, neighbors=8)
+    solver.setupWithScenario(sparse)
+    greedy_cost = solver.greedy(60)['cost']
+    for algorithm in ['greedy', 'multiStartGreedy', 'fancy', 'linKernighan']:
+        results = getattr(solver, algorithm)(time_allowance=1.0)
+        route = [c._index for c in results['soln'].route]
+        assert sorted(route) == list(range(300))
+        assert results['cost'] == dense.getCostMatrix()[route, np.roll(route, -1)].sum()
+        assert results['cost'] <= greedy_cost
+
+    for algorithm in ['branchAndBound', 'parallelBranchAndBound', 'heldKarp']:
+        try:
+            getattr(solver, algorithm)(time_allowance=1.0)
+            assert False
+        except ValueError:
+            pass
+    try:
+        Scenario(points, "Hard", 7, neighbors=8)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_held_karp_too_big():
+    solver = TSPSolver(None)
+    solver.setupWithScenario(Scenario(generate_points(12, 3), "Hard (Deterministic)", 3))
+    assert 'error' not in solver.heldKarp(60)
+
+    results = solver.heldKarp(60, max_bytes=1 << 10)
+    assert results['soln'] is None and results['cost'] == float('inf')
+    assert '12 cities' in results['error']
+
+def test_solution_cache():
+    from SolutionCache import SolutionCache
+    points = generate_points(14, 2)
+    cache = SolutionCache()
+    solver = TSPSolver(None, cache)
+    solver.setupWithScenario(Scenario(points, "Hard (Deterministic)", 2))
+
+    first = solver.greedy(60)
+    assert 'cached' not in first
+    # A fresh copy of the same scenario is answered from the cache
+    solver.setupWithScenario(Scenario(points, "Hard (Deterministic)", 2))
+    again = solver.greedy(60)
+    assert again['cached'] and again['cost'] == first['cost']
+    assert [c._index for c in again['soln'].route] == [c._index for c in first['soln'].route]
+    assert cache.hits == 1
+
+    # With the optimal tour cached, branch-and-bound starts from it, so
+    # even with no time at all that's what it returns
+    optimum = solver.heldKarp(60)['cost']
+    assert solver.branchAndBound(0.0)['cost'] == optimum
+    uncached = TSPSolver(None)
+    uncached.setupWithScenario(Scenario(points, "Hard (Deterministic)", 2))
+    assert uncached.branchAndBound(0.0)['cost'] == first['cost'] >= optimum
+
+    # A search cut short, or stopped, isn't remembered
+    assert 'branchAndBound' not in [alg for (_, alg) in cache._entries]
+    stop = threading.Event()
+    stop.set()
+    solver.fancy(60, stop_event=stop)
+    assert 'fancy' not in [alg for (_, alg) in cache._entries]
+
+    # An anytime search answers for runs given no longer than it had, and
+    # for the same settings only
+    fancy = solver.fancy(0.3)
+    assert 'cached' not in fancy
+    again = solver.fancy(0.2)
+    assert again['cached'] and again['cost'] == fancy['cost']
+    assert again['instrumentation']['counters']['count'] == 0
+    assert 'cached' not in solver.fancy(0.6)
+    assert 'cached' not in solver.fancy(0.3, tabu_tenure=3)
+    assert solver.fancy(0.3, tabu_tenure=3)['cached']
+    assert 'fancy(tabu_tenure=3)' in [alg for (_, alg) in cache._entries]
+
+
+def test_instrumentation():
+    solver = TSPSolver(None)
+    solver.setupWithScenario(Scenario(generate_points(12, 4), "Hard (Deterministic)", 4))
+
+    results = solver.branchAndBound(60)
+    stats = results['instrumentation']
+    assert set(stats['phases']) == {'reduction', 'greedy', 'search'}
+    assert stats['counters']['total'] == results['total']
+    assert stats['counters']['pruned'] == results['pruned']
+    assert stats['samples'] and stats['samples'][0]['queue'] is not None
+    assert stats['rates']['states_per_s'] > 0
+
+    results = solver.fancy(0.5)
+    stats = results['instrumentation']
+    assert {'greedy', 'matrix', 'local search', 'tabu search'} <= set(stats['phases'])
+    assert stats['counters']['moves'] > 0
+    json.loads(json.dumps(stats))
+
+
+def test_stop_event():
+    loc = generate_points(40, 6)
+    solver = TSPSolver(None)
+    solver.setupWithScenario(Scenario(loc, "Hard (Deterministic)", 3))
+
+    for algorithm in ['branchAndBound', 'parallelBranchAndBound', 'fancy', 'linKernighan']:
+        stop = threading.Event()
+        threading.Timer(0.3, stop.set).start()
+        results = getattr(solver, algorithm)(600, stop_event=stop)
+        assert results['time'] < 10
+        assert results['cost'] == results['soln'].cost < float('inf')
+
+    # Walking away from the stream stops the search too
+    start_time = time.time()
+    stream = solver.solutions('linKernighan', 600)
+    next(stream)
+    stream.close()
+    assert time.time() - start_time < 10
+
+
+def test_no_start_tour():
+    loc = generate_points(30, 7)
+    solver = TSPSolver(None)
+    solver.setupWithScenario(Scenario(loc, "Hard (Deterministic)", 7))
+
+    # Out of time before any greedy tour is found there is nothing to improve
+    for algorithm in ['fancy', 'linKernighan']:
+        results = getattr(solver, algorithm)(0.0)
+        assert results['cost'] == float('inf')
+        assert results['soln'] is None
 
-            next_states.append(new_state)
+    stop = threading.Event()
+    stop.set()
+    results = solver.linKernighan(60, stop_event=stop)
+    assert results['cost'] == float('inf')
+    assert results['soln'] is None
 
-    return next_states
+
+# bb_init_state :: [City] -> BbState
+def bb_init_state(cities, start_city):
+    # Set up cost matrix
+    idx = [c._index for c in cities]
+    cost_matrix = start_city._scenario.getCostMatrix()[np.ix_(idx, idx)]
+    (cost_matrix, lower_bound) = reduce_cost(cost_matrix)
+
+    return BbState(cost_matrix, lower_bound, 0, start_city, 1 << start_city._index)
+
+
+# gen_next_states :: BbState -> [City] -> [BbState]
+def gen_next_states(start_state, pool):
+    return list(iter_next_states(start_state, pool))
+
+
+# iter_next_states :: BbState -> [City] -> Optional(Real) -> Optional(Instrument) -> Iterator(BbState)
+#
+# Children are built lazily.  Reducing a child's matrix can only raise its
+# bound, so parent_lb + reduced edge cost is already a lower bound; when
+# that exceeds `bound' the child is counted as created and pruned without
+# ever copying or reducing its matrix.
+def iter_next_states(start_state, pool, bound=None, instrumenter=None):
+    src = start_state.city._index
+
+    # Every visited city but the root already has its column inf'd out,
+    # so the root is the only back edge left to remove
+    back_edge = start_state.root._index
+
+    cheap_bounds = start_state.lb + start_state.matrix[src]
+
+    # Children pruned here are counted once the caller is done with them all
+    skipped = 0
+    try:
+        for c in pool:
+            if not start_state.visits(c):
+                if bound is not None and cheap_bounds[c._index] > bound:
+                    skipped += 1
+                    continue
+
+                new_matrix = start_state.matrix.copy()
+                cost = new_matrix[src, c._index]
+
+                # inf out row/col the picked path is on
+                new_matrix[:, c._index] = np.inf
+                new_matrix[src, :] = np.inf
+
+                # inf out back edges
+                new_matrix[c._index, back_edge] = np.inf
+
+                new_lb = reduce_cost_in_place(new_matrix)
+                yield start_state.child(new_matrix, start_state.lb + new_lb + cost, c)
+    finally:
+        if instrumenter is not None:
+            instrumenter.inc_states_created(skipped)
+            instrumenter.inc_states_pruned(skipped)
 
 
 def test_gen_next_states():
-    loc = [QPointF(0, 2), QPointF(2, 3), QPointF(3, 1), QPointF(1, -2), QPointF(-2, 0)]
+    loc = [(0, 2), (2, 3), (3, 1), (1, -2), (-2, 0)]
     s = Scenario(loc, "", 0)
     cs = s.getCities()
     cs.sort(key=lambda i: i._index)
@@ -565,13 +1976,13 @@ def test_gen_next_states():
     #   [518, 1494, 0,    inf,  0],
     #   [0,   2171, 2271, 0,    inf]],
     #  13923, [])
-    assert st[1] == 13923
+    assert state_lb(st) == 13923
 
     nss = gen_next_states(st, cs)
     assert len(nss) == 4
 
     # 1 -> 2
-    (mtx1, cst1, dpth1, pth1) = nss[0]
+    (mtx1, cst1, dpth1, pth1) = unpack_state(nss[0])
     assert dpth1 == 1
     assert cst1 == 13923 + 592
     assert pth1 == [cs[0], cs[1]]
@@ -587,7 +1998,7 @@ def test_gen_next_states():
     assert mtx1[1][0] == float('inf')
 
     # 1 -> 3
-    (mtx2, cst2, dpth2, pth2) = nss[1]
+    (mtx2, cst2, dpth2, pth2) = unpack_state(nss[1])
     assert dpth2 == 1
     assert cst2 == 13923 + 926
     assert pth2 == [cs[0], cs[2]]
@@ -606,7 +2017,7 @@ def test_gen_next_states():
     # Now take a step; 1->3 gets used
     nss = gen_next_states(nss[1], cs)
     assert len(nss) == 3
-    (mtx3, cst3, dpth3, pth3) = nss[0]
+    (mtx3, cst3, dpth3, pth3) = unpack_state(nss[0])
     assert dpth3 == 2
     assert pth3 == [cs[0], cs[2], cs[1]]
     assert cst3 == (13923 + 926) + 2086
@@ -621,7 +2032,7 @@ def test_gen_next_states():
     # The final state transition
     nss = gen_next_states(nss[0], cs)
     assert len(nss) == 1
-    (mtx4, cst4, dpth4, pth4) = nss[0]
+    (mtx4, cst4, dpth4, pth4) = unpack_state(nss[0])
     assert cst4 == (13923 + 926) + 2086 + 0
     assert dpth4 == 4
     assert pth4 == [cs[0], cs[2], cs[1], cs[3], cs[4]]
@@ -631,6 +2042,25 @@ def test_gen_next_states():
             assert c == float('inf')
 
 
+def test_iter_next_states_lazy_prune():
+    loc = [(0, 2), (2, 3), (3, 1), (1, -2), (-2, 0)]
+    s = Scenario(loc, "", 0)
+    cs = s.getCities()
+    cs.sort(key=lambda i: i._index)
+
+    st = bb_init_state(cs, cs[0])
+    # The reduced row for city 0 is [inf, 0, 926, 1110, 592], so with this
+    # bound only the children for cities 1 and 4 are worth building
+    inst = Instrumenter()
+    nss = list(iter_next_states(st, cs, state_lb(st) + 600, inst))
+    assert [state_path(ns)[-1] for ns in nss] == [cs[1], cs[4]]
+    assert inst.states_created == 2
+    assert inst.states_pruned == 2
+
+    eager = gen_next_states(st, cs)
+    assert [state_lb(ns) for ns in nss] == [state_lb(eager[0]), state_lb(eager[3])]
+
+
 def print_matrix(mtx):
     print()
     for r in mtx:
@@ -644,21 +2074,32 @@ def pprint_state(st):
     for c in state_path(st):
         print(f"{c._index}", end=", ")
 
-    # print_matrix(st[0])
+    # print_matrix(st.matrix)
     # print("\\--------------------------------------------------/")
     print()
 
 
 def state_lb(state):
-    return state[1]
+    return state.lb
 
 
 def state_depth(state):
-    return state[2]
+    return state.depth
 
 
+# state_path :: BbState -> [City]
 def state_path(s):
-    return s[3]
+    path = []
+    while s is not None:
+        path.append(s.city)
+        s = s.parent
+    path.reverse()
+    return path
+
+
+# unpack_state :: BbState -> (CostMatrix, Real, Nat, [City])
+def unpack_state(s):
+    return (s.matrix, s.lb, s.depth, state_path(s))
 
 
 def heap_state_lb(state):
@@ -676,7 +2117,7 @@ def heap_score_state(state, count_cities, bssf_score):
     # then that means, roughly, that we're exceeing what the current
     # best search has found.
 
-    (_, lb, depth, _) = state
+    lb, depth = state.lb, state.depth
     return lb - (bssf_score * ((depth ** 2) / (count_cities ** 2)))
 
 
@@ -684,36 +2125,28 @@ def heap_state_depth(state):
     return (state_depth(state), state)
 
 
-# reduce_cost :: [[Real]] -> ([[Real]], Real)
+# reduce_cost :: CostMatrix -> (CostMatrix, Real)
 def reduce_cost(m):
-    m = copy.deepcopy(m)
-    c = len(m)
-
-    cost = 0
+    m = np.array(m, dtype=float)
+    cost = reduce_cost_in_place(m)
+    return (m, cost)
 
-    # Reduce rows first
-    for i in range(c):
-        mm = float('inf')
-        for j in range(c):
-            mm = min(mm, m[i][j])
 
-        if mm < float('inf') and mm > 0:
-            cost = cost + mm
-            for j in range(c):
-                m[i][j] = m[i][j] - mm
+# reduce_cost_in_place :: CostMatrix -> Real
+def reduce_cost_in_place(m):
+    # Reduce rows first; rows that are all inf are left alone
+    mm = m.min(axis=1)
+    mm[mm == np.inf] = 0
+    m -= mm[:, np.newaxis]
+    cost = mm.sum()
 
     # Columns now
-    for i in range(c):
-        mm = float('inf')
-        for j in range(c):
-            mm = min(mm, m[j][i])
+    mm = m.min(axis=0)
+    mm[mm == np.inf] = 0
+    m -= mm[np.newaxis, :]
+    cost += mm.sum()
 
-        if mm < float('inf') and mm > 0:
-            cost = cost + mm
-            for j in range(c):
-                m[j][i] = m[j][i] - mm
-
-    return (m, cost)
+    return cost
 
 
 def test_reduce_cost():
@@ -733,14 +2166,12 @@ def test_reduce_cost():
     (mtx2, cst) = reduce_cost(mtx)
 
     assert cst == 15
-    del mtx2[0][0]
-    del mtx2[1][1]
-    del mtx2[2][2]
-    del mtx2[3][3]
-    assert mtx2[0] == [4, 0, 8]
-    assert mtx2[1] == [0, 3, 10]
-    assert mtx2[2] == [0, 3, 0]
-    assert mtx2[3] == [6, 0, 2]
+    assert np.all(np.diag(mtx2) == inf)
+    off_diag = ~np.eye(4, dtype=bool)
+    assert mtx2[0][off_diag[0]].tolist() == [4, 0, 8]
+    assert mtx2[1][off_diag[1]].tolist() == [0, 3, 10]
+    assert mtx2[2][off_diag[2]].tolist() == [0, 3, 0]
+    assert mtx2[3][off_diag[3]].tolist() == [6, 0, 2]
 
     # Ensure that mtx does not get modified
     del mtx[0][0]
@@ -761,6 +2192,6 @@ def still_timep(start, amount):
 
 # cost :: City -> City -> Real
 def cost(c1, c2):
-    if c1 == c2:
-        return float('inf')
-    return c1.costTo(c2)
+    # The diagonal of the scenario's cost matrix is already inf, in Test
+    # scenarios too (see Scenario.setup_test)
+    return c1._scenario._cost_matrix[c1._index, c2._index]